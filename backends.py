@@ -0,0 +1,545 @@
+'''
+    llm backends behind the model classes of model1.py
+
+    a backend turns (settings, contents) into a stream of text chunks
+        settings = {'model_name', 'generation_config', 'safety_settings', 'system_instruction'}
+        contents = a prompt string or a list of {'role', 'parts'} turns
+
+        configure(env_path, key_name) -> api key (or a stand-in), called once per model instance
+        stream(settings, contents)    -> iterator of text chunks
+        astream(settings, contents)   -> async iterator of text chunks
+        generate(settings, contents)  -> whole text
+        chat(settings, history, message) -> stream of the reply to message after history
+        count_tokens(settings, contents) -> input tokens of contents (a local estimate by default)
+
+    MAKE_BEST_BACKEND picks the process default : gemini (default) or fake
+
+    the static system_instruction of each model / config goes to a server side context
+    cache (instruction_cache) when the backend supports it, calls fall back to sending it
+    every time when the cache can not be created
+'''
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from cache import cache_key
+from tokens import estimate_tokens
+
+
+async def iterate_in_thread(iterator):
+    '''
+        turns a blocking iterator into an async one, every next() runs in the default executor
+    '''
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def contents_text(contents):
+    '''
+        the text of a prompt, either a plain string or a list of {'role', 'parts'} turns
+    '''
+    if isinstance(contents, str):
+        return contents
+    return ''.join(str(part) for turn in contents for part in turn.get('parts', []))
+
+
+def settings_key(settings, contents):
+    return cache_key(settings['model_name'], settings['generation_config'], settings['system_instruction'], contents_text(contents))
+
+
+class llm_backend:
+    '''
+        base of the backends : subclasses implement configure() and stream(), the rest is derived
+    '''
+
+    name = 'base'
+
+    def configure(self, env_path, key_name):
+        raise NotImplementedError
+
+    def stream(self, settings, contents):
+        raise NotImplementedError
+
+    async def astream(self, settings, contents):
+        async for chunk in iterate_in_thread(self.stream(settings, contents)):
+            yield chunk
+
+    def generate(self, settings, contents):
+        return ''.join(self.stream(settings, contents))
+
+    def chat(self, settings, history, message):
+        return self.stream(settings, list(history) + [{'role': 'user', 'parts': [message]}])
+
+    def count_tokens(self, settings, contents):
+        return estimate_tokens(contents_text(contents))
+
+
+# what the api accepts for a context cache : an explicitly versioned model (gemini-1.5-flash-001,
+# not ...-latest) and at least MIN_CACHED_TOKENS tokens of cached content
+MIN_CACHED_TOKENS = 32768
+VERSIONED_MODEL = re.compile(r'-\d{3}$')
+
+
+def cache_refusal(settings):
+    '''
+        why the api would not cache settings' system instruction, None when it would
+    '''
+    if not VERSIONED_MODEL.search(settings['model_name']):
+        return f'{settings["model_name"]} is not a versioned model name'
+    tokens = estimate_tokens(settings['system_instruction'] or '')
+    if tokens < MIN_CACHED_TOKENS:
+        return f'the instruction has ~{tokens} tokens, below the {MIN_CACHED_TOKENS} token minimum'
+    return None
+
+
+# the api's answer to a cache it will never make for these settings (too few tokens, a model
+# without context caching), retrying does not change it
+REFUSAL = re.compile(r'too small|min_total_token_count|not supported|does not support|unsupported', re.I)
+
+
+def is_refusal(error):
+    '''
+        the settings can not be cached at all : cache_refusal(), an sdk without caching, or
+        the api saying so. quota and server errors are not refusals, a later call may succeed
+    '''
+    return isinstance(error, (ValueError, ImportError)) or bool(REFUSAL.search(str(error)))
+
+
+def instruction_key(settings):
+    return cache_key(settings['model_name'], [settings['generation_config'], settings['safety_settings']], settings['system_instruction'], '')
+
+
+class instruction_cache:
+    '''
+        one context cache of a system instruction per model / config : create(settings, ttl)
+        on first use, refresh(handle, ttl) once less than refresh_before seconds of the ttl
+        are left (a failed refresh creates a new one). settings the api refuses to cache
+        (is_refusal()) are remembered and get None, i.e. plain calls, from then on, other
+        failures (quota, server errors) get None for retry_after seconds and are tried again.
+        one call per key creates / refreshes (outside the lock), the others wait for it or
+        keep using the still valid handle
+    '''
+
+    def __init__(self, create, refresh, ttl = 3600, refresh_before = 300, retry_after = 60, clock = time.monotonic):
+        self.create = create
+        self.refresh = refresh
+        self.ttl = ttl
+        self.refresh_before = refresh_before
+        self.retry_after = retry_after
+        self.clock = clock
+        self.stats = {'created': 0, 'refreshed': 0, 'hits': 0, 'fallbacks': 0, 'errors': 0, 'refused': 0}
+        self._entries = {}      # key -> [handle, expires_at]
+        self._uncacheable = set()
+        self._failed = {}       # key -> when the next try may create it
+        self._in_flight = {}    # key -> Event of the call creating / refreshing it
+        self._lock = threading.Lock()
+
+    def get(self, settings):
+        key = instruction_key(settings)
+        while True:
+            with self._lock:
+                now = self.clock()
+                if key in self._uncacheable or self._failed.get(key, now) > now:
+                    self.stats['fallbacks'] += 1
+                    return None
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] - now >= self.refresh_before:
+                    self.stats['hits'] += 1
+                    return entry[0]
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    in_flight = self._in_flight[key] = threading.Event()
+                    break
+                if entry is not None and entry[1] > now:
+                    # another call is refreshing it, the current one is still valid
+                    self.stats['hits'] += 1
+                    return entry[0]
+            in_flight.wait()    # another call is creating it, then look again
+
+        # create / refresh are round trips to the api : outside the lock, so calls of other
+        # models (and of this one, while its cache is still valid) do not queue behind them
+        stored, counter, refused = None, 'errors', False
+        try:
+            if entry is not None:
+                try:
+                    stored, counter = [self.refresh(entry[0], self.ttl), now + self.ttl], 'refreshed'
+                except Exception:
+                    pass    # expired or deleted on the server, make a new one
+            if stored is None:
+                stored, counter = [self.create(settings, self.ttl), now + self.ttl], 'created'
+        except Exception as e:
+            refused = is_refusal(e)
+            if refused:
+                counter = 'refused'
+            print(f'context cache not used for {settings["model_name"]} : {e}', file = sys.stderr)
+        finally:
+            with self._lock:
+                self.stats[counter] += 1
+                if stored is None:
+                    self.stats['fallbacks'] += 1
+                    if refused:
+                        self._uncacheable.add(key)
+                    else:
+                        self._failed[key] = now + self.retry_after
+                    self._entries.pop(key, None)
+                else:
+                    self._failed.pop(key, None)
+                    self.stats['hits'] += 1
+                    self._entries[key] = stored
+                self._in_flight.pop(key).set()
+        return stored[0] if stored is not None else None
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats, entries = len(self._entries), uncacheable = len(self._uncacheable))
+
+
+class gemini_backend(llm_backend):
+    '''
+        google.generativeai, one process wide configure() and one GenerativeModel per distinct
+        settings, both built lazily and shared by every instance / session
+
+        with context_cache the system instruction lives in a CachedContent (sdk releases that
+        have google.generativeai.caching) and the model is built from it, so the instruction
+        is neither sent nor prefilled again on every call. a model / instruction the api does
+        not cache (too short, unversioned model name, old sdk) just uses the plain model
+    '''
+
+    name = 'gemini'
+
+    def __init__(self, context_cache = False, cache_ttl = 3600):
+        self._lock = threading.Lock()
+        self._configured = False
+        self._api_key = None
+        self._models = {}
+        self.context_cache = instruction_cache(self._create_cached, self._refresh_cached, ttl = cache_ttl) if context_cache else None
+
+    def _create_cached(self, settings, ttl):
+        refusal = cache_refusal(settings)
+        if refusal is not None:
+            raise ValueError(refusal)     # the api would refuse it, no round trip
+        import google.generativeai as genai
+        from google.generativeai import caching     # ImportError on old sdks -> plain calls
+
+        cached = caching.CachedContent.create(
+            model = settings['model_name'],
+            system_instruction = settings['system_instruction'],
+            ttl = datetime.timedelta(seconds = ttl)
+        )
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content = cached,
+            generation_config = settings['generation_config'],
+            safety_settings = settings['safety_settings']
+        )
+        return cached, model
+
+    def _refresh_cached(self, handle, ttl):
+        cached, model = handle
+        cached.update(ttl = datetime.timedelta(seconds = ttl))
+        return handle
+
+    def _model_for_call(self, settings):
+        if self.context_cache is not None:
+            handle = self.context_cache.get(settings)
+            if handle is not None:
+                return handle[1]
+        return self.model(settings)
+
+    def configure(self, env_path, key_name):
+        '''
+            loads the api key and configures genai once per process, later calls just return the key
+        '''
+        with self._lock:
+            if not self._configured:
+                # the sdk and dotenv are imported here, not at module level, so importing stays cheap
+                import google.generativeai as genai
+                from dotenv import load_dotenv
+
+                load_dotenv(dotenv_path = env_path)
+                self._api_key = os.getenv(key_name)
+                genai.configure(api_key = self._api_key)
+                self._configured = True
+
+            return self._api_key
+
+    def model(self, settings):
+        key = instruction_key(settings)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                import google.generativeai as genai
+
+                try:
+                    model = genai.GenerativeModel(
+                        model_name = settings['model_name'],
+                        safety_settings = settings['safety_settings'],
+                        generation_config = settings['generation_config'],
+                        system_instruction = settings['system_instruction']
+                    )
+                except Exception as e:
+                    raise RuntimeError(f'error is found during model initilization {e}')
+                self._models[key] = model
+
+            return model
+
+    def count_tokens(self, settings, contents):
+        # a round trip to the api, callers only ask near a budget and cache it (tokens.py)
+        return self.model(settings).count_tokens(contents).total_tokens
+
+    def stream(self, settings, contents):
+        chunk_response = self._model_for_call(settings).generate_content(contents = contents, stream = True)
+        try:
+            for chunk in chunk_response:
+                if chunk.text:
+                    yield chunk.text
+        except GeneratorExit:
+            _cancel_response(chunk_response)
+            raise
+
+    async def astream(self, settings, contents):
+        '''
+            the sdk's native generate_content_async when the model has it, otherwise the
+            blocking stream is pulled chunk by chunk from a worker thread
+        '''
+        model = self._model_for_call(settings)
+        generate_async = getattr(model, 'generate_content_async', None)
+        if generate_async is None:
+            async for chunk in iterate_in_thread(self.stream(settings, contents)):
+                yield chunk
+            return
+
+        chunk_response = await generate_async(contents = contents, stream = True)
+        try:
+            async for chunk in chunk_response:
+                if chunk.text:
+                    yield chunk.text
+        except GeneratorExit:
+            _cancel_response(chunk_response)
+            raise
+
+
+def _cancel_response(response):
+    '''
+        stops a streaming response that is abandoned midway (cancelled turn), best effort :
+        the sdk keeps the transport's iterator (grpc call / http stream) on _iterator
+    '''
+    iterator = getattr(response, '_iterator', None)
+    for name in ('cancel', 'close', 'aclose'):
+        method = getattr(iterator, name, None)
+        if method is not None:
+            try:
+                result = method()
+                if hasattr(result, 'close'):
+                    result.close()      # an aclose() coroutine that can not be awaited here
+            except Exception:
+                pass
+            return
+
+
+def synthetic_response(settings, prompt_text):
+    '''
+        deterministic stand-in answer shaped like the real model's, sized from the prompt hash
+            model1 (its instruction asks for prompt_for_model2) -> ```json decision
+            <CodeToFix> / <CodeToPerfect> prompts              -> ```json report + ```python code
+            anything else                                      -> a little text + ```python code
+    '''
+    seed = int(hashlib.sha256(prompt_text.encode('utf-8')).hexdigest()[:8], 16)
+    functions = 2 + seed % 4
+
+    if 'prompt_for_model2' in (settings.get('system_instruction') or ''):
+        decision = {
+            'is_code_related': True,
+            'response_for_user': 'Sure, generating that for you.',
+            # shaped like model1's directive : fixed instructions, then the task after the marker
+            'prompt_for_model2': f'Write a python module for request {seed % 10000}. Based on this context: {prompt_text[-200:]}'
+        }
+        return f'```json\n{json.dumps(decision, indent = 2)}\n```\n'
+
+    body = '\n\n'.join(
+        f'def step_{index}(values):\n    """step {index} of the synthetic solution"""\n'
+        f'    return [value * {index + 1} for value in values]'
+        for index in range(functions)
+    )
+    code = f'{body}\n\n\nif __name__ == "__main__":\n    print(step_0([1, 2, 3]))'
+
+    if '<CodeToFix' in prompt_text or '<CodeToPerfect' in prompt_text:
+        report = {'diagnosis': 'no execution-halting errors found', 'changes': [], 'status': 'SUCCESS'}
+        return f'```json\n{json.dumps(report, indent = 2)}\n```\n```python\n{code}\n```\n'
+    return f'Here is the implementation ({functions} functions).\n\n```python\n{code}\n```\n\nRun it with `python main.py`.\n'
+
+
+class fake_backend(llm_backend):
+    '''
+        offline, deterministic backend for load tests and profiling, no network and no key
+
+        replays the recorded answer of a prompt when there is one (JSONL of {"key", "text"},
+        see recording_backend), else synthetic_response(). the text is streamed in chunks of
+        chunk_tokens tokens (~4 characters each) after first_token_latency seconds, sleeping
+        token_latency seconds per token
+
+        prefill_latency seconds per input token are added before the first chunk, the system
+        instruction included unless the local stand-in of the context cache holds it. the
+        stand-in refuses what the api refuses (cache_refusal()) and falls back the same way,
+        so with the shipped model names and instructions it saves nothing, as in production
+    '''
+
+    name = 'fake'
+
+    def __init__(self, token_latency = 0.0, chunk_tokens = 8, first_token_latency = 0.0, recordings = None,
+                 responder = synthetic_response, prefill_latency = 0.0, context_cache = False, cache_ttl = 3600):
+        self.token_latency = token_latency
+        self.chunk_tokens = chunk_tokens
+        self.first_token_latency = first_token_latency
+        self.prefill_latency = prefill_latency
+        self.responder = responder
+        self.recordings = load_recordings(recordings) if isinstance(recordings, str) else dict(recordings or {})
+        self.calls = 0
+        self.context_cache = instruction_cache(self._create_cached, lambda handle, ttl: handle, ttl = cache_ttl) if context_cache else None
+
+    def _create_cached(self, settings, ttl):
+        refusal = cache_refusal(settings)
+        if refusal is not None:
+            raise ValueError(refusal)
+        return {'instruction_tokens': estimate_tokens(settings['system_instruction'] or '')}
+
+    def configure(self, env_path, key_name):
+        return 'fake'
+
+    def response(self, settings, contents):
+        self.calls += 1
+        recorded = self.recordings.get(settings_key(settings, contents))
+        if recorded is not None:
+            return recorded
+        return self.responder(settings, contents_text(contents))
+
+    def _chunks(self, text):
+        size = max(1, self.chunk_tokens * 4)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def _delay(self, chunk):
+        return (len(chunk) / 4) * self.token_latency
+
+    def _first_delay(self, settings, contents):
+        if self.context_cache is not None and self.context_cache.get(settings) is not None:
+            input_tokens = 0
+        else:
+            input_tokens = estimate_tokens(settings['system_instruction'] or '')
+        input_tokens += estimate_tokens(contents_text(contents))
+        return self.first_token_latency + input_tokens * self.prefill_latency
+
+    def stream(self, settings, contents):
+        chunks = self._chunks(self.response(settings, contents))
+        delay = self._first_delay(settings, contents)
+        if delay:
+            time.sleep(delay)
+        for chunk in chunks:
+            if self.token_latency:
+                time.sleep(self._delay(chunk))
+            yield chunk
+
+    async def astream(self, settings, contents):
+        chunks = self._chunks(self.response(settings, contents))
+        delay = self._first_delay(settings, contents)
+        if delay:
+            await asyncio.sleep(delay)
+        for chunk in chunks:
+            if self.token_latency:
+                await asyncio.sleep(self._delay(chunk))
+            yield chunk
+
+
+def load_recordings(path):
+    recordings = {}
+    if not os.path.exists(path):
+        return recordings
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            recordings[record['key']] = record['text']
+    return recordings
+
+
+class recording_backend(llm_backend):
+    '''
+        wraps another backend and appends every finished answer to a JSONL file that
+        fake_backend(recordings = path) replays later
+    '''
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.name = f'recording({backend.name})'
+        self.context_cache = getattr(backend, 'context_cache', None)
+        self._lock = threading.Lock()
+
+    def configure(self, env_path, key_name):
+        return self.backend.configure(env_path, key_name)
+
+    def count_tokens(self, settings, contents):
+        return self.backend.count_tokens(settings, contents)
+
+    def _save(self, settings, contents, chunks):
+        line = json.dumps({'key': settings_key(settings, contents), 'text': ''.join(chunks)}, ensure_ascii = False) + '\n'
+        with self._lock, open(self.path, 'a', encoding = 'utf-8') as f:
+            f.write(line)
+
+    def stream(self, settings, contents):
+        chunks = []
+        for chunk in self.backend.stream(settings, contents):
+            chunks.append(chunk)
+            yield chunk
+        self._save(settings, contents, chunks)
+
+    async def astream(self, settings, contents):
+        chunks = []
+        async for chunk in self.backend.astream(settings, contents):
+            chunks.append(chunk)
+            yield chunk
+        self._save(settings, contents, chunks)
+
+
+def backend_from_env():
+    '''
+        MAKE_BEST_BACKEND        gemini (default) or fake
+        MAKE_BEST_FAKE_LATENCY   fake : seconds per token (default 0)
+        MAKE_BEST_FAKE_TTFT      fake : seconds before the first chunk (default 0)
+        MAKE_BEST_FAKE_CHUNK     fake : tokens per chunk (default 8)
+        MAKE_BEST_FAKE_PREFILL   fake : seconds per input token before the first chunk (default 0)
+        MAKE_BEST_CONTEXT_CACHE  1 keeps system instructions of MIN_CACHED_TOKENS or more in a context
+                                 cache, 0 sends them with every call (default 0)
+        MAKE_BEST_CONTEXT_CACHE_TTL  seconds a context cache lives between refreshes (default 3600)
+        MAKE_BEST_RECORDINGS     fake : JSONL to replay / other backends : JSONL to record to
+    '''
+    recordings = os.getenv('MAKE_BEST_RECORDINGS')
+    context_cache = os.getenv('MAKE_BEST_CONTEXT_CACHE', '0').strip() == '1'
+    cache_ttl = int(os.getenv('MAKE_BEST_CONTEXT_CACHE_TTL', '3600'))
+    if os.getenv('MAKE_BEST_BACKEND', 'gemini').strip().lower() == 'fake':
+        return fake_backend(
+            token_latency = float(os.getenv('MAKE_BEST_FAKE_LATENCY', '0')),
+            chunk_tokens = int(os.getenv('MAKE_BEST_FAKE_CHUNK', '8')),
+            first_token_latency = float(os.getenv('MAKE_BEST_FAKE_TTFT', '0')),
+            prefill_latency = float(os.getenv('MAKE_BEST_FAKE_PREFILL', '0')),
+            recordings = recordings,
+            context_cache = context_cache,
+            cache_ttl = cache_ttl
+        )
+
+    backend = gemini_backend(context_cache = context_cache, cache_ttl = cache_ttl)
+    return recording_backend(backend, recordings) if recordings else backend
+
+
+default_backend = backend_from_env()
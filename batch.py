@@ -0,0 +1,153 @@
+'''
+    batch mode : runs a JSONL file of prompts through model1 -> model2 .. model5
+
+        python batch.py prompts.jsonl results.jsonl --concurrency 8 --mode asyncio
+
+    every input line is {"id": ..., "prompt": ...} (id defaults to the line number)
+    every output line holds the model1 decision, the per stage outputs and timings
+    a record is appended (and fsynced) as soon as its turn finishes, so after a crash
+    the same command resumes : ids that already have a record without error are skipped,
+    and with MAKE_BEST_CHECKPOINT_PATH a failed id continues after its last finished stage
+'''
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import default_pipeline, run_pipeline, run_turn
+
+
+def read_prompts(path):
+    prompts = []
+    with open(path, encoding = 'utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            prompts.append({'id': str(record.get('id', line_number)), 'prompt': record['prompt']})
+    return prompts
+
+
+def completed_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue    # torn last line of a crashed run
+            if record.get('error') is None:
+                done.add(record['id'])
+    return done
+
+
+class result_writer:
+    '''
+        thread safe JSONL appender, one flushed + fsynced line per finished turn
+    '''
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        torn = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b'\n'
+
+        self._file = open(path, 'a', encoding = 'utf-8')
+        if torn:
+            self._file.write('\n')
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii = False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def _record(item, result = None, error = None):
+    record = {'id': item['id'], 'prompt': item['prompt']}
+    record.update(result or {'trace_id': None, 'turn_id': None, 'model1': None, 'tier': None, 'response_for_user': '', 'outputs': {}, 'final': None, 'timings': None, 'tokens': None})
+    record['error'] = error
+    record['finished_at'] = time.time()
+    return record
+
+
+def _turn_id(item):
+    # stable across runs, a retried id picks up its stage checkpoints
+    return f"batch:{item['id']}:{hashlib.sha1(item['prompt'].encode('utf-8')).hexdigest()[:12]}"
+
+
+def run_threads(items, writer, concurrency, pipelined):
+    def _one(item):
+        try:
+            result = run_turn(item['prompt'], pipeline = default_pipeline(pipelined), turn_id = _turn_id(item))
+            record = _record(item, result)
+        except Exception as e:
+            record = _record(item, error = f'{type(e).__name__}: {e}')
+        writer.write(record)
+        return record
+
+    with ThreadPoolExecutor(max_workers = concurrency) as pool:
+        return list(pool.map(_one, items))
+
+
+async def run_asyncio(items, writer, concurrency, pipelined):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def _one(item):
+        async with limit:
+            try:
+                result = await run_pipeline(item['prompt'], pipeline = default_pipeline(pipelined), turn_id = _turn_id(item))
+                record = _record(item, result)
+            except Exception as e:
+                record = _record(item, error = f'{type(e).__name__}: {e}')
+        writer.write(record)
+        return record
+
+    return await asyncio.gather(*(_one(item) for item in items))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'run a JSONL file of prompts through the M1 -> M5 pipeline')
+    parser.add_argument('prompts', help = 'input JSONL, one {"id": ..., "prompt": ...} per line')
+    parser.add_argument('results', help = 'output JSONL, appended to and used to resume')
+    parser.add_argument('--concurrency', type = int, default = 4, help = 'turns in flight at once')
+    parser.add_argument('--mode', choices = ['thread', 'asyncio'], default = 'asyncio')
+    parser.add_argument('--sequential', action = 'store_true', help = 'wait for each whole stage instead of overlapping them')
+    args = parser.parse_args(argv)
+
+    items = read_prompts(args.prompts)
+    done = completed_ids(args.results)
+    todo = [item for item in items if item['id'] not in done]
+    print(f'{len(items)} prompts, {len(items) - len(todo)} already done, running {len(todo)}')
+
+    writer = result_writer(args.results)
+    started = time.perf_counter()
+    try:
+        if args.mode == 'thread':
+            records = run_threads(todo, writer, args.concurrency, not args.sequential)
+        else:
+            records = asyncio.run(run_asyncio(todo, writer, args.concurrency, not args.sequential))
+    finally:
+        writer.close()
+
+    failed = sum(1 for record in records if record['error'] is not None)
+    print(f'finished {len(records)} turns ({failed} failed) in {time.perf_counter() - started:.1f}s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,284 @@
+'''
+    end to end benchmark of a turn : model1 -> M2 .. M5, parsing and rendering, no network
+
+        python bench.py --turns 50 --latency 0.002 --ttft 0.3 --out bench.json
+        python bench.py --turns 50 --out new.json --baseline bench.json
+        python bench.py --turns 50 --profile fast --out fast.json
+
+    the models run on the offline fake backend (backends.py), synthetic answers or the
+    recordings given with --recordings, the stage outputs are fed to the same stream_renderer
+    the streamlit app uses (drawing into a placeholder that only counts calls)
+
+    reports p50 / p95 / p99 of time to first token, per stage wall time, parse and render
+    time and chunks/s as JSON, and the share of final answers whose code passes the local
+    checks (quality, to compare the pipelines.json profiles). with --baseline, metrics whose p50 or p95 got slower than
+    the baseline by more than --tolerance are listed and the exit code is 1
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import fake_backend
+from stream_parser import parse_all, parse_model1_output
+
+
+def percentiles(values):
+    # nearest rank, enough for a regression check
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def _rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+    return {
+        'p50': _rank(50), 'p95': _rank(95), 'p99': _rank(99),
+        'mean': sum(ordered) / len(ordered), 'max': ordered[-1], 'n': len(ordered)
+    }
+
+
+class null_placeholder:
+    '''
+        stands in for st.empty() / st.container() : accepts every drawing call and counts them
+    '''
+
+    calls = 0
+
+    def _draw(self, *args, **kwargs):
+        null_placeholder.calls += 1
+
+    markdown = code = json = _draw
+
+    def container(self):
+        return null_placeholder()
+
+    def empty(self):
+        return null_placeholder()
+
+
+def run_one(prompt, pipelined = True, render = True, profile = None):
+    '''
+        one turn driven like streamlit_app.py does, returns its raw measurements in seconds
+    '''
+    from fanout import score_candidate
+    from model1 import make_model1
+    from pipeline import default_pipeline
+    from render import stream_renderer
+
+    measure = {'ttft': None, 'model1': None, 'code_ttft': None, 'parse': 0.0, 'render': 0.0, 'frames': 0, 'stages': {}, 'quality': None}
+    started = time.perf_counter()
+
+    model1 = make_model1()
+    reply = []
+    for chunk in model1.stream(prompt):
+        if measure['ttft'] is None:
+            measure['ttft'] = time.perf_counter() - started
+        reply.append(chunk)
+    measure['model1'] = time.perf_counter() - started
+
+    parse_started = time.perf_counter()
+    decision = parse_model1_output(''.join(reply)) or {}
+    measure['parse'] += time.perf_counter() - parse_started
+
+    prompt_for_model2 = decision.get('prompt_for_model2', '') if decision.get('is_code_related') else ''
+    final = None
+    if prompt_for_model2.strip():
+        renderers = {}
+        for kind, name, data in default_pipeline(pipelined, profile).stream(prompt_for_model2):
+            now = time.perf_counter() - started
+            stage = measure['stages'].setdefault(name, {'start': now, 'first_chunk': None, 'done': None, 'chunks': 0})
+            if kind == 'start' and render:
+                renderers[name] = stream_renderer(null_placeholder())
+            elif kind == 'restart':
+                # the stage starts again on the whole upstream output, time that run
+                del measure['stages'][name]
+                renderers.pop(name, None)
+            elif kind == 'chunk':
+                stage['chunks'] += 1
+                if stage['first_chunk'] is None:
+                    stage['first_chunk'] = now
+                if measure['code_ttft'] is None:
+                    measure['code_ttft'] = now
+                if name in renderers:
+                    render_started = time.perf_counter()
+                    renderers[name].write(data)
+                    measure['render'] += time.perf_counter() - render_started
+            elif kind in ('done', 'skip', 'verified', 'cached'):
+                stage['done'] = now
+                final = data
+                if name in renderers:
+                    render_started = time.perf_counter()
+                    renderers[name].finish()
+                    measure['render'] += time.perf_counter() - render_started
+                    measure['frames'] += renderers.pop(name).frames
+
+    if final is not None:
+        parse_started = time.perf_counter()
+        parse_all(final)   # what display_ai_parts_from_string does with the final output
+        measure['parse'] += time.perf_counter() - parse_started
+        measure['quality'] = score_candidate(final)
+
+    measure['total'] = time.perf_counter() - started
+    return measure
+
+
+def summarize(measures, wall):
+    stage_names = []
+    for measure in measures:
+        stage_names += [name for name in measure['stages'] if name not in stage_names]
+
+    def _values(key):
+        return [m[key] for m in measures if m[key] is not None]
+
+    stages = {}
+    for name in stage_names:
+        runs = [m['stages'][name] for m in measures if name in m['stages']]
+        timed = [run for run in runs if run['done'] is not None]
+        streamed = [run for run in timed if run['chunks'] and run['done'] > run['start']]
+        stages[name] = {
+            'ttft': percentiles([run['first_chunk'] - run['start'] for run in runs if run['first_chunk'] is not None]),
+            'wall': percentiles([run['done'] - run['start'] for run in timed]),
+            'chunks_per_second': percentiles([run['chunks'] / (run['done'] - run['start']) for run in streamed]),
+            'ran': len(streamed),
+            'skipped': len(runs) - len(streamed)
+        }
+
+    scored = [m['quality'] for m in measures if m['quality'] is not None]
+    return {
+        'turns': len(measures),
+        'quality': {
+            'passed': sum(score['ok'] for score in scored) / len(scored) if scored else None,
+            'lint_warnings': sum(score['warnings'] for score in scored) / len(scored) if scored else None,
+            'n': len(scored)
+        },
+        'wall_seconds': wall,
+        'turns_per_second': len(measures) / wall if wall else None,
+        'metrics': {
+            'ttft': percentiles(_values('ttft')),
+            'model1': percentiles(_values('model1')),
+            'code_ttft': percentiles(_values('code_ttft')),
+            'total': percentiles(_values('total')),
+            'parse': percentiles(_values('parse')),
+            'render': percentiles(_values('render')),
+            'render_frames': percentiles(_values('frames')),
+            'stages': stages
+        }
+    }
+
+
+def import_seconds(runs = 3):
+    '''
+        cold import times of the app's modules, a fresh interpreter per run started in this
+        file's directory, so the modules timed are the ones next to it whatever the caller's cwd
+    '''
+    script = 'import time; t = time.perf_counter(); import model1, pipeline, render; print(time.perf_counter() - t)'
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, '-c', script], capture_output = True, text = True,
+                                   cwd = os.path.dirname(os.path.abspath(__file__)))
+        if completed.returncode == 0:
+            samples.append(float(completed.stdout))
+    return samples
+
+
+def regressions(report, baseline, tolerance):
+    '''
+        [(metric, percentile, baseline value, new value)] for the p50 / p95 that got slower
+    '''
+    slower = []
+
+    def _walk(path, new, old):
+        if not isinstance(new, dict) or not isinstance(old, dict):
+            return
+        if 'p50' in new:
+            if path[-1] in ('chunks_per_second', 'render_frames'):
+                return      # higher is better / not a time
+            for p in ('p50', 'p95'):
+                if old.get(p) and new[p] > old[p] * (1 + tolerance):
+                    slower.append(('.'.join(path), p, old[p], new[p]))
+            return
+        for key in new:
+            _walk(path + [key], new[key], old.get(key))
+
+    _walk(['metrics'], report['metrics'], baseline.get('metrics'))
+    return slower
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'benchmark the M1 -> M5 pipeline on the offline fake backend')
+    parser.add_argument('--turns', type = int, default = 20)
+    parser.add_argument('--concurrency', type = int, default = 1, help = 'turns in flight at once')
+    parser.add_argument('--prompts', help = 'JSONL of {"id", "prompt"} (batch.py format), default synthetic prompts')
+    parser.add_argument('--recordings', help = 'JSONL recorded by backends.recording_backend to replay')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'fake seconds per token')
+    parser.add_argument('--ttft', type = float, default = 0.0, help = 'fake seconds before the first chunk')
+    parser.add_argument('--chunk', type = int, default = 8, help = 'fake tokens per chunk')
+    parser.add_argument('--prefill', type = float, default = 0.0, help = 'fake seconds per input token before the first chunk (system instructions only skip it when the api could cache them, see backends.cache_refusal)')
+    parser.add_argument('--context-cache', action = 'store_true', help = 'keep the system instructions in a (fake) context cache, off by default as in MAKE_BEST_CONTEXT_CACHE')
+    parser.add_argument('--cache', action = 'store_true', help = 'keep the response cache on (off by default)')
+    parser.add_argument('--limiter', action = 'store_true', help = 'keep the rate limiter on (off by default)')
+    parser.add_argument('--profile', help = 'pipelines.json profile to run (default MAKE_BEST_PIPELINE / the file default)')
+    parser.add_argument('--sequential', action = 'store_true', help = 'wait for each whole stage instead of overlapping them')
+    parser.add_argument('--no-render', action = 'store_true', help = 'skip the stream_renderer part')
+    parser.add_argument('--out', help = 'write the JSON report here (default stdout)')
+    parser.add_argument('--baseline', help = 'earlier JSON report to compare with')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    from cache import default_cache
+    from model1 import make_best, make_base_model, make_stage_model
+
+    make_best.backend = fake_backend(
+        token_latency = args.latency, chunk_tokens = args.chunk,
+        first_token_latency = args.ttft, recordings = args.recordings,
+        prefill_latency = args.prefill, context_cache = args.context_cache
+    )
+    if not args.limiter:
+        make_base_model.limiter = None
+    if not args.cache:
+        make_stage_model.cache = None
+
+    if args.prompts:
+        from batch import read_prompts
+        prompts = [item['prompt'] for item in read_prompts(args.prompts)]
+    else:
+        prompts = [f'write a python function for task number {index}' for index in range(args.turns)]
+    prompts = (prompts * (args.turns // max(1, len(prompts)) + 1))[:args.turns]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = args.concurrency) as pool:
+        measures = list(pool.map(lambda prompt: run_one(prompt, not args.sequential, not args.no_render, args.profile), prompts))
+    report = summarize(measures, time.perf_counter() - started)
+
+    # under metrics, so regressions() compares it against the baseline like the turn timings
+    report['metrics']['import'] = percentiles(import_seconds())
+    report['config'] = {key: value for key, value in vars(args).items() if key not in ('out', 'baseline')}
+    report['python'] = platform.python_version()
+    if args.cache:
+        report['cache'] = default_cache.summary()
+    if make_best.backend.context_cache is not None:
+        report['context_cache'] = make_best.backend.context_cache.summary()
+
+    text = json.dumps(report, indent = 2)
+    if args.out:
+        with open(args.out, 'w', encoding = 'utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding = 'utf-8') as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for metric, p, old, new in slower:
+            print(f'slower : {metric} {p} {old * 1000:.1f}ms -> {new * 1000:.1f}ms', file = sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def cache_key(model_name, generation_config, system_instruction, prompt):
+    '''
+        content address of one stage call : same model, config, instructions and prompt -> same key
+    '''
+    payload = json.dumps(
+        [model_name, generation_config, _sha256(system_instruction or ''), prompt],
+        sort_keys = True,
+        default = str
+    )
+    return _sha256(payload)
+
+
+class response_cache:
+    '''
+        LRU of finished streams (the list of chunks, so a hit replays as a stream)
+        bounded by entries, bytes and ttl, with an optional sqlite tier on disk that
+        survives restarts. stats counts hits / misses and what the hits saved
+    '''
+
+    def __init__(self, max_entries = 256, max_bytes = 64 * 1024 * 1024, ttl = 24 * 3600, disk_path = None, max_disk_entries = 5000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+
+        self._entries = OrderedDict()   # key -> (stored_at, elapsed, chunks, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'saved_seconds': 0.0,
+            'saved_chars': 0
+        }
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread = False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses '
+                '(key TEXT PRIMARY KEY, stored_at REAL, elapsed REAL, chunks TEXT)'
+            )
+            self._db.commit()
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0]):
+                self._drop(key)
+                entry = None
+
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    'SELECT stored_at, elapsed, chunks FROM responses WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    chunks = json.loads(row[2])
+                    self._remember(key, row[0], row[1], chunks)
+                    entry = (row[0], row[1], chunks, sum(len(chunk) for chunk in chunks))
+                    self.stats['disk_hits'] += 1
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            self.stats['saved_seconds'] += entry[1]
+            self.stats['saved_chars'] += entry[3]
+            return list(entry[2])
+
+    def put(self, key, chunks, elapsed = 0.0):
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, elapsed, list(chunks))
+            self.stats['stores'] += 1
+
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                    (key, stored_at, elapsed, json.dumps(list(chunks)))
+                )
+                if self.ttl is not None:
+                    self._db.execute('DELETE FROM responses WHERE stored_at < ?', (stored_at - self.ttl,))
+                self._db.execute(
+                    'DELETE FROM responses WHERE key NOT IN '
+                    '(SELECT key FROM responses ORDER BY stored_at DESC LIMIT ?)',
+                    (self.max_disk_entries,)
+                )
+                self._db.commit()
+
+    def _remember(self, key, stored_at, elapsed, chunks):
+        if key in self._entries:
+            self._drop(key)
+        size = sum(len(chunk) for chunk in chunks)
+        self._entries[key] = (stored_at, elapsed, chunks, size)
+        self._bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM responses')
+                self._db.commit()
+
+    def summary(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(
+                self.stats,
+                entries = len(self._entries),
+                bytes = self._bytes,
+                hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+            )
+
+
+# shared by every stage model, set MAKE_BEST_CACHE_PATH to keep it across restarts
+default_cache = response_cache(disk_path = os.getenv('MAKE_BEST_CACHE_PATH'))
@@ -0,0 +1,83 @@
+'''
+    per turn cancellation : a cancel_token with an optional deadline, made current for a turn
+    with cancel_scope(). model streams call check_cancelled() between chunks, the pipeline
+    stops starting stages and its consumer aborts as soon as the token is cancelled
+
+    like the tracing context, the current token follows into asyncio tasks and into the
+    threads the pipeline starts (they run in a copied context)
+'''
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+
+_current_token = contextvars.ContextVar('make_best_cancel', default = None)
+
+
+class turn_cancelled(RuntimeError):
+    pass
+
+
+class cancel_token:
+
+    def __init__(self, deadline = None, clock = time.monotonic):
+        '''
+            deadline : seconds from now after which the token counts as cancelled, None for none
+        '''
+        self.clock = clock
+        self.deadline_at = clock() + deadline if deadline is not None else None
+        self.reason = None
+        self._event = threading.Event()
+
+    def cancel(self, reason = 'cancelled'):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline_at is not None and self.clock() >= self.deadline_at:
+            self.cancel('deadline exceeded')
+        return self._event.is_set()
+
+    def remaining(self):
+        if self.deadline_at is None:
+            return None
+        return max(0.0, self.deadline_at - self.clock())
+
+    def check(self):
+        if self.cancelled:
+            raise turn_cancelled(f'turn cancelled : {self.reason}')
+
+
+def turn_token(deadline = None):
+    '''
+        token for a new turn, deadline defaults to MAKE_BEST_TURN_DEADLINE seconds (unset = none)
+    '''
+    if deadline is None and os.getenv('MAKE_BEST_TURN_DEADLINE'):
+        deadline = float(os.environ['MAKE_BEST_TURN_DEADLINE'])
+    return cancel_token(deadline)
+
+
+def current_token():
+    return _current_token.get()
+
+
+def check_cancelled():
+    '''
+        raises turn_cancelled when the current turn's token is cancelled, cheap enough per chunk
+    '''
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+@contextlib.contextmanager
+def cancel_scope(token):
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
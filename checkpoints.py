@@ -0,0 +1,133 @@
+'''
+    per turn checkpoints of the M2 .. M5 chain : every finished stage output is written as soon
+    as the pipeline sees it, keyed by (turn id, stage). a turn that failed or was cancelled in
+    model4 resumes from model3's stored output instead of paying for model2 and model3 again,
+    and a later stage can be re-run alone (make_pipeline(checkpoints = ...).stream(..., turn_id))
+
+    sqlite, in memory by default (retries within the process), MAKE_BEST_CHECKPOINT_PATH keeps
+    them on disk across restarts. only the newest max_turns turns are kept
+'''
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def new_turn_id():
+    return uuid.uuid4().hex
+
+
+class checkpoint_store:
+
+    def __init__(self, path = ':memory:', max_turns = 500):
+        self.path = path
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        self.stats = {'turns': 0, 'saved': 0, 'resumed': 0, 'reused_stages': 0}
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS turns '
+            '(turn_id TEXT PRIMARY KEY, prompt TEXT, status TEXT, error TEXT, started_at REAL, updated_at REAL, profile TEXT, tier TEXT);'
+            'CREATE TABLE IF NOT EXISTS stages '
+            '(turn_id TEXT, stage TEXT, kind TEXT, output TEXT, finished_at REAL, PRIMARY KEY (turn_id, stage));'
+        )
+        # files written before turns kept their profile and tier
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(turns)')}
+        for column in ('profile', 'tier'):
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE turns ADD COLUMN {column} TEXT')
+        self._db.commit()
+
+    def begin(self, turn_id, prompt, profile = None, tier = None, rerun = ()):
+        '''
+            registers a turn (the prompt the chain starts from, the pipeline profile and model tier
+            its stages run with), an existing one keeps those and is marked running again. the
+            stages in rerun are dropped, a rerun that fails leaves none of their old outputs behind
+        '''
+        now = time.time()
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE turns SET status = 'running', error = NULL, updated_at = ? WHERE turn_id = ?", (now, turn_id)
+            ).rowcount
+            if not updated:
+                self._db.execute(
+                    "INSERT INTO turns (turn_id, prompt, status, error, started_at, updated_at, profile, tier) "
+                    "VALUES (?, ?, 'running', NULL, ?, ?, ?, ?)", (turn_id, prompt, now, now, profile, tier)
+                )
+                self.stats['turns'] += 1
+                self._prune()
+            self._db.executemany('DELETE FROM stages WHERE turn_id = ? AND stage = ?', [(turn_id, stage) for stage in rerun])
+            self._db.commit()
+
+    def save(self, turn_id, stage, kind, output):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)', (turn_id, stage, kind, output, time.time()))
+            self._db.execute('UPDATE turns SET updated_at = ? WHERE turn_id = ?', (time.time(), turn_id))
+            self._db.commit()
+            self.stats['saved'] += 1
+
+    def finish(self, turn_id, status = 'done', error = None):
+        '''
+            status : done, failed or cancelled
+        '''
+        with self._lock:
+            self._db.execute('UPDATE turns SET status = ?, error = ?, updated_at = ? WHERE turn_id = ?',
+                             (status, error, time.time(), turn_id))
+            self._db.commit()
+
+    def turn(self, turn_id):
+        '''
+            {'turn_id', 'prompt', 'status', 'error', 'profile', 'tier', 'stages': {stage: {'kind', 'output'}}} or None
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT prompt, status, error, profile, tier FROM turns WHERE turn_id = ?', (turn_id,)).fetchone()
+            if row is None:
+                return None
+            stages = self._db.execute('SELECT stage, kind, output FROM stages WHERE turn_id = ?', (turn_id,)).fetchall()
+        return {
+            'turn_id': turn_id, 'prompt': row[0], 'status': row[1], 'error': row[2], 'profile': row[3], 'tier': row[4],
+            'stages': {stage: {'kind': kind, 'output': output} for stage, kind, output in stages}
+        }
+
+    def outputs(self, turn_id, stages, rerun_from = None, profile = None, tier = None):
+        '''
+            {stage: output} of the leading stages (names in pipeline order) that finished,
+            stopping before rerun_from so that stage and the ones after it run again.
+            ValueError when the turn ran with another profile or tier, its outputs would not
+            be what this pipeline hands downstream
+        '''
+        turn = self.turn(turn_id)
+        if turn is not None and turn['stages'] and (turn['profile'], turn['tier']) != (profile, tier):
+            raise ValueError(f"turn {turn_id} ran with profile {turn['profile']!r} and tier {turn['tier']!r}, "
+                             f"not {profile!r} and {tier!r}")
+        outputs = {}
+        for stage in stages:
+            if turn is None or stage == rerun_from or stage not in turn['stages']:
+                break
+            outputs[stage] = turn['stages'][stage]['output']
+        if outputs:
+            with self._lock:
+                self.stats['resumed'] += 1
+                self.stats['reused_stages'] += len(outputs)
+        return outputs
+
+    def recent(self, limit = 10):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT turn_id, status, error, updated_at FROM turns ORDER BY updated_at DESC LIMIT ?', (limit,)
+            ).fetchall()
+        return [{'turn_id': turn_id, 'status': status, 'error': error, 'updated_at': updated_at} for turn_id, status, error, updated_at in rows]
+
+    def _prune(self):
+        old = 'SELECT turn_id FROM turns ORDER BY updated_at DESC LIMIT -1 OFFSET ?'
+        self._db.execute(f'DELETE FROM stages WHERE turn_id IN ({old})', (self.max_turns,))
+        self._db.execute(f'DELETE FROM turns WHERE turn_id IN ({old})', (self.max_turns,))
+
+    def summary(self):
+        with self._lock:
+            by_status = dict(self._db.execute('SELECT status, COUNT(*) FROM turns GROUP BY status').fetchall())
+            return dict(self.stats, by_status = by_status)
+
+
+default_checkpoints = checkpoint_store(os.getenv('MAKE_BEST_CHECKPOINT_PATH') or ':memory:')
@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+import time
+
+from sandbox import check_code, lint_warnings
+from stream_parser import first_code_block
+
+
+def score_candidate(text, run = False, timeout = 10.0):
+    '''
+        cheap local score of one stage answer, higher is better :
+            (passed all checks, checks passed, -lint warnings)
+    '''
+    code = first_code_block(text) or text.strip()
+    result = check_code(code, run = run, timeout = timeout)
+    steps = ['parse', 'compile', 'run'] if run else ['parse', 'compile']
+    passed = len(steps) if result['ok'] else steps.index(result['step'])
+    warnings = lint_warnings(code) if passed >= 1 else []
+    return {
+        'ok': result['ok'],
+        'score': (result['ok'], passed, -len(warnings)),
+        'error': result['error'],
+        'warnings': len(warnings)
+    }
+
+
+class fanout_model:
+    '''
+        n parallel samples of one stage, only the best goes downstream
+
+        every candidate streams the same prompt past the response cache (fresh samples), the
+        first one whose code passes the local checks wins and the others are cancelled at
+        their next chunk. when none passes, the best scored one wins once all have finished.
+        the winner is stored in the response cache and yielded as the stage's output
+
+        stream() / astream() behave like the wrapped model's, other attributes are read from it
+    '''
+
+    def __init__(self, model, candidates = 3, run = False, timeout = 10.0):
+        self.model = model
+        self.candidates = candidates
+        self.run = run
+        self.timeout = timeout
+        self.stats = {'fanouts': 0, 'candidates': 0, 'cancelled': 0, 'failed': 0, 'passed': 0, 'best_effort': 0, 'cache_hits': 0, 'winner_index': {}}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # generation_config, settings, backend ... of the wrapped model (token budgets use them)
+        return getattr(self.model, name)
+
+    def _count(self, name, amount = 1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def _cached(self, prompt):
+        lookup = getattr(self.model, '_cache_lookup', None)
+        if lookup is None:
+            return None, None
+        return lookup(prompt)
+
+    def _store(self, key, text, started):
+        if key is not None:
+            self.model.cache.put(key, [text], time.perf_counter() - started)
+
+    def _pick(self, finished):
+        '''
+            finished : [(index, text, score)] -> winner, counts the outcome
+        '''
+        index, text, score = max(finished, key = lambda item: item[2]['score'])
+        with self._lock:
+            self.stats['passed' if score['ok'] else 'best_effort'] += 1
+            self.stats['winner_index'][index] = self.stats['winner_index'].get(index, 0) + 1
+        return text
+
+    def _candidate(self, index, prompt, cancelled, results):
+        chunks = []
+        try:
+            stream = self.model.stream(prompt, use_cache = False)
+            for chunk in stream:
+                if cancelled.is_set():
+                    stream.close()
+                    self._count('cancelled')
+                    return
+                chunks.append(chunk)
+        except Exception as e:
+            results.put((index, None, e))
+            return
+        text = ''.join(chunks)
+        results.put((index, text, score_candidate(text, self.run, self.timeout)))
+
+    def stream(self, prompt):
+        key, cached_chunks = self._cached(prompt)
+        if cached_chunks is not None:
+            self._count('cache_hits')
+            yield from cached_chunks
+            return
+
+        self._count('fanouts')
+        self._count('candidates', self.candidates)
+        started = time.perf_counter()
+        cancelled = threading.Event()
+        results = queue.Queue()
+        for index in range(self.candidates):
+            # copied context : the candidates keep the turn's trace and cancel token
+            context = contextvars.copy_context()
+            threading.Thread(target = context.run, args = (self._candidate, index, prompt, cancelled, results), daemon = True).start()
+
+        finished, errors = [], []
+        for _ in range(self.candidates):
+            index, text, score = results.get()
+            if text is None:
+                errors.append(score)
+                self._count('failed')
+                continue
+            finished.append((index, text, score))
+            if score['ok']:
+                cancelled.set()
+                break
+
+        if not finished:
+            raise errors[0]
+        winner = self._pick(finished)
+        self._store(key, winner, started)
+        yield winner
+
+    async def _acandidate(self, index, prompt):
+        chunks = [chunk async for chunk in self.model.astream(prompt, use_cache = False)]
+        text = ''.join(chunks)
+        # the checks may run a subprocess, keep them off the event loop
+        return index, text, await asyncio.to_thread(score_candidate, text, self.run, self.timeout)
+
+    async def astream(self, prompt):
+        key, cached_chunks = self._cached(prompt)
+        if cached_chunks is not None:
+            self._count('cache_hits')
+            for chunk in cached_chunks:
+                yield chunk
+            return
+
+        self._count('fanouts')
+        self._count('candidates', self.candidates)
+        started = time.perf_counter()
+        pending = {asyncio.create_task(self._acandidate(index, prompt)) for index in range(self.candidates)}
+        finished, errors = [], []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        self._count('failed')
+                    else:
+                        finished.append(task.result())
+                if any(score['ok'] for _, _, score in finished):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            self._count('cancelled', len(pending))
+
+        if not finished:
+            raise errors[0]
+        winner = self._pick(finished)
+        self._store(key, winner, started)
+        yield winner
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats, winner_index = dict(self.stats['winner_index']))
+
+
+def fanout_from_env():
+    '''
+        MAKE_BEST_FANOUT = stage=candidates pairs, e.g. "model3=3" or "model2=2,model3=3"
+        MAKE_BEST_FANOUT_RUN = 1 also runs every candidate in the sandbox to score it
+    '''
+    run = os.getenv('MAKE_BEST_FANOUT_RUN', '0').strip() == '1'
+    spec = {}
+    for item in os.getenv('MAKE_BEST_FANOUT', '').split(','):
+        name, _, count = item.partition('=')
+        if name.strip() and count.strip().isdigit() and int(count) > 1:
+            spec[name.strip()] = {'candidates': int(count), 'run': run}
+    return spec
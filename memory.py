@@ -0,0 +1,96 @@
+import hashlib
+import re
+
+from tokens import estimate_tokens
+
+
+CODE_BLOCK_PATTERN = re.compile(r"```(\w*)[^\n]*\n(.*?)(?:\n```|$)", re.DOTALL)
+
+
+def digest_code(text):
+    '''
+        replaces every fenced code block with a one line digest (language, line count, hash)
+        json blocks are kept, for model1 they are its own earlier decisions
+    '''
+    def _digest(match):
+        code = match.group(2)
+        language = match.group(1) or 'code'
+        if language.lower() == 'json':
+            return match.group(0)
+        code_hash = hashlib.sha1(code.encode('utf-8')).hexdigest()[:10]
+        return f"[{language} block omitted : {code.count(chr(10)) + 1} lines, sha1 {code_hash}]"
+
+    return CODE_BLOCK_PATTERN.sub(_digest, text)
+
+
+class conversation_memory:
+    '''
+        bounded history for model1 : keeps the last max_turns user/model pairs, stores old
+        code blocks as digests, cuts single turns to max_turn_tokens and drops the oldest
+        pairs until the whole history fits in max_tokens. contents() is what gets sent
+
+        the latest pair goes out verbatim, code included, while it fits in max_latest_tokens
+        (and max_tokens) : a follow up like "now add type hints to that function" needs the
+        function itself, not its digest
+    '''
+
+    def __init__(self, max_turns = 6, max_tokens = 3000, max_turn_tokens = 800, max_latest_tokens = 2000):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.max_turn_tokens = max_turn_tokens
+        self.max_latest_tokens = max_latest_tokens
+        self.turns = []     # [user_text, model_text] pairs, oldest first
+        self._latest = None     # the last pair as it was said
+
+    def _compact(self, text):
+        text = digest_code(text)
+        max_chars = self.max_turn_tokens * 4
+        if len(text) > max_chars:
+            text = f'{text[:max_chars]} ...[truncated {len(text) - max_chars} chars]'
+        return text
+
+    def add(self, user_text, model_text):
+        self.turns.append([self._compact(user_text), self._compact(model_text)])
+        del self.turns[:-self.max_turns]
+        self._latest = [user_text, model_text]
+
+    def extend_last_reply(self, text):
+        '''
+            attaches extra context (e.g. the pipeline output) to the last model reply
+            without paying for another round trip
+        '''
+        if not self.turns:
+            return
+        self.turns[-1][1] = self._compact(f'{self.turns[-1][1]}\n\n{text}')
+        self._latest[1] = f'{self._latest[1]}\n\n{text}'
+
+    def _pairs(self):
+        '''
+            the pairs to send, newest first : the latest one verbatim when it fits
+        '''
+        pairs = list(reversed(self.turns))
+        if self._latest is not None:
+            cost = estimate_tokens(self._latest[0]) + estimate_tokens(self._latest[1])
+            if cost <= min(self.max_latest_tokens, self.max_tokens):
+                pairs[0] = self._latest
+        return pairs
+
+    def contents(self, user_prompt):
+        history = []
+        used = 0
+        for user_text, model_text in self._pairs():
+            cost = estimate_tokens(user_text) + estimate_tokens(model_text)
+            if used + cost > self.max_tokens:
+                break
+            used += cost
+            history[:0] = [
+                {'role': 'user', 'parts': [user_text]},
+                {'role': 'model', 'parts': [model_text]}
+            ]
+
+        history.append({'role': 'user', 'parts': [user_prompt]})
+        return history
+
+    def clear(self):
+        self.turns = []
+        self._latest = None
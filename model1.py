@@ -1,17 +1,26 @@
-import google.generativeai as genai 
-from dotenv import load_dotenv 
-import os 
-import json 
 import sys 
+import time 
+from contextlib import aclosing, closing 
+from backends import contents_text, default_backend 
+from cache import cache_key, default_cache 
+from cancel import check_cancelled, turn_cancelled 
+from memory import conversation_memory 
+from pipeline import default_pipeline, run_turn 
+from ratelimit import default_limiter 
+from router import route 
+from tiers import apply_tier 
+from tokens import estimate_tokens 
+from tracing import default_tracer 
+
 
 class make_best: 
+
+    backend = default_backend   # where the text comes from (backends.py), MAKE_BEST_BACKEND=fake runs offline 
     
     def __init__(self,env_path = '/workspaces/make_best/api_key.env', key_name = 'api_key'):  
         try: 
             
-            load_dotenv(dotenv_path= env_path) 
-            self.GOOGLE_API_KEY = os.getenv(key_name) 
-            genai.configure(api_key=self.GOOGLE_API_KEY)
+            self.GOOGLE_API_KEY = self.backend.configure(env_path, key_name) 
     
         except Exception as e : 
     
@@ -21,11 +30,9 @@ class make_best:
     
     def __call__(self): 
         
-        model1 = make_model1() 
-        model2 = make_model2()
-        model3 = make_model3() 
-        model4 = make_model4() 
-        model5 = make_model5() 
+        # the same turn as streamlit and batch.py : router, tiers, checkpoints (pipeline.run_turn) 
+        model1 = route(make_model1()) 
+        pipeline = default_pipeline()   # stages of the pipelines.json profile, MAKE_BEST_PIPELINE picks another one 
          
         while True: 
             user_prompt = input('you ;') 
@@ -33,41 +40,21 @@ class make_best:
                 break 
             
             try : 
-                model1_output = model1(user_prompt) 
-                model1_output = model1_output.split('```json\n',1)[1]
-                model1_output = model1_output.split('\n```',1)[0]
-                try : 
-                    
-                    model1_output_json = json.loads(model1_output)
-                    if model1_output_json.get('is_code_related',False): 
-                    
-                        if len(model1_output_json.get('prompt_for_model2',"").strip() ) < 2 : 
-                            print(f'model1 is not give input for next model \n outupt looklike \n {model1_output_json}')
-                            continue
-
-                        # print(f'gpt :- {model1_output_json.get('response_for_user')}')
-                        # print(f' gpt : -- {model2(model1_output_json.get('prompt_for_model2'))}') 
-                        
-                        model2_output = model2(model1_output_json.get('prompt_for_model2'))
-                        model3_output = model3(model2_output)
-                        model4_output = model4(model3_output)                 
-                        model5_output = model5(model4_output)
-                        model1(f' that is the code generated by model2 : {model5_output}')
-
-
-                    else : 
-                        if len(model1_output_json.get('response_for_user','').strip()) < 2 :
-                            print(f' model1 is give nothing for user_output json file is {model1_output_json}') 
-                        
-                        print(f'gpt :- {model1_output_json.get('response_for_user')}')
-                        continue
-                
-                except Exception as e : 
-                    raise RuntimeWarning(f'we are get error during model2 conversation look like this : {e}')
-                
-            
+                progress = _progress_printer(pipeline.stages[-1].name) 
+                result = run_turn(user_prompt, model1 = model1, pipeline = pipeline, on_event = progress) 
             except Exception as e : 
                 raise RuntimeWarning(f'we are get error during model2 conversation look like this : {e}')
+
+            if result['model1'] is None : 
+                print(f'model1 output is not valid json, nothing to do for : {user_prompt}') 
+                continue
+            if result['response_for_user'].strip() : 
+                print(f'gpt :- {result["response_for_user"]}') 
+            if result['final'] is not None : 
+                if not progress.streamed : 
+                    print(result['final'])     # cached / verified / skipped, nothing streamed 
+            elif result['model1'].get('is_code_related',False) : 
+                print(f'model1 is not give input for next model \n outupt looklike \n {result["model1"]}') 
                             
         '''
             here th while logic is appling and user interface how to hand users 
@@ -77,9 +64,141 @@ class make_best:
             work with class and that models and that shit     
         
         '''
-class make_model1(make_best): 
 
-    def __init__(self,max_output_tokens = 7500, model_name = 'gemini-1.5-flash-latest'): 
+
+class make_base_model(make_best): 
+    '''
+        the settings of a class go to its backend (backends.py) with every call, the gemini 
+        backend builds one shared GenerativeModel per distinct settings on first use 
+    '''
+
+    @property 
+    def settings(self): 
+        # the turn's tier (tiers.py) may swap the model and cap the output for this stage 
+        return apply_tier(self.stage_name, {
+            'model_name' : self.model_name, 
+            'generation_config' : self.generation_config, 
+            'safety_settings' : self.safety_settings, 
+            'system_instruction' : self.system_instruction 
+        })
+
+    limiter = default_limiter   # shared quota guard (ratelimit.py), None calls gemini directly 
+    tracer = default_tracer     # one span per call (tracing.py) 
+
+    @property 
+    def stage_name(self): 
+        return type(self).__name__.replace('make_', '', 1) 
+
+    def _span(self,contents,**attributes): 
+        return self.tracer.start_span(
+            self.stage_name, 
+            model = self.settings['model_name'], 
+            backend = self.backend.name, 
+            prompt_tokens = estimate_tokens(contents_text(contents)), 
+            **attributes 
+        )
+
+    def _generate(self,contents,span = None): 
+        if self.limiter is None: 
+            return self._open_stream(contents) 
+        on_retry = span.retry if span is not None else None 
+        return self.limiter.stream(lambda: self._open_stream(contents), estimate_tokens(contents_text(contents)), on_retry)
+
+    def _agenerate(self,contents,span = None): 
+        if self.limiter is None: 
+            return self._open_astream(contents) 
+        on_retry = span.retry if span is not None else None 
+        return self.limiter.astream(lambda: self._open_astream(contents), estimate_tokens(contents_text(contents)), on_retry)
+
+    def _open_stream(self,contents): 
+        return self.backend.stream(self.settings, contents) 
+
+    def _open_astream(self,contents): 
+        return self.backend.astream(self.settings, contents) 
+
+    async def acall(self,user_prompt): 
+        return ''.join([chunk async for chunk in self.astream(user_prompt)])
+
+
+class make_stage_model(make_base_model): 
+    '''
+        shared streaming logic of the pipeline stages (model2 .. model5) 
+        stream() yields every chunk the moment gemini sends it, __call__ just collects them 
+        astream() is the asyncio version of stream() 
+        finished streams go to the response cache, a hit is replayed chunk by chunk 
+        use_cache = False skips it both ways (e.g. fan-out candidates must be fresh samples) 
+        the turn's cancel token (cancel.py) is checked between chunks, a cancelled stream is 
+        closed right away so the request to gemini stops too 
+    '''
+
+    cache = default_cache   # set to None (on the class or an instance) to always call gemini 
+
+    def _cache_lookup(self,user_prompt): 
+        if self.cache is None: 
+            return None, None 
+        settings = self.settings 
+        key = cache_key(settings['model_name'], settings['generation_config'], self.system_instruction, user_prompt)
+        return key, self.cache.get(key) 
+
+    def stream(self,user_prompt,use_cache = True): 
+        check_cancelled() 
+        key, cached_chunks = self._cache_lookup(user_prompt) if use_cache else (None, None) 
+        with self._span(user_prompt, cache_hit = cached_chunks is not None) as span: 
+            if cached_chunks is not None: 
+                for chunk in cached_chunks: 
+                    check_cancelled() 
+                    span.chunk(chunk) 
+                    yield chunk 
+                return 
+
+            started = time.perf_counter() 
+            chunks = [] 
+            with closing(self._generate(user_prompt, span)) as source: 
+                for chunk in source: 
+                    check_cancelled() 
+                    chunks.append(chunk)
+                    span.chunk(chunk) 
+                    yield chunk 
+
+            if key is not None: 
+                self.cache.put(key, chunks, time.perf_counter() - started)
+
+    async def astream(self,user_prompt,use_cache = True): 
+        check_cancelled() 
+        key, cached_chunks = self._cache_lookup(user_prompt) if use_cache else (None, None) 
+        with self._span(user_prompt, cache_hit = cached_chunks is not None) as span: 
+            if cached_chunks is not None: 
+                for chunk in cached_chunks: 
+                    check_cancelled() 
+                    span.chunk(chunk) 
+                    yield chunk 
+                return 
+
+            started = time.perf_counter() 
+            chunks = [] 
+            async with aclosing(self._agenerate(user_prompt, span)) as source: 
+                async for chunk in source: 
+                    check_cancelled() 
+                    chunks.append(chunk)
+                    span.chunk(chunk) 
+                    yield chunk 
+
+            if key is not None: 
+                self.cache.put(key, chunks, time.perf_counter() - started)
+
+    def __call__(self,user_prompt): 
+        full_content = [] 
+        for chunk in self.stream(user_prompt): 
+            print(chunk, end = '')
+            full_content.append(chunk)
+            sys.stdout.flush() 
+
+        return ''.join(full_content)
+
+
+class make_model1(make_base_model): 
+
+    def __init__(self,max_output_tokens = 7500, model_name = 'gemini-1.5-flash-latest', memory = None): 
 
         super().__init__() 
         genai_parameters = {
@@ -109,13 +228,10 @@ class make_model1(make_best):
             }
         ] 
 
-        if self.GOOGLE_API_KEY : 
-            try : 
-                model = genai.GenerativeModel(
-                    model_name = model_name, 
-                    safety_settings= safety_settings, 
-                    generation_config = genai_parameters, 
-                    system_instruction =  '''
+        self.model_name = model_name 
+        self.generation_config = genai_parameters 
+        self.safety_settings = safety_settings 
+        self.system_instruction = '''
                     
                             "You are an intelligent gatekeeper and expert prompt engineer for a specialized AI coding assistant (Model 2). "
                             "Your primary function is to analyze user input and recent conversation history to determine if a request is code-related "
@@ -158,39 +274,70 @@ class make_model1(make_best):
 
                             "Ensure your entire output is ONLY the valid JSON object described. Do not add any text before or after the JSON."
                        ''' 
-                ) 
-                
-                self.chat_session = model.start_chat(history = []) 
 
-            except Exception as e :
-                raise RuntimeError('error found in initilizing model') 
-            
-    
-    def __call__(self,user_prompt): 
-    
+        # bounded, digested history instead of an ever growing chat session 
+        self.memory = memory if memory is not None else conversation_memory() 
+
+    def stream(self,user_prompt): 
+        '''
+            yields the gatekeeper reply chunk by chunk as gemini sends it 
+            only the windowed history from self.memory goes with the prompt 
+        '''
+        if not self.GOOGLE_API_KEY : 
+            raise RuntimeWarning(f'warrning api key is not configured, model1 can not be used ') 
+
+        reply = [] 
+        contents = self.memory.contents(user_prompt) 
         try:
-            if not self.chat_session : 
-                raise RuntimeWarning(f'warrning chat_sessions is not initilized ') 
+            check_cancelled() 
+            with self._span(contents, cache_hit = False) as span, closing(self._generate(contents, span)) as source: 
+                for chunk in source: 
+                    check_cancelled() 
+                    reply.append(chunk) 
+                    span.chunk(chunk) 
+                    yield chunk 
+
+        except turn_cancelled : 
+            raise 
+        except Exception as e : 
+            raise RuntimeError(f'error founded during response geting {e}') from e 
 
-            # chunck_session = self.model.generate_content(
-            #     contents = user_prompt, 
-            #     stream= True
-            # )
-            
-            # for chunck in chunck_session: 
-            #     if chunck.text:
-            #         print(chunck.text, end = '')
-            #         sys.stdout.flush() 
-            
-                    
-            response  =  self.chat_session.send_message(user_prompt)
-            return response.text 
-        
+        self.memory.add(user_prompt, ''.join(reply))
+
+    async def astream(self,user_prompt): 
+        if not self.GOOGLE_API_KEY : 
+            raise RuntimeWarning(f'warrning api key is not configured, model1 can not be used ') 
+
+        reply = [] 
+        contents = self.memory.contents(user_prompt) 
+        try:
+            check_cancelled() 
+            with self._span(contents, cache_hit = False) as span: 
+                async with aclosing(self._agenerate(contents, span)) as source: 
+                    async for chunk in source: 
+                        check_cancelled() 
+                        reply.append(chunk) 
+                        span.chunk(chunk) 
+                        yield chunk 
+
+        except turn_cancelled : 
+            raise 
         except Exception as e : 
-            raise RuntimeError(f'error founded during response geting {e}') 
+            raise RuntimeError(f'error founded during response geting {e}') from e 
+
+        self.memory.add(user_prompt, ''.join(reply))
+
+    def __call__(self,user_prompt): 
+        return ''.join(self.stream(user_prompt))
+
+    def remember(self,text): 
+        '''
+            adds text (e.g. the final pipeline output) to the context of the last turn, no api call 
+        '''
+        self.memory.extend_last_reply(text)
 
 
-class make_model2(make_best): 
+class make_model2(make_stage_model): 
 
     def __init__(self,max_output_tokens = 8120, model_name = 'gemini-1.5-flash-latest'): 
         super().__init__() 
@@ -222,13 +369,10 @@ class make_model2(make_best):
                         } 
         ] 
         
-        try :
-            self.MODEL = genai.GenerativeModel(
-                        model_name = model_name,
-                        safety_settings = safety_setting, 
-                        generation_config = generation_configure, 
-                        system_instruction = 
-                            '''
+        self.model_name = model_name 
+        self.generation_config = generation_configure 
+        self.safety_settings = safety_setting 
+        self.system_instruction = '''
                             **CORE DIRECTIVE: Elite AI Code Synthesis Engine**
 
                             **Mission Critical Objective:** Your SOLE function is to synthesize raw, executable, production-grade source code based on the precise specifications provided in the user prompt.
@@ -273,32 +417,11 @@ class make_model2(make_best):
                             **Performance Standard:** Your output will be judged on its direct usability, adherence to the STRUCTURED CODE OUTPUT format, and the extreme quality standards. Failure to include necessary setup instructions when external libraries are used, or including any extraneous text, is unacceptable. Synthesize with unparalleled precision.
 
                             ''' 
-            )  
-            self.chat_session = self.MODEL.start_chat(history = []) 
-        
-        except Exception as  e: 
-            raise RuntimeError('error is found during model initilization ') 
-        
-    def __call__(self,user_content):
-        
-        full_content = [] 
-        chunck_response = self.MODEL.generate_content(
-            contents = user_content, 
-            stream=True 
-        )
-        
-        for chunck in chunck_response: 
-            if chunck.text:
-                print(chunck.text, end = '')
-                full_content.append(chunck.text)
-                sys.stdout.flush()
-                 
-        full_content = ''.join(full_content)
+
         
-        return full_content
 
 
-class make_model4(make_best): 
+class make_model4(make_stage_model): 
 
     def __init__(self, max_output_tokens = 8120, model_name = 'gemini-1.5-flash-latest'): 
         super().__init__() 
@@ -333,12 +456,10 @@ class make_model4(make_best):
                     } 
             ]
         
-        try : 
-            self.model = genai.GenerativeModel(
-                    model_name = model_name, 
-                    safety_settings = safety_settings , 
-                    generation_config = generation_config, 
-                    system_instruction= '''
+        self.model_name = model_name 
+        self.generation_config = generation_config 
+        self.safety_settings = safety_settings 
+        self.system_instruction = '''
                     
                     **CORE DIRECTIVE: Grandmaster AI Code Physician & Refinement Specialist**
 
@@ -410,34 +531,15 @@ class make_model4(make_best):
 
                     **Performance Benchmark:** Your value is measured by the demonstrable quality and runnability of the **FINAL CERTIFIED SOURCE CODE (PART 2)**, the thoroughness and accuracy of your **CLINICAL DIAGNOSIS & TREATMENT REPORT (PART 1)**, and your unwavering adherence to library constraints and the output format. Providing code that violates constraints or is not fully remediated is a critical failure. You are the ultimate code surgeon.
 
-                    '''
-                    ) 
-            
-        except Exception as e : 
-             raise RuntimeError('error we are get during making mdoel look like {e} ') 
+                    ''' 
 
 
 
 
-    def __call__(self,user_prompt): 
-        
-        full_content = [] 
-        chunck_content = self.model.generate_content(
-                contents = user_prompt, 
-                stream = True 
-                ) 
-        
-        for chunck in chunck_content:
-            if chunck.text: 
-                print(chunck.text, end = '')
-                full_content.append(chunck.text) 
-                sys.stdout.flush() 
-        
-        full_content = ''.join(full_content)
-        return full_content
 
 
-class make_model3(make_best): 
+
+class make_model3(make_stage_model): 
     
     def __init__(self,max_output_tokens = 8120, model_name = 'gemini-1.5-flash-latest'): 
         super().__init__() 
@@ -468,12 +570,10 @@ class make_model3(make_best):
                 'threshold' : 'BLOCK_MEDIUM_AND_ABOVE'
             }
         ]
-        try : 
-            self.model = genai.GenerativeModel(
-                model_name = model_name , 
-                safety_settings = safety_setting, 
-                generation_config = generative_config, 
-                system_instruction = '''
+        self.model_name = model_name 
+        self.generation_config = generative_config 
+        self.safety_settings = safety_setting 
+        self.system_instruction = '''
                 
                     **CORE DIRECTIVE: Apex AI Code Synthesizer**
 
@@ -524,29 +624,12 @@ class make_model3(make_best):
 
                     **Performance Benchmark:** Your output's value is determined by its immediate fitness for use as raw source code in a production environment, its perfect adherence to the PRECISION-STRUCTURED RAW CODE output protocol, and its embodiment of the Uncompromising Excellence quality standards. Deviations, especially in output format or code quality, are critical failures. Synthesize with absolute precision.
                 
-                '''
-            )
-        except Exception as e : 
-            raise RuntimeWarning('error is found during model3 making look like this {e}')
+                ''' 
+
         
-    def __call__(self,user_prmpt):
-        full_content = [] 
-        if self.model: 
-            chunck_content = self.model.generate_content(
-                contents =user_prmpt, 
-                stream = True
-            )
-            
-            for chunck in chunck_content: 
-                if chunck.text: 
-                    print(chunck.text, end = '')
-                    full_content.append(chunck.text)
-                    sys.stdout.flush() 
-            
-        return full_content
                     
 
-class make_model5(make_best): 
+class make_model5(make_stage_model): 
     
     def __init__(self,max_output_tokens = 8120, model_name = 'gemini-1.5-flash-latest'): 
         super().__init__() 
@@ -577,12 +660,10 @@ class make_model5(make_best):
                 'threshold' : 'BLOCK_MEDIUM_AND_ABOVE'
             }
         ]
-        try : 
-            self.model = genai.GenerativeModel(
-                model_name = model_name , 
-                safety_settings = safety_setting, 
-                generation_config = generative_config, 
-                system_instruction = '''
+        self.model_name = model_name 
+        self.generation_config = generative_config 
+        self.safety_settings = safety_setting 
+        self.system_instruction = '''
                     **CORE DIRECTIVE: Autonomous AI Code Resilience & Perfection Engine**
 
                     **Unyielding Mission:** You are an advanced AI system designed for iterative, autonomous code debugging and refinement. Your sole objective is to take potentially broken or incomplete source code and, through a relentless cycle of analysis, targeted correction, and re-analysis, transform it into a **flawlessly runnable and functionally complete** version. You do not stop until your analysis indicates the code is free of execution-halting errors and robustly implements the implied or stated core functionality.
@@ -666,32 +747,42 @@ class make_model5(make_best):
                     *   **Be Tenacious but Bounded:** Strive for perfection but respect `MaxIterations`.
 
                     **Performance Standard:** Success is defined by your ability to systematically eliminate execution-halting errors and deliver runnable code that addresses the task goal. The clarity of your Iterative Refinement Log and the quality of the Final Perfected Source Code are paramount. An inability to make progress or getting stuck on simple errors is a failure.
-                '''
-            )
-        except Exception as e : 
-            raise RuntimeWarning('error is found during model3 making look like this {e}')
+                ''' 
+
         
-    def __call__(self,user_prmpt):
-        if self.model: 
-            chunck_content = self.model.generate_content(
-                contents =user_prmpt, 
-                stream = True
-            )
-            
-            for chunck in chunck_content: 
-                if chunck.text: 
-                    print(chunck.text, end = '')
-                    sys.stdout.flush() 
         
 
-model_ = make_best() 
-response = model_()
-
-
-
-
-
-
-
-
-
+class _progress_printer: 
+    '''
+        on_event of a console turn : the last stage's chunks are printed as they stream, the 
+        other stages get one line when they finish. streamed is True once the final output 
+        is on screen that way 
+    '''
+
+    def __init__(self,final_stage): 
+        self.final_stage = final_stage 
+        self.streamed = False 
+
+    def __call__(self,event): 
+        kind, name, data = event 
+        if name == self.final_stage and kind == 'chunk': 
+            print(data, end = '', flush = True) 
+        elif name == self.final_stage and kind == 'restart': 
+            print(f'\n[{name} restarted : {data}]') 
+        elif kind in ('done','skip','verified','cached'): 
+            if name == self.final_stage and kind == 'done': 
+                self.streamed = True 
+                print() 
+            print(f'[{name} : {kind}]') 
+
+
+def main(): 
+    '''
+        console entry point : python model1.py starts the interactive loop 
+    '''
+    model_ = make_best() 
+    model_() 
+
+
+if __name__ == '__main__': 
+    main() 
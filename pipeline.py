@@ -0,0 +1,846 @@
+import asyncio
+import contextvars
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from contextlib import closing
+
+from cancel import cancel_scope, cancel_token, current_token, turn_cancelled, turn_token
+from checkpoints import default_checkpoints, new_turn_id
+from fanout import fanout_from_env, fanout_model, score_candidate
+from refine import refine_from_env
+from sandbox import default_verifier
+from semantic_cache import default_semantic_cache
+from stream_parser import code_fence_handoff, first_code_block, parse_all, parse_model1_output
+from tiers import current_tier, default_tiers, tier_scope
+from tokens import default_counter, estimate_tokens, input_budget
+from tracing import default_tracer
+
+
+PIPELINES_PATH = os.getenv('MAKE_BEST_PIPELINES') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipelines.json')
+
+TEMPLATE_FIELD = re.compile(r'\{(input|code)\}')
+
+SKIP_CONDITIONS = ('verified', 'no_code')
+JOINS = ('concat', 'best_code')
+
+
+def input_for_refine(model4_output):
+    # refine_loop runs the code itself, it only needs model4's output to hold a code block
+    return model4_output if first_code_block(model4_output) is not None else None
+
+
+# events that end a stage
+FINISHED = ('done', 'skip', 'verified', 'cached')
+
+
+class pipeline_stage:
+    '''
+        one node of the graph
+        build_prompt(upstream_text) -> prompt for this stage, None means the stage is skipped
+        after : the stages whose output this one takes, ('input',) is the pipeline's prompt. with
+                several, the stage waits until all of them finished and join makes its input :
+                'concat' (each output in <name> tags) or 'best_code' (the output whose code passes
+                the most local checks, fanout.score_candidate)
+        handoff() -> tracker whose feed(chunk) returns the section downstream needs as soon as it
+                     is complete (None until then), handoff = None waits for the whole output
+        skip_when_verified : the pipeline's verifier may skip the stage when the upstream code
+                             already passes the local checks (sandbox.py)
+        input_budget : tokens of upstream text the stage takes before non code chatter is
+                       dropped (tokens.py), None for no limit
+        refinable : the refine loop (refine.py) takes the stage over when one is configured
+    '''
+
+    def __init__(self, name, model, build_prompt, label, handoff = code_fence_handoff, skip_when_verified = False, input_budget = None,
+                 after = ('input',), join = 'concat', refinable = False):
+        self.name = name
+        self.model = model
+        self.build_prompt = build_prompt
+        self.label = label
+        self.handoff = handoff
+        self.skip_when_verified = skip_when_verified
+        self.input_budget = input_budget
+        self.after = tuple(after)
+        self.join = join
+        self.refinable = refinable
+
+
+def template_prompt(template, needs_code = False):
+    '''
+        build_prompt of a template : {input} is the upstream text, {code} its first fenced code
+        block. the stage is skipped (None) when it needs code, or uses {code}, and there is none
+    '''
+    def _build(text):
+        code = first_code_block(text)
+        if code is None and (needs_code or '{code}' in template):
+            return None
+        values = {'input': text, 'code': code or ''}
+        return TEMPLATE_FIELD.sub(lambda match: values[match.group(1)], template)
+
+    return _build
+
+
+def load_profiles(path = None):
+    '''
+        the pipeline definitions, {'default': name, 'profiles': {name: {'description', 'stages'}}}
+        from PIPELINES_PATH (MAKE_BEST_PIPELINES, default pipelines.json next to this file),
+        YAML when the file ends in .yaml / .yml and pyyaml is installed
+    '''
+    path = path or PIPELINES_PATH
+    with open(path, encoding = 'utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError as e:
+                raise RuntimeError(f'{path} is YAML but pyyaml is not installed') from e
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def profile_stages(profile, models):
+    '''
+        the pipeline_stage list of one profile, models(class_name) -> model instance
+        stage keys : name, model, label, template, after, join, skip_when (verified / no_code),
+        input_budget, handoff, refine. ValueError for an invalid definition
+    '''
+    stages, names = [], set()
+    for spec in profile['stages']:
+        name = spec['name']
+        if name in names or name == 'input':
+            raise ValueError(f'stage name {name!r} is used twice or reserved')
+        after = tuple(spec.get('after') or ([stages[-1].name] if stages else ['input']))
+        undefined = [upstream for upstream in after if upstream != 'input' and upstream not in names]
+        if undefined:
+            raise ValueError(f'stage {name!r} runs after {undefined}, which are not defined before it')
+        skip_when = spec.get('skip_when', [])
+        join = spec.get('join', 'concat')
+        if set(skip_when) - set(SKIP_CONDITIONS) or join not in JOINS:
+            raise ValueError(f'stage {name!r} : skip_when takes {SKIP_CONDITIONS}, join takes {JOINS}')
+
+        model = models(spec['model'])
+        stages.append(pipeline_stage(
+            name, model, template_prompt(spec.get('template', '{input}'), 'no_code' in skip_when), spec.get('label', name),
+            handoff = code_fence_handoff if spec.get('handoff', True) else None,
+            skip_when_verified = 'verified' in skip_when,
+            input_budget = input_budget(model) if spec.get('input_budget') else None,
+            after = after, join = join, refinable = spec.get('refine', False)
+        ))
+        names.add(name)
+    return stages
+
+
+def model_factory(models = None):
+    '''
+        models(class_name) -> the instance given in models ({class_name: model}) or a new one of
+        that model1.py class, made once per factory
+    '''
+    import model1   # model1 itself imports this module
+    made = dict(models or {})
+
+    def _model(class_name):
+        if class_name not in made:
+            model_class = getattr(model1, class_name, None)
+            if not isinstance(model_class, type):
+                raise ValueError(f'unknown model class {class_name!r}')
+            made[class_name] = model_class()
+        return made[class_name]
+
+    return _model
+
+
+def default_stages(model2 = None, model3 = None, model4 = None, model5 = None):
+    # the 'full' profile with these models, a new model1.py instance for each one not given
+    models = {'make_model2': model2, 'make_model3': model3, 'make_model4': model4, 'make_model5': model5}
+    return profile_stages(load_profiles()['profiles']['full'],
+                          model_factory({name: model for name, model in models.items() if model is not None}))
+
+
+class make_pipeline:
+    '''
+        runs a stage graph : stages = profile_stages(...) of a profile in pipelines.json, by
+        default the 'full' M2 -> M3 -> M4 -> M5 chain with the given models (new ones for those
+        not given). a stage starts as soon as its upstream stages allow it, stages after the
+        same one run in parallel
+
+        with pipelined = True a stage hands its output downstream as soon as handoff()
+        finds a complete section (e.g. model3's code fence closed), the next stage starts
+        right away while the upstream one keeps streaming its tail. until that upstream stage
+        finishes the next one is speculative : it streams, but its handoff and its result are
+        held back. when the whole upstream output holds the same code as the section they are
+        released, when more code arrived (a second file after the first fence) the stage is
+        restarted on the whole output. with pipelined = False (and always for a stage after
+        several others) it waits for the whole upstream output
+
+        with a verifier (sandbox.code_verifier) the stages marked skip_when_verified are not
+        called when the upstream code already passes the local checks
+
+        with refine (refine.refine_loop) the refinable stage (model5) executes the code and
+        only asks model5 to fix real failures instead of one simulated iteration call
+
+        fanout = {stage_name: {'candidates': n, 'run': bool}} samples those stages n times in
+        parallel and keeps the best locally checked answer (fanout.py)
+
+        with a semantic_cache (semantic_cache.py) a near duplicate prompt replays the stored
+        stage outputs and the chain resumes after the last one stored, finished stage outputs
+        are stored for the next time
+
+        with checkpoints (checkpoints.checkpoint_store) and a turn_id every finished stage is
+        saved as it arrives, running the same turn_id again replays the saved stages and
+        continues after them, rerun_from = stage name runs that stage and the later ones again
+
+        stream() yields (kind, stage_name, data) events in arrival order :
+            'start'   data = prompt sent to the stage
+            'chunk'   data = text chunk
+            'handoff' data = section passed downstream before the stage finished
+            'restart' data = why : the stage's earlier start / chunks are void, it starts again
+            'done'    data = full output of the stage
+            'skip'    data = upstream text passed through unchanged (build_prompt gave None)
+            'verified' data = upstream code, fenced, that passed the checks (stage not called)
+            'cached'  data = output stored by the semantic cache or the turn's checkpoint
+
+        token (cancel.cancel_token, default the current one or a fresh one) cancels the run :
+        stages check it between chunks, no further stage starts and the consumer gets
+        turn_cancelled. a consumer that stops iterating early cancels it too
+    '''
+
+    poll_interval = 0.1     # how often a waiting consumer looks at the token
+
+    def __init__(self, model2 = None, model3 = None, model4 = None, model5 = None, pipelined = True, verifier = None, refine = None,
+                 counter = default_counter, fanout = None, semantic_cache = None, checkpoints = None, stages = None, profile = None):
+        self.stages = stages if stages is not None else default_stages(model2, model3, model4, model5)
+        self.profile = profile if stages is not None else 'full'
+        self.counter = counter
+        for stage in self.stages:
+            if refine is not None and stage.refinable:
+                stage.model, stage.build_prompt, stage.input_budget = refine, input_for_refine, None
+                stage.label = 'Running & Fixing Code (Model 5)'
+            if fanout and stage.name in fanout:
+                stage.model = fanout_model(stage.model, **fanout[stage.name])
+        self.pipelined = pipelined
+        self.verifier = verifier
+        self.semantic_cache = semantic_cache
+        self.checkpoints = checkpoints
+
+    def _resume(self, prompt, put, run, turn_id = None, rerun_from = None):
+        '''
+            puts a 'cached' event per leading stage stored in the turn's checkpoint or, without
+            one, for a near duplicate prompt, returns the replayed {stage: output}
+        '''
+        names = [stage.name for stage in self.stages]
+        if rerun_from is not None and rerun_from not in names:
+            raise ValueError(f'no stage {rerun_from!r} to rerun from, stages : {names}')
+        outputs = {}
+        if turn_id is not None and self.checkpoints is not None:
+            outputs = self.checkpoints.outputs(turn_id, names, rerun_from, self.profile, _tier_name())
+        if not outputs and rerun_from is None and self.semantic_cache is not None:
+            hit = self.semantic_cache.lookup(prompt, names, self.profile, _tier_name())
+            outputs = hit['outputs'] if hit is not None else {}
+
+        replayed = {}
+        for stage in self.stages:
+            if stage.name not in outputs:
+                break
+            replayed[stage.name] = outputs[stage.name]
+            run['started'].add(stage.name)
+            put(('cached', stage.name, outputs[stage.name]))
+        return replayed
+
+    def _checkpoint(self, turn_id, event):
+        kind, name, data = event
+        if turn_id is not None and self.checkpoints is not None and kind != 'cached':
+            self.checkpoints.save(turn_id, name, kind, data)
+
+    def _begin(self, turn_id, prompt, rerun_from = None):
+        if turn_id is not None and self.checkpoints is not None:
+            names = [stage.name for stage in self.stages]
+            rerun = names[names.index(rerun_from):] if rerun_from is not None else ()
+            self.checkpoints.begin(turn_id, prompt, self.profile, _tier_name(), rerun)
+
+    def _end(self, turn_id, prompt, outputs, kinds, status, error):
+        self._store(prompt, outputs, kinds)
+        if turn_id is not None and self.checkpoints is not None:
+            self.checkpoints.finish(turn_id, status, error)
+
+    def _store(self, prompt, outputs, kinds):
+        '''
+            stores the outputs of the leading finished stages, unless all of them came from the cache
+        '''
+        if self.semantic_cache is None:
+            return
+        stored = {}
+        for stage in self.stages:
+            if stage.name not in outputs:
+                break
+            stored[stage.name] = outputs[stage.name]
+        if stored and any(kinds[name] != 'cached' for name in stored):
+            self.semantic_cache.store(prompt, stored, self.profile, _tier_name())
+
+    def stream(self, prompt, token = None, turn_id = None, rerun_from = None):
+        token = token or current_token() or cancel_token()
+        events = queue.Queue()
+        run = self._new_run()
+        with cancel_scope(token):
+            # stage threads copy this context, the token goes with them
+            replayed = self._resume(prompt, events.put, run, turn_id, rerun_from)
+            self._begin(turn_id, prompt, rerun_from)
+            for name, text in [('input', prompt)] + list(replayed.items()):
+                self._available(run, name, text, True, events)
+
+        finished = 0
+        outputs, kinds = {}, {}
+        status, error = 'cancelled', None     # stays cancelled when the consumer stops early
+        try:
+            while finished < len(self.stages):
+                try:
+                    event = events.get(timeout = self.poll_interval)
+                except queue.Empty:
+                    token.check()
+                    continue
+                token.check()
+                kind, name, data = event
+                if kind == 'error':
+                    if isinstance(data, turn_cancelled):
+                        raise data
+                    raise RuntimeError(f'error during pipeline stage {name} : {data}') from data
+                if kind in FINISHED:
+                    finished += 1
+                    outputs[name], kinds[name] = data, kind
+                    self._checkpoint(turn_id, event)
+                yield event
+            status = 'done'
+        except turn_cancelled as e:
+            error = str(e)
+            raise
+        except Exception as e:
+            status, error = 'failed', str(e)
+            raise
+        finally:
+            if finished < len(self.stages):
+                token.cancel('pipeline consumer stopped')
+            self._end(turn_id, prompt, outputs, kinds, status, error)
+
+    def _verified(self, stage, upstream_text):
+        '''
+            the fenced upstream code when stage can be skipped, None when it has to run
+        '''
+        if self.verifier is None or not stage.skip_when_verified:
+            return None
+        code = self.verifier.verified_code(upstream_text)
+        if code is None:
+            return None
+        self.verifier.count_skip(stage.name)
+        return f'```python\n{code}\n```\n'
+
+    def _prompt(self, stage, upstream_text):
+        if self.counter is not None:
+            budget = stage.input_budget
+            if budget is not None:
+                budget = min(budget, input_budget(stage.model) or budget)     # smaller under a capped tier
+            upstream_text = self.counter.fit(upstream_text, budget, stage.model)
+        return stage.build_prompt(upstream_text)
+
+    def _new_run(self):
+        # per stream() state : text so far per stage, the finished ones, the started ones, the
+        # speculative ones ({stage: section it started from}) with their held back events and
+        # the generation of every restarted stage
+        return {'texts': {}, 'final': set(), 'started': set(), 'lock': threading.Lock(),
+                'speculative': {}, 'held': {}, 'generation': {}}
+
+    def _ready(self, run, name, text, final):
+        '''
+            records name's text, returns (stage, generation) of the stages that can start now
+            (each one only once), those started from a section are speculative
+        '''
+        ready = []
+        with run['lock']:
+            run['texts'][name] = text
+            if final:
+                run['final'].add(name)
+            for stage in self.stages:
+                if stage.name in run['started'] or name not in stage.after:
+                    continue
+                if len(stage.after) == 1 or all(upstream in run['final'] for upstream in stage.after):
+                    run['started'].add(stage.name)
+                    if not final:
+                        run['speculative'][stage.name] = text
+                    ready.append((stage, run['generation'].get(stage.name, 0)))
+        return ready
+
+    def _settle(self, run, name, output, put):
+        '''
+            name finished with output : its speculative downstream stages are confirmed, their
+            held events come back to be released, or restarted when output has more code than
+            the section they started from (_ready then starts them again)
+        '''
+        released = []
+        with run['lock']:
+            for stage in self.stages:
+                section = run['speculative'].get(stage.name)
+                if section is None or stage.after != (name,):
+                    continue
+                del run['speculative'][stage.name]
+                held = run['held'].pop(stage.name, [])
+                if _code_blocks(section) == _code_blocks(output):
+                    released += held
+                    continue
+                run['generation'][stage.name] = run['generation'].get(stage.name, 0) + 1
+                run['started'].discard(stage.name)
+                put(('restart', stage.name, f'{name} wrote more code after the section handed off'))
+        return released
+
+    def _live(self, run, name, generation, event, put):
+        '''
+            puts event unless the stage was restarted since this run of it started
+        '''
+        with run['lock']:
+            if run['generation'].get(name, 0) != generation:
+                return False
+            put(event)
+            return True
+
+    def _release(self, run, name, generation, event, final):
+        '''
+            True when event (a handoff or the stage's result) can go out now, a speculative
+            stage's is held back until its upstream finishes, a restarted one's is dropped
+        '''
+        with run['lock']:
+            if run['generation'].get(name, 0) != generation:
+                return False
+            if name in run['speculative']:
+                run['held'].setdefault(name, []).append((event, final))
+                return False
+            return True
+
+    def _input(self, stage, run):
+        texts = [run['texts'][name] for name in stage.after]
+        if len(texts) == 1:
+            return texts[0]
+        if stage.join == 'best_code':
+            return max(texts, key = lambda text: score_candidate(text)['score'])
+        return '\n\n'.join(f'<{name}>\n{text}\n</{name}>' for name, text in zip(stage.after, texts))
+
+    def _plan(self, stage, run):
+        '''
+            ('verified', fenced code) / ('skip', upstream text) / ('run', prompt) for a stage whose inputs are in
+        '''
+        upstream_text = self._input(stage, run)
+        verified = self._verified(stage, upstream_text)
+        if verified is not None:
+            return 'verified', verified
+        prompt = self._prompt(stage, upstream_text)
+        if prompt is None:
+            return 'skip', upstream_text
+        return 'run', prompt
+
+    def _available(self, run, name, text, final, events):
+        '''
+            name's text is in (a handed off section, or its whole output when final) : every
+            stage that was waiting for it is verified, skipped or started in its own thread.
+            a failure there (e.g. the verifier's subprocess) is that stage's error event, stream()
+            would wait for it forever otherwise
+        '''
+        if current_token() is not None and current_token().cancelled:
+            return
+        released = self._settle(run, name, text, events.put) if final else []
+        for stage, generation in self._ready(run, name, text, final):
+            try:
+                kind, data = self._plan(stage, run)
+                if kind != 'run':
+                    self._emit(run, stage.name, generation, (kind, stage.name, data), True, events)
+                    continue
+                # a copied context keeps the stage spans inside the caller's trace
+                context = contextvars.copy_context()
+                threading.Thread(target = context.run, args = (self._run_stage, stage, data, run, events, generation), daemon = True).start()
+            except Exception as e:
+                events.put(('error', stage.name, e))
+        for event, event_final in released:
+            events.put(event)
+            self._available(run, event[1], event[2], event_final, events)
+
+    def _emit(self, run, name, generation, event, final, events):
+        if self._release(run, name, generation, event, final):
+            events.put(event)
+            self._available(run, name, event[2], final, events)
+
+    def _tracker(self, stage):
+        return stage.handoff() if self.pipelined and stage.handoff is not None else None
+
+    def _run_stage(self, stage, prompt, run, events, generation = 0):
+        if not self._live(run, stage.name, generation, ('start', stage.name, prompt), events.put):
+            return
+
+        chunks = []
+        tracker = self._tracker(stage)
+        handed_off = False
+        try:
+            with closing(stage.model.stream(prompt)) as source:
+                for chunk in source:
+                    if not self._live(run, stage.name, generation, ('chunk', stage.name, chunk), events.put):
+                        return      # restarted on the whole upstream output
+                    chunks.append(chunk)
+
+                    section = tracker.feed(chunk) if tracker is not None and not handed_off else None
+                    if section is not None:
+                        handed_off = True
+                        self._emit(run, stage.name, generation, ('handoff', stage.name, section), False, events)
+
+        except Exception as e:
+            self._live(run, stage.name, generation, ('error', stage.name, e), events.put)
+            return
+
+        self._emit(run, stage.name, generation, ('done', stage.name, ''.join(chunks)), True, events)
+
+    async def astream(self, prompt, token = None, turn_id = None, rerun_from = None):
+        '''
+            asyncio version of stream() : stages are tasks instead of threads, same events
+        '''
+        token = token or current_token() or cancel_token()
+        events = asyncio.Queue()
+        tasks = []
+        run = self._new_run()
+        with cancel_scope(token):
+            # tasks copy this context, the token goes with them
+            replayed = self._resume(prompt, events.put_nowait, run, turn_id, rerun_from)
+            self._begin(turn_id, prompt, rerun_from)
+            for name, text in [('input', prompt)] + list(replayed.items()):
+                await self._aavailable(run, name, text, True, events, tasks)
+
+        finished = 0
+        outputs, kinds = {}, {}
+        status, error = 'cancelled', None     # stays cancelled when the consumer stops early
+        try:
+            while finished < len(self.stages):
+                try:
+                    event = await asyncio.wait_for(events.get(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    token.check()
+                    continue
+                token.check()
+                kind, name, data = event
+                if kind == 'error':
+                    if isinstance(data, turn_cancelled):
+                        raise data
+                    raise RuntimeError(f'error during pipeline stage {name} : {data}') from data
+                if kind in FINISHED:
+                    finished += 1
+                    outputs[name], kinds[name] = data, kind
+                    self._checkpoint(turn_id, event)
+                yield event
+            status = 'done'
+        except turn_cancelled as e:
+            error = str(e)
+            raise
+        except Exception as e:
+            status, error = 'failed', str(e)
+            raise
+        finally:
+            if finished < len(self.stages):
+                token.cancel('pipeline consumer stopped')
+            self._end(turn_id, prompt, outputs, kinds, status, error)
+            for task in tasks:
+                task.cancel()
+
+    async def _aavailable(self, run, name, text, final, events, tasks):
+        if current_token() is not None and current_token().cancelled:
+            return
+        released = self._settle(run, name, text, events.put_nowait) if final else []
+        for stage, generation in self._ready(run, name, text, final):
+            try:
+                # the checks may run a subprocess and an exact token count near the budget is a
+                # round trip, keep them off the event loop
+                kind, data = await asyncio.to_thread(self._plan, stage, run)
+                if kind != 'run':
+                    await self._aemit(run, stage.name, generation, (kind, stage.name, data), True, events, tasks)
+                    continue
+                tasks.append(asyncio.create_task(self._arun_stage(stage, data, run, events, tasks, generation)))
+            except Exception as e:
+                events.put_nowait(('error', stage.name, e))
+        for event, event_final in released:
+            events.put_nowait(event)
+            await self._aavailable(run, event[1], event[2], event_final, events, tasks)
+
+    async def _aemit(self, run, name, generation, event, final, events, tasks):
+        if self._release(run, name, generation, event, final):
+            events.put_nowait(event)
+            await self._aavailable(run, name, event[2], final, events, tasks)
+
+    async def _arun_stage(self, stage, prompt, run, events, tasks, generation = 0):
+        if not self._live(run, stage.name, generation, ('start', stage.name, prompt), events.put_nowait):
+            return
+
+        chunks = []
+        tracker = self._tracker(stage)
+        handed_off = False
+        source = stage.model.astream(prompt)
+        try:
+            async for chunk in source:
+                if not self._live(run, stage.name, generation, ('chunk', stage.name, chunk), events.put_nowait):
+                    return      # restarted on the whole upstream output
+                chunks.append(chunk)
+
+                section = tracker.feed(chunk) if tracker is not None and not handed_off else None
+                if section is not None:
+                    handed_off = True
+                    await self._aemit(run, stage.name, generation, ('handoff', stage.name, section), False, events, tasks)
+
+        except Exception as e:
+            self._live(run, stage.name, generation, ('error', stage.name, e), events.put_nowait)
+            return
+        finally:
+            await source.aclose()
+
+        await self._aemit(run, stage.name, generation, ('done', stage.name, ''.join(chunks)), True, events, tasks)
+
+    async def acall(self, prompt):
+        '''
+            runs the chain without printing and returns {stage_name: output}
+        '''
+        outputs = {}
+        async for kind, name, data in self.astream(prompt):
+            if kind in FINISHED:
+                outputs[name] = data
+        return outputs
+
+    def __call__(self, prompt):
+        '''
+            runs the chain printing every stage in order (overlapping stages are buffered)
+            and returns the output of the last stage
+        '''
+        order = [stage.name for stage in self.stages]
+        pending = {name: [] for name in order}
+        outputs = {}
+        current = 0
+
+        for kind, name, data in self.stream(prompt):
+            if kind == 'chunk':
+                pending[name].append(data)
+            elif kind == 'restart':
+                pending[name].clear()
+                if name == order[current]:
+                    print(f'\n[{name} restarted : {data}]\n', end = '')
+            elif kind in FINISHED:
+                outputs[name] = data
+
+            while current < len(order):
+                print(''.join(pending[order[current]]), end = '')
+                pending[order[current]].clear()
+                sys.stdout.flush()
+                if order[current] not in outputs:
+                    break
+                current += 1
+
+        return outputs[order[-1]]
+
+
+def default_pipeline(pipelined = True, profile = None, models = None, **options):
+    '''
+        the pipeline of one profile of pipelines.json : profile, else MAKE_BEST_PIPELINE, else
+        the file's default. verifier, refine loop, fanout, semantic cache and checkpoints come
+        from the environment unless given in options, models = {class_name: model} reuses
+        instances instead of making new ones
+    '''
+    definitions = load_profiles()
+    profile = profile or os.getenv('MAKE_BEST_PIPELINE') or definitions.get('default', 'full')
+    if profile not in definitions['profiles']:
+        raise ValueError(f"unknown pipeline profile {profile!r}, defined : {sorted(definitions['profiles'])}")
+
+    stages = profile_stages(definitions['profiles'][profile], model_factory(models))
+    if 'refine' not in options:
+        refinable = [stage.model for stage in stages if stage.refinable]
+        options['refine'] = refine_from_env(refinable[0]) if refinable else None
+    settings = dict(
+        verifier = default_verifier, fanout = fanout_from_env(), semantic_cache = default_semantic_cache,
+        checkpoints = default_checkpoints
+    )
+    settings.update(options)
+    return make_pipeline(pipelined = pipelined, stages = stages, profile = profile, **settings)
+
+
+def _new_result(decision, started, model1_done, trace_id = None, turn_id = None):
+    return {
+        'trace_id': trace_id,
+        'turn_id': turn_id,
+        'model1': decision,
+        'tier': None,
+        'response_for_user': (decision or {}).get('response_for_user', ''),
+        'outputs': {},
+        'final': None,
+        'timings': {'model1': model1_done - started, 'stages': {}, 'total': None},
+        'tokens': {'model1': None, 'stages': {}, 'total': 0}
+    }
+
+
+def _code_blocks(text):
+    return [(data['language'], data['code']) for kind, data in parse_all(text) if kind == 'code_close']
+
+
+def _tier_name():
+    tier = current_tier()
+    return tier['name'] if tier is not None else None
+
+
+def _choose_tier(result, trace, prompt, decision = None):
+    '''
+        the turn's tier (tiers.py), also on the result and the turn span, None without tiers
+    '''
+    if default_tiers is None:
+        return None
+    tier = default_tiers.choose(prompt, decision, trace.trace_id)
+    result['tier'] = tier['name']
+    trace.set(tier = tier['name'], complexity = round(tier['score'], 2))
+    return tier
+
+
+def _count_model1(result, prompt, reply):
+    result['tokens']['model1'] = {'prompt': estimate_tokens(prompt), 'response': estimate_tokens(reply)}
+    result['tokens']['total'] += estimate_tokens(prompt) + estimate_tokens(reply)
+
+
+def _prompt_for_pipeline(decision):
+    prompt_for_model2 = (decision or {}).get('prompt_for_model2', '') or ''
+    if decision and decision.get('is_code_related', False) and prompt_for_model2.strip():
+        return prompt_for_model2
+    return None
+
+
+def _record(result, event, started):
+    '''
+        keeps the outputs and, per stage, the seconds (since the turn started) of start / first chunk / done
+        and the estimated prompt / response tokens of the stages that ran
+    '''
+    kind, name, data = event
+    now = time.perf_counter() - started
+    timing = result['timings']['stages'].setdefault(name, {})
+    if kind == 'start':
+        timing['start'] = now
+        result['tokens']['stages'][name] = {'prompt': estimate_tokens(data), 'response': 0}
+        result['tokens']['total'] += estimate_tokens(data)
+    elif kind == 'chunk':
+        timing.setdefault('first_chunk', now)
+    elif kind == 'restart':
+        timing.pop('first_chunk', None)
+        timing['restarts'] = timing.get('restarts', 0) + 1
+    elif kind in FINISHED:
+        timing['done'] = now
+        result['outputs'][name] = data
+        if kind == 'done':
+            response_tokens = estimate_tokens(data)
+            result['tokens']['stages'][name]['response'] = response_tokens
+            result['tokens']['total'] += response_tokens
+        if kind == 'skip':
+            timing['skipped'] = True
+        elif kind == 'verified':
+            timing['verified'] = True
+        elif kind == 'cached':
+            timing['cached'] = True
+
+
+def run_turn(prompt, model1 = None, pipeline = None, token = None, turn_id = None, on_event = None):
+    '''
+        one whole turn, blocking : model1 decides, code requests go through the stage chain
+        token (cancel.cancel_token) stops it with turn_cancelled, by default MAKE_BEST_TURN_DEADLINE applies
+        turn_id keys the stage checkpoints (a new one by default), resume_turn() continues it
+        on_event(event) sees every pipeline event as it happens (e.g. progress in a console)
+        returns {'trace_id': str, 'turn_id': str, 'model1': decision or None, 'response_for_user': str,
+                 'outputs': {stage: text}, 'final': str or None, 'timings': {...}, 'tokens': {...}}
+    '''
+    if model1 is None:
+        from model1 import make_model1
+        from router import route
+        model1 = route(make_model1())
+
+    with default_tracer.trace('turn') as trace, cancel_scope(token or turn_token()):
+        started = time.perf_counter()
+        reply = model1(prompt)
+        decision = parse_model1_output(reply)
+        result = _new_result(decision, started, time.perf_counter(), trace.trace_id, turn_id or new_turn_id())
+        _count_model1(result, prompt, reply)
+
+        prompt_for_model2 = _prompt_for_pipeline(decision)
+        if prompt_for_model2 is not None:
+            pipeline = pipeline if pipeline is not None else default_pipeline()
+            with tier_scope(_choose_tier(result, trace, prompt, decision)):
+                for event in pipeline.stream(prompt_for_model2, turn_id = result['turn_id']):
+                    _record(result, event, started)
+                    if on_event is not None:
+                        on_event(event)
+            result['final'] = result['outputs'][pipeline.stages[-1].name]
+            model1.remember(f'that is the code generated by the pipeline : {result["final"]}')
+
+        result['timings']['total'] = time.perf_counter() - started
+    return result
+
+
+async def run_pipeline(prompt, model1 = None, pipeline = None, token = None, turn_id = None):
+    '''
+        run_turn() on the event loop, same result
+    '''
+    if model1 is None:
+        from model1 import make_model1
+        from router import route
+        model1 = route(make_model1())
+
+    with default_tracer.trace('turn') as trace, cancel_scope(token or turn_token()):
+        started = time.perf_counter()
+        reply = await model1.acall(prompt)
+        decision = parse_model1_output(reply)
+        result = _new_result(decision, started, time.perf_counter(), trace.trace_id, turn_id or new_turn_id())
+        _count_model1(result, prompt, reply)
+
+        prompt_for_model2 = _prompt_for_pipeline(decision)
+        if prompt_for_model2 is not None:
+            pipeline = pipeline if pipeline is not None else default_pipeline()
+            with tier_scope(_choose_tier(result, trace, prompt, decision)):
+                async for event in pipeline.astream(prompt_for_model2, turn_id = result['turn_id']):
+                    _record(result, event, started)
+            result['final'] = result['outputs'][pipeline.stages[-1].name]
+            model1.remember(f'that is the code generated by the pipeline : {result["final"]}')
+
+        result['timings']['total'] = time.perf_counter() - started
+    return result
+
+
+def resume_turn(turn_id, pipeline = None, rerun_from = None, token = None):
+    '''
+        runs the stage chain of a checkpointed turn again : the stages saved before rerun_from
+        (all saved ones by default) are replayed, the rest run, with the profile (by default)
+        and tier the turn started with. same result as run_turn(), without model1,
+        RuntimeError for an unknown turn_id
+    '''
+    checkpoints = pipeline.checkpoints if pipeline is not None else default_checkpoints
+    turn = checkpoints.turn(turn_id) if checkpoints is not None else None
+    if turn is None:
+        raise RuntimeError(f'no checkpoint for turn {turn_id}')
+    pipeline = pipeline if pipeline is not None else default_pipeline(profile = turn['profile'])
+
+    with default_tracer.trace('turn', resumed = True) as trace, cancel_scope(token or turn_token()):
+        started = time.perf_counter()
+        result = _new_result(None, started, started, trace.trace_id, turn_id)
+        tier = default_tiers.named(turn['tier']) if default_tiers is not None and turn['tier'] is not None else None
+        if tier is not None:
+            result['tier'] = tier['name']
+            trace.set(tier = tier['name'])
+        with tier_scope(tier):
+            for event in pipeline.stream(turn['prompt'], turn_id = turn_id, rerun_from = rerun_from):
+                _record(result, event, started)
+        result['final'] = result['outputs'][pipeline.stages[-1].name]
+        result['timings']['total'] = time.perf_counter() - started
+    return result
+
+
+async def run_pipelines(prompts, concurrency = 16):
+    '''
+        drives many independent turns on one event loop, at most concurrency at a time
+        results come back in the order of prompts (an exception object for a failed turn)
+    '''
+    limit = asyncio.Semaphore(concurrency)
+
+    async def _one(prompt):
+        async with limit:
+            return await run_pipeline(prompt)
+
+    return await asyncio.gather(*(_one(prompt) for prompt in prompts), return_exceptions = True)
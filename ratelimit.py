@@ -0,0 +1,257 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+from cancel import check_cancelled, turn_cancelled
+
+
+# waits are cut in slices this long, a cancelled turn stops waiting within one
+CHECK_INTERVAL = 0.1
+
+RETRYABLE_ERRORS = ('ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'DeadlineExceeded', 'InternalServerError')
+
+
+def is_retryable(error):
+    '''
+        quota (429) and transient server side errors, google.api_core names them, plain http codes as fallback
+    '''
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    message = str(error)
+    return any(code in message for code in ('429', '503', '504', 'Resource has been exhausted'))
+
+
+def backoff_delay(attempt, base = 1.0, cap = 30.0):
+    # "full jitter" exponential backoff, spreads retries of concurrent callers apart
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def wait(seconds):
+    '''
+        time.sleep() that raises turn_cancelled as soon as the current turn is cancelled
+    '''
+    until = time.monotonic() + seconds
+    while True:
+        check_cancelled()
+        left = until - time.monotonic()
+        if left <= 0:
+            return
+        time.sleep(min(CHECK_INTERVAL, left))
+
+
+async def wait_async(seconds):
+    until = time.monotonic() + seconds
+    while True:
+        check_cancelled()
+        left = until - time.monotonic()
+        if left <= 0:
+            return
+        await asyncio.sleep(min(CHECK_INTERVAL, left))
+
+
+class token_bucket:
+    '''
+        per_minute units refill continuously up to capacity
+        reserve() takes the units right away (the level may go negative) and returns how long
+        the caller has to wait for them, so waiting callers are served in order
+    '''
+
+    def __init__(self, per_minute, capacity = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._level = float(self.capacity)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self, amount = 1):
+        with self._lock:
+            self._refill()
+            self._level -= min(amount, self.capacity)
+            return max(0.0, -self._level / self.rate)
+
+    def acquire(self, amount = 1):
+        delay = self.reserve(amount)
+        if delay:
+            try:
+                wait(delay)
+            except turn_cancelled:
+                self.charge(-min(amount, self.capacity))     # not used, the next callers get them
+                raise
+
+    async def acquire_async(self, amount = 1):
+        delay = self.reserve(amount)
+        if delay:
+            try:
+                await wait_async(delay)
+            except turn_cancelled:
+                self.charge(-min(amount, self.capacity))
+                raise
+
+    def charge(self, amount):
+        '''
+            books units after the fact (e.g. output tokens), later callers wait for them
+        '''
+        with self._lock:
+            self._refill()
+            self._level -= amount
+
+
+class adaptive_concurrency:
+    '''
+        AIMD limit on calls in flight : +increase / limit per successful call (about +increase
+        per round of calls), limit * decrease on every throttled one
+    '''
+
+    def __init__(self, initial = 8, minimum = 1, maximum = 64, increase = 1.0, decrease = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def _has_room(self):
+        return self.in_flight < max(1, int(self.limit))
+
+    def acquire(self):
+        with self._condition:
+            while not self._has_room():
+                check_cancelled()
+                self._condition.wait(CHECK_INTERVAL)
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        while True:
+            check_cancelled()
+            with self._condition:
+                if self._has_room():
+                    self.in_flight += 1
+                    return
+            await asyncio.sleep(0.01)
+
+    def release(self, outcome):
+        '''
+            outcome : 'ok', 'throttled', or anything else (error, abandoned stream) to leave the limit alone
+        '''
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == 'throttled':
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            elif outcome == 'ok':
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+
+class rate_limiter:
+    '''
+        shared throttle for every gemini call : requests / min and tokens / min buckets, AIMD
+        concurrency, and retries with jittered backoff for retryable errors raised before
+        the first chunk (after that the caller already has part of the stream)
+    '''
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_retries = 4, concurrency = None):
+        self.requests = token_bucket(requests_per_minute)
+        self.tokens = token_bucket(tokens_per_minute)
+        self.concurrency = concurrency if concurrency is not None else adaptive_concurrency()
+        self.max_retries = max_retries
+        self.stats = {'calls': 0, 'retries': 0, 'throttled': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _give_up(self, outcome, yielded, attempt):
+        if outcome == 'throttled':
+            self._count('throttled')
+        if yielded or outcome != 'throttled' or attempt >= self.max_retries:
+            self._count('failed')
+            return True
+        self._count('retries')
+        return False
+
+    def stream(self, open_stream, prompt_tokens = 0, on_retry = None):
+        '''
+            open_stream() -> iterator of text chunks, called again on every retry
+            on_retry() is called before each retry (e.g. tracing.span.retry)
+        '''
+        attempt = 0
+        while True:
+            self._count('calls')
+            self.requests.acquire()
+            self.tokens.acquire(prompt_tokens)
+            self.concurrency.acquire()
+
+            outcome = 'abandoned'
+            output_chars = 0
+            try:
+                for chunk in open_stream():
+                    output_chars += len(chunk)
+                    yield chunk
+                outcome = 'ok'
+            except Exception as e:
+                outcome = 'throttled' if is_retryable(e) else 'error'
+                if self._give_up(outcome, output_chars > 0, attempt):
+                    raise
+            finally:
+                self.concurrency.release(outcome)
+                self.tokens.charge(output_chars // 4)
+
+            if outcome == 'ok':
+                return
+            attempt += 1
+            if on_retry is not None:
+                on_retry()
+            wait(backoff_delay(attempt))
+
+    async def astream(self, open_stream, prompt_tokens = 0, on_retry = None):
+        '''
+            same as stream() for open_stream() -> async iterator
+        '''
+        attempt = 0
+        while True:
+            self._count('calls')
+            await self.requests.acquire_async()
+            await self.tokens.acquire_async(prompt_tokens)
+            await self.concurrency.acquire_async()
+
+            outcome = 'abandoned'
+            output_chars = 0
+            try:
+                async for chunk in open_stream():
+                    output_chars += len(chunk)
+                    yield chunk
+                outcome = 'ok'
+            except Exception as e:
+                outcome = 'throttled' if is_retryable(e) else 'error'
+                if self._give_up(outcome, output_chars > 0, attempt):
+                    raise
+            finally:
+                self.concurrency.release(outcome)
+                self.tokens.charge(output_chars // 4)
+
+            if outcome == 'ok':
+                return
+            attempt += 1
+            if on_retry is not None:
+                on_retry()
+            await wait_async(backoff_delay(attempt))
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats, concurrency_limit = self.concurrency.limit, in_flight = self.concurrency.in_flight)
+
+
+# one limiter for all five models, set the quota of your key with MAKE_BEST_RPM / MAKE_BEST_TPM
+default_limiter = rate_limiter(
+    requests_per_minute = float(os.getenv('MAKE_BEST_RPM', '60')),
+    tokens_per_minute = float(os.getenv('MAKE_BEST_TPM', '1000000'))
+)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+import threading
+
+from sandbox import check_code, diagnostic
+from stream_parser import first_code_block
+
+
+def prompt_for_fix(code, failure, task_goal = None):
+    goal = task_goal or 'Fix exactly this failure, change nothing else.'
+    return (
+        f"<CodeToPerfect language='python'>\n```python\n{code}\n```\n</CodeToPerfect>\n"
+        f"<ExecutionResult>\n{failure}\n</ExecutionResult>\n"
+        f"<TaskGoal>{goal} The code was really executed, the result above is the actual output.</TaskGoal>\n"
+        f"<MaxIterations>1</MaxIterations>"
+    )
+
+
+class refine_loop:
+    '''
+        model5 backed by real runs instead of simulated iterations
+
+        the candidate (first code block of the upstream text) runs in the sandbox (sandbox.py),
+        on failure only the diagnostic (traceback tail) goes to model5 with the code, its fixed
+        code runs again, and so on up to max_iterations model calls. the first green run stops
+        the loop, so code that already works costs no model call at all
+
+        stream() / astream() take the upstream text like a pipeline stage model and yield one
+        model5 style answer : a ```json refinement log of the actual runs, then the final code
+    '''
+
+    def __init__(self, model, max_iterations = 5, timeout = 10.0, cpu_seconds = 10, memory_mb = 512):
+        self.model = model
+        self.max_iterations = max_iterations
+        self.limits = {'timeout': timeout, 'cpu_seconds': cpu_seconds, 'memory_mb': memory_mb}
+        self.stats = {'runs': 0, 'model_calls': 0, 'green_without_model': 0, 'fixed': 0, 'gave_up': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.stats[name] += amount
+
+    def _check(self, code):
+        self._count(runs = 1)
+        return check_code(code, run = True, **self.limits)
+
+    def _step(self, log, iteration, result):
+        log.append({
+            'iteration': iteration,
+            'step': result['step'],
+            'ok': result['ok'],
+            'problem_description': result['error'],
+            'seconds': round(result['seconds'], 3)
+        })
+
+    def _finish(self, code, log, result, model_calls):
+        if result['ok']:
+            status = 'SUCCESS: ran without error' + (f' after {model_calls} fixes' if model_calls else ', no fix needed')
+            self._count(green_without_model = int(model_calls == 0), fixed = int(model_calls > 0))
+        else:
+            status = f'PARTIAL_SUCCESS: still failing after {model_calls} fixes'
+            self._count(gave_up = 1)
+
+        report = {'iterative_refinement_log': {
+            'total_iterations_performed': model_calls,
+            'refinement_steps': log,
+            'final_status': status,
+            'remaining_known_issues_or_warnings': None if result['ok'] else diagnostic(result)
+        }}
+        return f'```json\n{json.dumps(report, indent = 2)}\n```\n```python\n{code}\n```\n'
+
+    def stream(self, upstream_text):
+        code = first_code_block(upstream_text) or upstream_text.strip()
+        log = []
+        result = self._check(code)
+        self._step(log, 0, result)
+
+        model_calls = 0
+        while not result['ok'] and model_calls < self.max_iterations:
+            model_calls += 1
+            self._count(model_calls = 1)
+            answer = ''.join(self.model.stream(prompt_for_fix(code, diagnostic(result))))
+            fixed = first_code_block(answer)
+            if fixed is None:
+                break
+            code = fixed
+            result = self._check(code)
+            self._step(log, model_calls, result)
+
+        yield self._finish(code, log, result, model_calls)
+
+    async def astream(self, upstream_text):
+        code = first_code_block(upstream_text) or upstream_text.strip()
+        log = []
+        # the checks block on a subprocess, keep them off the event loop
+        result = await asyncio.to_thread(self._check, code)
+        self._step(log, 0, result)
+
+        model_calls = 0
+        while not result['ok'] and model_calls < self.max_iterations:
+            model_calls += 1
+            self._count(model_calls = 1)
+            answer = ''.join([chunk async for chunk in self.model.astream(prompt_for_fix(code, diagnostic(result)))])
+            fixed = first_code_block(answer)
+            if fixed is None:
+                break
+            code = fixed
+            result = await asyncio.to_thread(self._check, code)
+            self._step(log, model_calls, result)
+
+        yield self._finish(code, log, result, model_calls)
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+def refine_from_env(model):
+    # MAKE_BEST_REFINE = max model5 fix calls (e.g. 5), unset or 0 keeps the single model5 call
+    max_iterations = int(os.getenv('MAKE_BEST_REFINE', '0') or 0)
+    if max_iterations <= 0:
+        return None
+    return refine_loop(model, max_iterations = max_iterations)
@@ -0,0 +1,81 @@
+import time
+
+from stream_parser import fence_parser
+
+
+class stream_renderer:
+    '''
+        incremental view of one text stream inside a streamlit placeholder (st.empty())
+
+        chunks go through the incremental fence parser, nothing is re-joined per chunk. a code
+        fence is drawn once with .code() (a json one with .json()) the moment it closes and is
+        never touched again, only the open tail (text since the last closed fence) is redrawn,
+        and at most once every min_interval seconds, so the cost of a whole stream stays linear
+        in its size
+    '''
+
+    def __init__(self, placeholder, min_interval = 0.08, cursor = ' ▌', clock = time.perf_counter):
+        self.placeholder = placeholder
+        self.container = placeholder.container()
+        self.min_interval = min_interval
+        self.cursor = cursor
+        self.clock = clock
+
+        self._tail_area = self.container.empty()
+        self._parser = fence_parser()
+        self._tail = []         # complete lines of the open tail (fence lines included)
+        self._fence_start = 0   # index in _tail of the open fence's first line
+        self._last_frame = None
+        self._dirty = False
+        self.frames = 0
+
+    def write(self, chunk):
+        for kind, data in self._parser.feed(chunk):
+            self._on_event(kind, data)
+
+        self._dirty = True
+        now = self.clock()
+        if self._last_frame is None or now - self._last_frame >= self.min_interval:
+            self._draw(self.cursor)
+            self._last_frame = now
+
+    def _on_event(self, kind, data):
+        if kind in ('text', 'code'):
+            self._tail.append(data)
+        elif kind == 'code_open':
+            self._fence_start = len(self._tail)
+            self._tail.append(f'```{data}\n')
+        elif kind in ('code_close', 'json', 'json_error'):
+            block = self._tail_area.container()
+            before = ''.join(self._tail[:self._fence_start])
+            if before.strip():
+                block.markdown(before)
+            if kind == 'code_close':
+                block.code(data['code'], language = data['language'] or None)
+            elif kind == 'json':
+                block.json(data)
+            else:
+                block.code(data['raw'], language = 'json')
+
+            self._tail_area = self.container.empty()
+            self._tail = []
+            self._fence_start = 0
+            self.frames += 1
+
+    def _draw(self, cursor = ''):
+        self._tail_area.markdown(''.join(self._tail) + self._parser.partial + cursor)
+        self._dirty = False
+        self.frames += 1
+
+    def finish(self):
+        '''
+            last frame without the cursor (the coalescing may have skipped the final chunks)
+        '''
+        for kind, data in self._parser.close():
+            if kind != 'code_close' or data['closed']:
+                self._on_event(kind, data)
+        if self._dirty or self._tail:
+            self._draw()
+
+    def clear(self):
+        self.placeholder.empty()
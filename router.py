@@ -0,0 +1,312 @@
+'''
+    local fast path in front of model1 : obvious turns are decided without a gemini round trip
+
+    two layers, both well under a millisecond per message :
+        rules        greetings / thanks / goodbyes are small talk, code fences, tracebacks and
+                     "write a function ..." style requests are code
+        classifier   tf-idf + logistic regression (scikit-learn, optional) trained on logged
+                     model1 decisions, trusted only above a confidence threshold
+
+    anything the router is unsure about goes to model1 as before. with MAKE_BEST_ROUTER :
+        off       no router (default)
+        on        confident decisions replace the model1 call
+        shadow    model1 always runs, the router only counts how often it would have agreed
+
+    MAKE_BEST_ROUTER_THRESHOLD     classifier confidence needed to skip model1 (default 0.9)
+    MAKE_BEST_ROUTER_LOG           JSONL that model1 decisions are appended to (training data)
+    MAKE_BEST_ROUTER_TRAIN         comma separated JSONL files to train on (default the log),
+                                   batch.py result files work too
+'''
+import json
+import os
+import re
+import threading
+import time
+
+from stream_parser import parse_model1_output
+
+
+SMALL_TALK = [
+    ('greeting', re.compile(r"(hi|hello|hey|hiya|yo|good (morning|afternoon|evening)|greetings)( there)?", re.I),
+     "Hi! How can I help you with a coding task today?"),
+    ('thanks', re.compile(r"(thanks|thank you|thx|ty|cheers)( (a lot|so much|very much))?", re.I),
+     "You're welcome! Is there anything else you'd like to build or fix?"),
+    ('goodbye', re.compile(r"(bye|goodbye|see you|see ya|good night)( later)?", re.I),
+     "Goodbye! Come back any time you need help with code."),
+    ('ack', re.compile(r"(ok|okay|cool|great|nice|awesome|perfect|got it)", re.I),
+     "Great. What would you like to work on next?"),
+]
+
+CODE_RULES = [
+    ('code_fence', re.compile(r"```")),
+    ('traceback', re.compile(r"Traceback \(most recent call last\)|\b\w+(Error|Exception): ")),
+    ('code_request', re.compile(
+        r"^\s*(please\s+)?(write|implement|create|build|generate|refactor|optimi[sz]e|fix|debug|convert|port)\b"
+        r".{0,60}\b(function|script|program|code|algorithm|endpoint|regex|sql query|module|method|"
+        r"unit tests?|cli|parser|decorator|dataclass)\b", re.I | re.S)),
+]
+
+CHAT_REPLY = "I specialize in coding tasks. Is there something code-related I can assist with?"
+CODE_REPLY = "Understood. Generating efficient code for you..."
+
+
+def _small_talk(text):
+    # the whole (short) message must be small talk, "hi, write me a parser" is not
+    stripped = text.strip().rstrip('!.?,:) ').lstrip('( ')
+    if len(stripped.split()) > 5:
+        return None
+    for name, pattern, reply in SMALL_TALK:
+        if pattern.fullmatch(stripped):
+            return name, reply
+    return None
+
+
+def prompt_for_model2(user_prompt, history = ()):
+    '''
+        the directive model1 writes for model2, filled from the request and the recent turns
+    '''
+    context = [f'User request : {user_prompt.strip()}']
+    for user_text, model_text in history:
+        context.append(f'Earlier, the user said : {user_text}')
+    return (
+        'You are an elite AI specializing in writing extremely efficient and comprehensive code. '
+        'Your ONLY output should be the requested code. Do NOT include explanations, apologies, or any text other than the code itself. '
+        'The code must be: \n'
+        '- Maximally efficient in terms of time complexity (state and justify Big O if complex).\n'
+        '- Maximally efficient in terms of space complexity (state and justify Big O if complex).\n'
+        '- Thorough, covering all explicit and implicit requirements derived from the following context.\n'
+        '- Robust, handling potential edge cases and invalid inputs gracefully.\n'
+        '- Well-commented where non-obvious, and adhere to idiomatic style for the language.\n'
+        'Based on this context: ' + '\n'.join(context)
+    )
+
+
+def load_decisions(paths):
+    '''
+        [(prompt, is_code_related)] from JSONL lines holding a prompt and a model1 decision
+        (the router log and batch.py results both do), unreadable lines are skipped
+    '''
+    examples = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                decision = record.get('model1') if isinstance(record, dict) else None
+                if isinstance(decision, dict) and isinstance(record.get('prompt'), str) \
+                        and isinstance(decision.get('is_code_related'), bool):
+                    examples.append((record['prompt'], decision['is_code_related']))
+    return examples
+
+
+class intent_router:
+    '''
+        decide(text) -> {'is_code_related': True / False / None (unsure), 'confidence', 'source'}
+    '''
+
+    def __init__(self, threshold = 0.9, min_examples = 20):
+        self.threshold = threshold
+        self.min_examples = min_examples
+        self.classifier = None
+        self.trained_on = 0
+
+    def train(self, examples):
+        '''
+            fits the classifier on [(prompt, is_code_related)], False (rules only) when
+            scikit-learn is missing or the examples are too few / all one class
+        '''
+        if len(examples) < self.min_examples or len({label for _, label in examples}) < 2:
+            return False
+        try:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.pipeline import make_pipeline
+        except ImportError:
+            return False
+
+        classifier = make_pipeline(
+            TfidfVectorizer(analyzer = 'char_wb', ngram_range = (2, 4), sublinear_tf = True, max_features = 50000),
+            LogisticRegression(max_iter = 1000, class_weight = 'balanced')
+        )
+        classifier.fit([text for text, _ in examples], [int(label) for _, label in examples])
+        self.classifier = classifier
+        self.trained_on = len(examples)
+        return True
+
+    def decide(self, text):
+        small_talk = _small_talk(text)
+        if small_talk is not None:
+            return {'is_code_related': False, 'confidence': 1.0, 'source': f'rule:{small_talk[0]}', 'reply': small_talk[1]}
+        for name, pattern in CODE_RULES:
+            if pattern.search(text):
+                return {'is_code_related': True, 'confidence': 1.0, 'source': f'rule:{name}', 'reply': CODE_REPLY}
+
+        if self.classifier is not None:
+            code_probability = float(self.classifier.predict_proba([text])[0][1])
+            confidence = max(code_probability, 1 - code_probability)
+            if confidence >= self.threshold:
+                is_code = code_probability >= 0.5
+                return {'is_code_related': is_code, 'confidence': confidence, 'source': 'classifier',
+                        'reply': CODE_REPLY if is_code else CHAT_REPLY}
+            return {'is_code_related': None, 'confidence': confidence, 'source': 'classifier', 'reply': None}
+        return {'is_code_related': None, 'confidence': 0.0, 'source': None, 'reply': None}
+
+
+class routed_model1:
+    '''
+        model1 behind an intent_router : same stream() / astream() / __call__ / remember(),
+        other attributes are read from the wrapped model. a routed turn still goes into
+        model1's memory, so later turns see it like any other
+    '''
+
+    def __init__(self, model, router, mode = 'on', log_path = None):
+        self.model = model
+        self.router = router
+        self.mode = mode
+        self.log_path = log_path
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _route(self, user_prompt):
+        started = time.perf_counter()
+        decision = self.router.decide(user_prompt)
+        _stats.observe(decision, time.perf_counter() - started)
+        if self.mode != 'on' or decision['is_code_related'] is None:
+            return decision, None
+
+        reply = {'is_code_related': decision['is_code_related'], 'response_for_user': decision['reply'], 'prompt_for_model2': ''}
+        if decision['is_code_related']:
+            reply['prompt_for_model2'] = prompt_for_model2(user_prompt, self.model.memory.turns[-3:])
+        text = json.dumps(reply, ensure_ascii = False)
+        self.model.memory.add(user_prompt, text)
+        _stats.bump('answered')
+        return decision, text
+
+    def _after_model1(self, user_prompt, decision, reply):
+        model1_decision = parse_model1_output(reply)
+        _stats.bump('model1_calls')
+        if not isinstance(model1_decision, dict) or not isinstance(model1_decision.get('is_code_related'), bool):
+            return
+        if decision['is_code_related'] is not None:
+            _stats.bump('agreed' if decision['is_code_related'] == model1_decision['is_code_related'] else 'disagreed')
+        if self.log_path:
+            line = json.dumps({'prompt': user_prompt, 'model1': model1_decision, 'at': time.time()}, ensure_ascii = False) + '\n'
+            with self._lock, open(self.log_path, 'a', encoding = 'utf-8') as f:
+                f.write(line)
+
+    def stream(self, user_prompt):
+        decision, text = self._route(user_prompt)
+        if text is not None:
+            yield text
+            return
+        reply = []
+        for chunk in self.model.stream(user_prompt):
+            reply.append(chunk)
+            yield chunk
+        self._after_model1(user_prompt, decision, ''.join(reply))
+
+    async def astream(self, user_prompt):
+        decision, text = self._route(user_prompt)
+        if text is not None:
+            yield text
+            return
+        reply = []
+        async for chunk in self.model.astream(user_prompt):
+            reply.append(chunk)
+            yield chunk
+        self._after_model1(user_prompt, decision, ''.join(reply))
+
+    def __call__(self, user_prompt):
+        return ''.join(self.stream(user_prompt))
+
+    async def acall(self, user_prompt):
+        return ''.join([chunk async for chunk in self.astream(user_prompt)])
+
+
+class router_stats:
+    '''
+        process wide counters : routed decisions per source, agreement with model1 (shadow
+        mode, or the unsure turns in on mode) and the time spent deciding
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {'decisions': 0, 'confident': 0, 'answered': 0, 'model1_calls': 0,
+                      'agreed': 0, 'disagreed': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'sources': {}}
+
+    def bump(self, name, amount = 1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def observe(self, decision, seconds):
+        with self._lock:
+            self.stats['decisions'] += 1
+            self.stats['seconds'] += seconds
+            self.stats['max_seconds'] = max(self.stats['max_seconds'], seconds)
+            if decision['is_code_related'] is not None:
+                self.stats['confident'] += 1
+                source = decision['source']
+                self.stats['sources'][source] = self.stats['sources'].get(source, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            compared = self.stats['agreed'] + self.stats['disagreed']
+            decisions = self.stats['decisions']
+            return dict(
+                self.stats, sources = dict(self.stats['sources']),
+                agreement = self.stats['agreed'] / compared if compared else None,
+                mean_seconds = self.stats['seconds'] / decisions if decisions else None
+            )
+
+
+_stats = router_stats()
+
+
+def router_summary():
+    return _stats.summary()
+
+
+def router_from_env():
+    '''
+        (router, mode, log path) from MAKE_BEST_ROUTER*, router None when it is off
+    '''
+    mode = os.getenv('MAKE_BEST_ROUTER', 'off').strip().lower()
+    if mode not in ('on', 'shadow'):
+        return None, 'off', None
+    log_path = os.getenv('MAKE_BEST_ROUTER_LOG') or None
+    router = intent_router(threshold = float(os.getenv('MAKE_BEST_ROUTER_THRESHOLD', '0.9')))
+    train_paths = [path.strip() for path in os.getenv('MAKE_BEST_ROUTER_TRAIN', log_path or '').split(',') if path.strip()]
+    router.train(load_decisions(train_paths))
+    return router, mode, log_path
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_router():
+    '''
+        (router, mode, log path) of MAKE_BEST_ROUTER*, built on first use : training imports
+        scikit-learn and fits the classifier, importing this module must not
+    '''
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = router_from_env()
+        return _default
+
+
+def route(model1):
+    '''
+        model1 behind the default router, or model1 itself when MAKE_BEST_ROUTER is off
+    '''
+    router, mode, log_path = default_router()
+    if router is None:
+        return model1
+    return routed_model1(model1, router, mode, log_path)
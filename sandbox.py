@@ -0,0 +1,272 @@
+import ast
+import builtins
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from stream_parser import parse_all
+
+try:
+    from pyflakes.api import check as pyflakes_check
+    from pyflakes.reporter import Reporter as pyflakes_reporter
+except ImportError:
+    pyflakes_check = None
+
+
+def check_code(code, run = False, timeout = 10.0, cpu_seconds = 10, memory_mb = 512):
+    '''
+        cheap local checks of python source, stops at the first failing step :
+            'parse'   ast.parse
+            'compile' byte-compile
+            'run'     (run = True) execute it in a fresh interpreter, see run_code()
+        returns {'ok', 'step', 'error', 'stdout', 'stderr', 'seconds'}
+    '''
+    started = time.perf_counter()
+    result = {'ok': False, 'step': 'parse', 'error': None, 'stdout': '', 'stderr': '', 'seconds': 0.0}
+
+    try:
+        tree = ast.parse(code)
+        result['step'] = 'compile'
+        compile(tree, '<candidate>', 'exec')
+    except (SyntaxError, ValueError) as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        if isinstance(e, SyntaxError) and e.text:
+            result['stderr'] = f'line {e.lineno}: {e.text.rstrip()}'
+        result['seconds'] = time.perf_counter() - started
+        return result
+
+    if run:
+        result['step'] = 'run'
+        result.update(run_code(code, timeout = timeout, cpu_seconds = cpu_seconds, memory_mb = memory_mb))
+    else:
+        result['ok'] = True
+
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def run_code(code, timeout = 10.0, cpu_seconds = 10, memory_mb = 512):
+    '''
+        runs code as a script in an isolated interpreter (-I) inside a scratch directory,
+        stdin closed, returns {'ok', 'error', 'stdout', 'stderr'}
+        timeout is wall clock seconds, cpu_seconds / memory_mb are hard rlimits of the child
+        (None for no limit)
+
+        the child gets a minimal environment (child_env()), never ours : load_dotenv puts the
+        api key in os.environ. it is not a jail, the code still has the network and every
+        file this user can read or write
+    '''
+    with tempfile.TemporaryDirectory(prefix = 'make_best_') as workdir:
+        path = os.path.join(workdir, 'candidate.py')
+        with open(path, 'w', encoding = 'utf-8') as f:
+            f.write(code)
+
+        try:
+            completed = subprocess.run(
+                [sys.executable, '-I', '-c', LIMITS_PRELUDE, str(cpu_seconds), str(memory_mb), path],
+                cwd = workdir,
+                env = child_env(),
+                stdin = subprocess.DEVNULL,
+                capture_output = True,
+                text = True,
+                timeout = timeout
+            )
+        except subprocess.TimeoutExpired as e:
+            return {
+                'ok': False,
+                'error': f'TimeoutExpired: no exit after {timeout}s',
+                'stdout': _text(e.stdout),
+                'stderr': _text(e.stderr).replace(path, 'candidate.py')
+            }
+
+    stderr = _prelude_frames(completed.stderr.replace(path, 'candidate.py'))
+    error = None
+    if completed.returncode != 0:
+        lines = stderr.strip().splitlines()
+        error = lines[-1] if lines else _signal_name(completed.returncode)
+    return {'ok': completed.returncode == 0, 'error': error, 'stdout': completed.stdout, 'stderr': stderr}
+
+
+def lint_warnings(code):
+    '''
+        static warnings of python source : pyflakes when it is installed, else a cheap scope
+        blind pass that only reports names read somewhere but bound nowhere (future NameErrors)
+    '''
+    if pyflakes_check is not None:
+        out = io.StringIO()
+        pyflakes_check(code, 'candidate.py', pyflakes_reporter(out, out))
+        return out.getvalue().splitlines()
+
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return []
+
+    bound, loaded = set(dir(builtins)) | {'__file__', '__name__', '__doc__'}, {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.setdefault(node.id, node.lineno)
+            else:
+                bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            bound.add(node.name)
+    return [f'candidate.py:{line}: undefined name {name!r}' for name, line in sorted(loaded.items(), key = lambda item: item[1]) if name not in bound]
+
+
+def child_env():
+    '''
+        PATH and nothing else (plus SYSTEMROOT on windows, python does not start without it)
+    '''
+    env = {'PATH': os.environ.get('PATH', os.defpath)}
+    if os.name == 'nt' and 'SYSTEMROOT' in os.environ:
+        env['SYSTEMROOT'] = os.environ['SYSTEMROOT']
+    return env
+
+
+# the child limits itself and then runs the candidate as __main__ : preexec_fn would be
+# simpler but is not safe with threads (stage, fan-out and streamlit threads call run_code)
+# argv : cpu_seconds memory_mb path, 'None' for no limit. resource is posix only, elsewhere
+# the child just runs without cpu / memory limits
+LIMITS_PRELUDE = '''
+import runpy, sys
+try:
+    import resource
+except ImportError:
+    resource = None
+cpu_seconds, memory_mb, path = sys.argv[1:4]
+if resource is not None and cpu_seconds != 'None':
+    resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_seconds), int(cpu_seconds) + 1))
+if resource is not None and memory_mb != 'None':
+    resource.setrlimit(resource.RLIMIT_AS, (int(memory_mb) * 1024 * 1024,) * 2)
+sys.argv = [path]
+runpy.run_path(path, run_name = '__main__')
+'''
+
+
+def _prelude_frames(stderr):
+    # the prelude and runpy frames on top of every traceback say nothing about the candidate
+    lines, skipping = [], False
+    for line in stderr.splitlines(keepends = True):
+        if line.startswith('  File ') and 'candidate.py' not in line and ('"<string>"' in line or 'runpy' in line):
+            skipping = True
+            continue
+        if skipping and line.startswith('    '):
+            continue    # the frame's source line
+        skipping = False
+        lines.append(line)
+    return ''.join(lines)
+
+
+def _signal_name(returncode):
+    # killed by an rlimit : SIGXCPU for cpu time, SIGKILL / SIGSEGV when out of memory
+    if returncode < 0:
+        return f'killed by signal {-returncode} (cpu or memory limit)'
+    return f'exit code {returncode}'
+
+
+def diagnostic(result, max_lines = 12):
+    '''
+        the part of a failed check worth showing a model : the tail of the traceback
+        (innermost frames + the exception) or the syntax error, never the whole output
+    '''
+    if result['ok']:
+        return ''
+    lines = result['stderr'].strip().splitlines()[-max_lines:]
+    if result['error'] and (not lines or lines[-1] != result['error']):
+        lines.append(result['error'])
+    return '\n'.join(lines)
+
+
+def _text(output):
+    # TimeoutExpired keeps what was captured as bytes even with text = True
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output or ''
+
+
+class code_verifier:
+    '''
+        local gate between pipeline stages : when the upstream code already passes check_code()
+        the pipeline skips the stages marked skip_when_verified (model4 / model5)
+        only python is checked, results are kept per code so one check serves both stages
+    '''
+
+    def __init__(self, run = False, timeout = 10.0, max_entries = 64, cpu_seconds = 10, memory_mb = 512):
+        self.run = run
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_entries = max_entries
+        self.stats = {'checks': 0, 'passed': 0, 'failed': 0, 'skipped': {}, 'seconds': 0.0}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def verified_code(self, upstream_text):
+        '''
+            the code of upstream_text when it passes the checks, None otherwise
+        '''
+        fenced = [data for kind, data in parse_all(upstream_text) if kind == 'code_close']
+        if fenced:
+            language, code = fenced[0]['language'], fenced[0]['code'].strip()
+            if language not in ('', 'python', 'py', 'python3'):
+                return None
+        else:
+            code = upstream_text.strip()
+        if not code:
+            return None
+
+        with self._lock:
+            if code in self._results:
+                self._results.move_to_end(code)
+                return code if self._results[code]['ok'] else None
+
+        result = check_code(code, run = self.run, timeout = self.timeout, cpu_seconds = self.cpu_seconds, memory_mb = self.memory_mb)
+        with self._lock:
+            self.stats['checks'] += 1
+            self.stats['passed' if result['ok'] else 'failed'] += 1
+            self.stats['seconds'] += result['seconds']
+            self._results[code] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last = False)
+        return code if result['ok'] else None
+
+    def count_skip(self, stage_name):
+        with self._lock:
+            self.stats['skipped'][stage_name] = self.stats['skipped'].get(stage_name, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            checks = self.stats['checks']
+            return dict(
+                self.stats,
+                skipped = dict(self.stats['skipped']),
+                mode = 'run' if self.run else 'static',
+                pass_rate = self.stats['passed'] / checks if checks else 0.0
+            )
+
+
+def _verifier_from_env():
+    # MAKE_BEST_EARLY_EXIT = static (parse + compile) or run (also execute it), unset = off
+    mode = os.getenv('MAKE_BEST_EARLY_EXIT', '').strip().lower()
+    if mode not in ('static', 'run'):
+        return None
+    return code_verifier(run = mode == 'run', timeout = float(os.getenv('MAKE_BEST_EARLY_EXIT_TIMEOUT', '10')))
+
+
+default_verifier = _verifier_from_env()
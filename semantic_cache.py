@@ -0,0 +1,319 @@
+'''
+    near duplicate cache in front of the M2 .. M5 chain : "write a fast LRU cache in python" and
+    "python LRU cache, fast please" should not pay for the whole pipeline twice
+
+    prompts are embedded locally (hashed word and character trigram features, numpy, no
+    network) into a fixed size matrix that is searched brute force by cosine similarity.
+    only the task part of prompt_for_model2 is embedded (what follows "Based on this context",
+    the rest is model1's fixed directive, a prompt without the marker is not cached : the
+    directive would make unrelated tasks look alike) and a hit also needs the same programming
+    languages mentioned, "... in python" never serves the javascript answer. the word order
+    only counts around "to" / "into" : "celsius to fahrenheit" is not "fahrenheit to celsius",
+    while "python LRU cache, fast please" still finds "write a fast LRU cache in python".
+    entries are kept per pipeline profile and model tier, a fast profile or a small tier
+    never serves what the full chain made and the other way around
+
+    an entry keeps the outputs of the stages that finished, in order : a hit with the last
+    stage serves the stored final output, a hit on a turn that stopped half way resumes the
+    pipeline after its last stored stage (make_pipeline(semantic_cache = ...))
+
+        MAKE_BEST_SEMANTIC_CACHE        1 turns it on
+        MAKE_BEST_SEMANTIC_THRESHOLD    cosine similarity needed for a hit (default 0.9)
+        MAKE_BEST_SEMANTIC_MAX          entries kept, least recently used evicted (default 1000)
+        MAKE_BEST_SEMANTIC_PATH         .npz file the index is loaded from and saved to
+'''
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+from stream_parser import TASK_MARKER, task_text
+
+
+DIMENSIONS = 2048
+
+WORD = re.compile(r'[a-z0-9_+#]+')
+
+# request phrasing that says nothing about the task itself
+STOPWORDS = frozenset('''
+    a an the and or of to in on for with by from as at is are be it its this that these those
+    please can could would you me i my we our your some any just also so very then than
+    write create make implement implementation give need want show help build generate using use via
+'''.split())
+
+LANGUAGES = frozenset('''
+    python javascript js typescript ts java c c++ cpp c# csharp go golang rust ruby php kotlin
+    swift scala sql bash shell powershell haskell lua perl dart julia matlab
+'''.split())
+
+# "a function to sort ...", the "to" after these words is not a direction
+PURPOSE_WORDS = frozenset('''
+    function method class module script program code snippet tool app api endpoint algorithm
+    regex query command loop way how
+'''.split())
+
+TRIGRAM_WEIGHT = 0.3
+
+DIRECTION_WEIGHT = 2.0
+
+# stored with the index, vectors of another embedding are not loaded
+EMBEDDING_VERSION = 3
+
+
+def _words(text):
+    words = []
+    for word in WORD.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]    # caches -> cache, cheap and good enough here
+        words.append(word)
+    return words
+
+
+def _directions(text):
+    '''
+        'x -> y' for every "x to y" / "x into y" between two content words
+    '''
+    tokens = WORD.findall(text.lower())
+    return [f'{tokens[i - 1]} -> {tokens[i + 1]}' for i in range(1, len(tokens) - 1)
+            if tokens[i] in ('to', 'into') and tokens[i - 1] not in STOPWORDS and tokens[i - 1] not in PURPOSE_WORDS
+            and tokens[i + 1] not in STOPWORDS]
+
+
+def languages(text):
+    return frozenset(word for word in WORD.findall(text.lower()) if word in LANGUAGES)
+
+
+def embed(text, dimensions = DIMENSIONS):
+    '''
+        L2 normalized float32 vector of the hashed words (weight 1), their character
+        trigrams (TRIGRAM_WEIGHT, tolerates typos and inflections) and the directions of
+        "x to y" (DIRECTION_WEIGHT), signed hashing. other word order does not count
+    '''
+    import numpy as np     # only once a cache exists, importing pipeline does not pay for it
+    vector = np.zeros(dimensions, dtype = np.float32)
+    features = []
+    for word in _words(text):
+        features.append((word, 1.0))
+        padded = f'<{word}>'
+        features += [(padded[i:i + 3], TRIGRAM_WEIGHT) for i in range(len(padded) - 2)]
+    features += [(direction, DIRECTION_WEIGHT) for direction in _directions(text)]
+    for feature, weight in features:
+        hashed = zlib.crc32(feature.encode('utf-8'))
+        vector[hashed % dimensions] += weight if hashed & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class semantic_cache:
+    '''
+        lookup(prompt, stages, profile, tier) -> {'similarity', 'outputs': {stage: text}} or None
+        store(prompt, outputs, profile, tier) keeps the finished stage outputs of a run, only a
+        lookup with the same profile and tier finds them
+
+        bounded by max_entries (the matrix is allocated once) and max_bytes of stored
+        outputs, least recently used first out, entries older than ttl are not served
+    '''
+
+    def __init__(self, threshold = 0.9, max_entries = 1000, max_bytes = 64 * 1024 * 1024, ttl = 24 * 3600,
+                 dimensions = DIMENSIONS, path = None, save_interval = 5.0):
+        import numpy as np
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.dimensions = dimensions
+        self.path = path
+        self.save_interval = save_interval
+
+        self._vectors = np.zeros((max_entries, dimensions), dtype = np.float32)
+        self._entries = [None] * max_entries    # slot -> {'task', 'languages', 'profile', 'tier', 'outputs', 'stored_at', 'used_at', 'size'}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0.0
+        self.stats = {'lookups': 0, 'hits': 0, 'resumed': 0, 'misses': 0, 'unmarked': 0, 'stores': 0, 'updates': 0,
+                      'evictions': 0, 'saved_stages': 0}
+
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def _live(self):
+        return [slot for slot, entry in enumerate(self._entries) if entry is not None]
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry['stored_at'] > self.ttl
+
+    def _best(self, vector, task_languages, profile, tier):
+        '''
+            (similarity, slot) of the closest live entry with the same languages, profile and
+            tier, (0.0, None) if none
+        '''
+        import numpy as np
+        slots = self._live()
+        if not slots:
+            return 0.0, None
+        similarities = self._vectors[slots] @ vector
+        for position in np.argsort(similarities)[::-1]:
+            slot = slots[position]
+            entry = self._entries[slot]
+            if (entry['languages'], entry['profile'], entry['tier']) == (task_languages, profile, tier):
+                return float(similarities[position]), slot
+        return 0.0, None
+
+    def lookup(self, prompt, stages = None, profile = None, tier = None):
+        '''
+            stages : stage names in pipeline order, the hit counts as served when the last
+            one is stored and as resumed otherwise. profile and tier (names) the run uses.
+            None for a prompt without the task marker
+        '''
+        if not TASK_MARKER.search(prompt):
+            with self._lock:
+                self.stats['unmarked'] += 1
+            return None
+        task = task_text(prompt)
+        vector = embed(task, self.dimensions)
+        with self._lock:
+            self.stats['lookups'] += 1
+            similarity, slot = self._best(vector, languages(task), profile, tier)
+            entry = self._entries[slot] if slot is not None else None
+            if entry is not None and self._expired(entry):
+                self._drop(slot)
+                entry = None
+            if entry is None or similarity < self.threshold:
+                self.stats['misses'] += 1
+                return None
+
+            entry['used_at'] = time.time()
+            outputs = dict(entry['outputs'])
+            served = stages is None or stages[-1] in outputs
+            self.stats['hits' if served else 'resumed'] += 1
+            self.stats['saved_stages'] += len(outputs)
+            return {'similarity': similarity, 'outputs': outputs, 'task': entry['task']}
+
+    def store(self, prompt, outputs, profile = None, tier = None):
+        if not outputs or not TASK_MARKER.search(prompt):
+            return
+        task = task_text(prompt)
+        vector = embed(task, self.dimensions)
+        task_languages = languages(task)
+        size = sum(len(text) for text in outputs.values())
+        now = time.time()
+        with self._lock:
+            similarity, slot = self._best(vector, task_languages, profile, tier)
+            if slot is not None and similarity >= 0.99:
+                # the same task again (e.g. resumed), keep the entry with more stages
+                self.stats['updates'] += 1
+                if len(outputs) < len(self._entries[slot]['outputs']):
+                    return
+                self._drop(slot)
+            else:
+                self.stats['stores'] += 1
+                slot = self._free_slot()
+
+            self._vectors[slot] = vector
+            self._entries[slot] = {'task': task, 'languages': task_languages, 'profile': profile, 'tier': tier, 'outputs': dict(outputs),
+                                   'stored_at': now, 'used_at': now, 'size': size}
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._live()) > 1:
+                self._evict(keep = slot)
+            self._dirty = True
+            due = now - self._saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def _free_slot(self):
+        for slot, entry in enumerate(self._entries):
+            if entry is None:
+                return slot
+        return self._evict()
+
+    def _evict(self, keep = None):
+        slot = min((slot for slot in self._live() if slot != keep), key = lambda slot: self._entries[slot]['used_at'])
+        self._drop(slot)
+        self.stats['evictions'] += 1
+        return slot
+
+    def _drop(self, slot):
+        self._bytes -= self._entries[slot]['size']
+        self._entries[slot] = None
+        self._vectors[slot] = 0.0
+
+    def save(self):
+        '''
+            writes the live entries to self.path (float16 vectors + json metadata), atomically
+        '''
+        if not self.path:
+            return
+        import numpy as np
+        with self._lock:
+            if not self._dirty:
+                return
+            slots = self._live()
+            vectors = self._vectors[slots].astype(np.float16)
+            metadata = json.dumps([dict(self._entries[slot], languages = sorted(self._entries[slot]['languages'])) for slot in slots])
+            self._dirty = False
+            self._saved_at = time.time()
+
+        temporary = f'{self.path}.tmp.npz'
+        np.savez_compressed(temporary, vectors = vectors, metadata = np.array(metadata), version = np.array(EMBEDDING_VERSION))
+        os.replace(temporary, self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        import numpy as np
+        try:
+            with np.load(self.path) as data:
+                version = int(data['version']) if 'version' in data else 1
+                vectors = data['vectors'].astype(np.float32)
+                entries = json.loads(str(data['metadata']))
+        except (OSError, ValueError, KeyError) as e:
+            print(f'semantic cache not loaded from {self.path} : {e}')
+            return
+        if version != EMBEDDING_VERSION or vectors.shape[1:] != (self.dimensions,):
+            return      # another embedding or other dimensions, start empty
+
+        # most recently used last, so the oldest are the ones that do not fit
+        order = sorted(range(len(entries)), key = lambda index: entries[index]['used_at'])[-self.max_entries:]
+        for slot, index in enumerate(order):
+            entry = entries[index]
+            entry['languages'] = frozenset(entry['languages'])
+            self._vectors[slot] = vectors[index]
+            self._entries[slot] = entry
+            self._bytes += entry['size']
+
+    def clear(self):
+        with self._lock:
+            self._entries = [None] * self.max_entries
+            self._vectors[:] = 0.0
+            self._bytes = 0
+            self._dirty = True
+
+    def summary(self):
+        with self._lock:
+            lookups = self.stats['lookups']
+            return dict(
+                self.stats,
+                entries = len(self._live()),
+                bytes = self._bytes,
+                hit_rate = (self.stats['hits'] + self.stats['resumed']) / lookups if lookups else 0.0
+            )
+
+
+def semantic_cache_from_env():
+    if os.getenv('MAKE_BEST_SEMANTIC_CACHE', '0').strip() != '1':
+        return None
+    return semantic_cache(
+        threshold = float(os.getenv('MAKE_BEST_SEMANTIC_THRESHOLD', '0.9')),
+        max_entries = int(os.getenv('MAKE_BEST_SEMANTIC_MAX', '1000')),
+        path = os.getenv('MAKE_BEST_SEMANTIC_PATH') or None
+    )
+
+
+default_semantic_cache = semantic_cache_from_env()
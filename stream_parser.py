@@ -0,0 +1,139 @@
+import json
+import re
+
+
+# model1's prompt_for_model2 is its fixed directive, then the request itself after this marker
+TASK_MARKER = re.compile(r'based on this context\s*:?', re.I)
+
+
+class fence_parser:
+    '''
+        single pass, incremental parser for the ```fenced``` output of the models
+
+        feed(chunk) consumes text as it streams and returns the events it completed :
+            ('text', line)          a line outside any fence (newline included)
+            ('code_open', language) a fence opened ('' when it has no language)
+            ('code', line)          a line inside a fence
+            ('code_close', {'language', 'code', 'end', 'closed'})
+                                    a fence closed, end = offset just after its closing line
+            ('json', obj)           a ```json fence closed and parsed
+            ('json_error', {'raw', 'error'})
+        only complete lines are parsed, so every character is looked at a constant number of times
+        close() flushes the last partial line and an unterminated fence (closed = False)
+    '''
+
+    def __init__(self):
+        self.partial = ''       # current incomplete line
+        self.offset = 0         # characters consumed as complete lines
+        self._fence = None      # language of the open fence
+        self._code = []
+
+    @property
+    def in_fence(self):
+        return self._fence is not None
+
+    def feed(self, chunk):
+        events = []
+        if '\n' not in chunk:
+            self.partial += chunk
+            return events
+
+        pieces = chunk.split('\n')
+        pieces[0] = self.partial + pieces[0]
+        for line in pieces[:-1]:
+            self.offset += len(line) + 1
+            self._line(line, '\n', events)
+        self.partial = pieces[-1]
+        return events
+
+    def close(self):
+        events = []
+        if self.partial:
+            line, self.partial = self.partial, ''
+            self.offset += len(line)
+            self._line(line, '', events)
+        if self._fence is not None:
+            self._close(events, closed = False)
+        return events
+
+    def _line(self, line, newline, events):
+        stripped = line.strip()
+        if self._fence is None:
+            if stripped.startswith('```'):
+                self._fence = stripped[3:].strip().lower()
+                self._code = []
+                events.append(('code_open', self._fence))
+            else:
+                events.append(('text', line + newline))
+        elif stripped == '```':
+            self._close(events, closed = True)
+        else:
+            self._code.append(line)
+            events.append(('code', line + newline))
+
+    def _close(self, events, closed):
+        language, code = self._fence, '\n'.join(self._code)
+        self._fence = None
+        self._code = []
+
+        if language == 'json':
+            try:
+                events.append(('json', json.loads(code)))
+            except json.JSONDecodeError as e:
+                events.append(('json_error', {'raw': code, 'error': str(e)}))
+        else:
+            events.append(('code_close', {'language': language, 'code': code, 'end': self.offset, 'closed': closed}))
+
+
+def parse_all(text):
+    '''
+        every event of a finished text, in order
+    '''
+    parser = fence_parser()
+    return parser.feed(text) + parser.close()
+
+
+def first_code_block(text):
+    for kind, data in parse_all(text):
+        if kind == 'code_close':
+            return data['code'].strip()
+    return None
+
+
+def task_text(prompt):
+    '''
+        the request part of a model2 prompt, the whole prompt when it has no context marker
+    '''
+    parts = TASK_MARKER.split(prompt)
+    return parts[-1] if len(parts) > 1 and parts[-1].strip() else prompt
+
+
+def parse_model1_output(text):
+    '''
+        model1 answers with a ```json fenced object (sometimes bare json), None when it can not be parsed
+    '''
+    for kind, data in parse_all(text):
+        if kind == 'json':
+            return data
+    try:
+        return json.loads(text.strip())
+    except json.JSONDecodeError:
+        return None
+
+
+class code_fence_handoff:
+    '''
+        pipeline hand-off tracker : feed() returns the text up to the end of the first closed
+        non json code fence, None until then
+    '''
+
+    def __init__(self):
+        self.parser = fence_parser()
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        for kind, data in self.parser.feed(chunk):
+            if kind == 'code_close':
+                return ''.join(self.chunks)[:data['end']]
+        return None
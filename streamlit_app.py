@@ -1,6 +1,5 @@
 import streamlit as st
 import json
-import re
 import time
 # Import your model classes from your model1.py
 # Ensure model1.py is in the same directory or accessible via PYTHONPATH
@@ -13,6 +12,21 @@ from model1 import (
     # Add make_model_ml_optimizer if you have it defined in your model1.py
     # and model1 can route to it. For now, assuming the M1-M5 pipeline.
 )
+from pipeline import default_pipeline, load_profiles
+from backends import default_backend
+from cancel import cancel_scope, turn_cancelled, turn_token
+from checkpoints import default_checkpoints, new_turn_id
+from cache import default_cache
+from ratelimit import default_limiter
+from refine import refine_from_env
+from router import default_router, route, router_summary
+from sandbox import default_verifier
+from semantic_cache import default_semantic_cache
+from tiers import default_tiers, tier_scope
+from render import stream_renderer
+from stream_parser import parse_all, parse_model1_output
+from tokens import default_counter
+from tracing import default_metrics, default_tracer
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -63,28 +77,38 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Model Initialization ---
+@st.cache_resource
+def load_stage_models():
+    # model2..model5 hold no per-user state, so one set serves every browser session.
+    # Their Gemini objects are only built (once per process) on first use.
+    return make_model2(), make_model3(), make_model4(), make_model5()
+
+@st.cache_resource
+def load_refine_loop():
+    # real run-and-fix loop around model5 (refine.py), None unless MAKE_BEST_REFINE is set
+    return refine_from_env(load_stage_models()[3])
+
 if 'models_initialized_flag' not in st.session_state: st.session_state.models_initialized_flag = False
 if not st.session_state.models_initialized_flag:
-    with st.spinner("Initializing AI Cores... This might take a moment."):
-        try:
-            # These must match the class names in your model1.py
-            st.session_state.model1_instance = make_model1()
-            st.session_state.model2_instance = make_model2()
-            st.session_state.model3_instance = make_model3() # Your Apex Synthesizer
-            st.session_state.model4_instance = make_model4()
-            st.session_state.model5_instance = make_model5()
-            # If you add make_model_ml_optimizer to your model1.py, initialize it here too
-            # st.session_state.model_ml_optimizer_instance = make_model_ml_optimizer()
-            st.session_state.models_initialized_flag = True
-            print("INFO (Streamlit): All AI models initialized successfully.")
-        except RuntimeError as e:
-            st.error(f"Fatal Error during AI Model Initialization: {e}")
-            st.error("Ensure GOOGLE_API_KEY is in 'api_key.env' or set as environment variable.")
-            st.session_state.models_initialized_flag = False
-        except Exception as e:
-            st.error(f"An unexpected fatal error during AI Model Initialization: {e}")
-            import traceback; traceback.print_exc()
-            st.session_state.models_initialized_flag = False
+    try:
+        # model1 keeps this user's chat history, so it stays per session (it is cheap to create)
+        st.session_state.model1_instance = route(make_model1()) # local intent router in front, if MAKE_BEST_ROUTER is set
+        (st.session_state.model2_instance,
+         st.session_state.model3_instance, # Your Apex Synthesizer
+         st.session_state.model4_instance,
+         st.session_state.model5_instance) = load_stage_models()
+        # If you add make_model_ml_optimizer to your model1.py, initialize it here too
+        # st.session_state.model_ml_optimizer_instance = make_model_ml_optimizer()
+        st.session_state.models_initialized_flag = True
+        print("INFO (Streamlit): All AI models initialized successfully.")
+    except RuntimeError as e:
+        st.error(f"Fatal Error during AI Model Initialization: {e}")
+        st.error("Ensure GOOGLE_API_KEY is in 'api_key.env' or set as environment variable.")
+        st.session_state.models_initialized_flag = False
+    except Exception as e:
+        st.error(f"An unexpected fatal error during AI Model Initialization: {e}")
+        import traceback; traceback.print_exc()
+        st.session_state.models_initialized_flag = False
 
 # --- Helper Function to Parse and Display AI's Multi-Part Response ---
 def display_ai_parts_from_string(full_response_string, container_to_write_in, expected_model_output_style="unknown"):
@@ -99,23 +123,31 @@ def display_ai_parts_from_string(full_response_string, container_to_write_in, ex
     remaining_text = full_response_string.strip()
 
     if expected_model_output_style in ["model4_style", "model5_style"]: # Expect JSON report then MD code
-        json_match = re.search(r"```json\s*(\{.*?\})\s*```", remaining_text, re.DOTALL)
-        if json_match:
-            try:
-                json_data = json.loads(json_match.group(1))
-                displayed_parts_for_history.append({"type": "json", "data": json_data})
-                container_to_write_in.json(json_data)
-                remaining_text = remaining_text.replace(json_match.group(0), "", 1).strip()
-            except json.JSONDecodeError as e:
-                container_to_write_in.warning(f"AI Warning: Could not parse JSON block: {e}.")
-
-        code_match_md = re.search(r"```(\w*)\s*\n(.*?)\n```", remaining_text, re.DOTALL)
-        if code_match_md:
-            language = code_match_md.group(1).lower().strip() if code_match_md.group(1) else "plaintext"
-            code_content = code_match_md.group(2).strip()
-            displayed_parts_for_history.append({"type": "code", "data": {"language": language, "code": code_content}})
-            container_to_write_in.code(code_content, language=language)
-            remaining_text = remaining_text.replace(code_match_md.group(0), "", 1).strip()
+        # One pass of the fence parser (stream_parser.py): first JSON block and first code block
+        # get their own widgets, everything else stays text
+        leftover_text_parts = []
+        json_shown = code_shown = False
+        for kind, data in parse_all(remaining_text):
+            if kind == "json" and not json_shown:
+                displayed_parts_for_history.append({"type": "json", "data": data})
+                container_to_write_in.json(data)
+                json_shown = True
+            elif kind == "json_error" and not json_shown:
+                container_to_write_in.warning(f"AI Warning: Could not parse JSON block: {data['error']}.")
+                leftover_text_parts.append(f"```json\n{data['raw']}\n```\n")
+            elif kind == "code_close" and not code_shown:
+                language = data["language"] or "plaintext"
+                code_content = data["code"].strip()
+                displayed_parts_for_history.append({"type": "code", "data": {"language": language, "code": code_content}})
+                container_to_write_in.code(code_content, language=language)
+                code_shown = True
+            elif kind == "code_close":
+                leftover_text_parts.append(f"```{data['language']}\n{data['code']}\n```\n")
+            elif kind == "json":
+                leftover_text_parts.append(f"```json\n{json.dumps(data, indent=2)}\n```\n")
+            elif kind == "text":
+                leftover_text_parts.append(data)
+        remaining_text = "".join(leftover_text_parts).strip()
 
     elif expected_model_output_style == "model2_or_3_raw_code_style": # Expect raw setup comments + raw code
         # This style is just text, possibly starting with comments
@@ -137,9 +169,100 @@ def display_ai_parts_from_string(full_response_string, container_to_write_in, ex
     return displayed_parts_for_history
 
 
+def choose_tier(user_prompt, model1_decision=None):
+    """Model tier of a code request (tiers.py), None when MAKE_BEST_TIERS is off."""
+    return default_tiers.choose(user_prompt, model1_decision) if default_tiers is not None else None
+
+
+def stream_pipeline(prompt_for_next, container, thinking_placeholder, turn_id, rerun_from=None, tier=None, profile=None):
+    """
+    Runs the pipeline of profile, by default the selected one (stages overlap, see pipeline.py) live into container.
+    Stages saved under turn_id before rerun_from are replayed from the checkpoints.
+    tier (choose_tier) picks the stage models and output caps for this turn.
+    Returns the final output (the last stage's, or what stands in for it).
+    """
+    # Stages, prompts and skip rules come from the chosen pipelines.json profile. Verifier, fanout
+    # (e.g. MAKE_BEST_FANOUT=model3=3), semantic cache and checkpoints are the env defaults.
+    pipeline = default_pipeline(
+        profile=profile or st.session_state.get("pipeline_profile"),
+        models={
+            "make_model2": st.session_state.model2_instance,
+            "make_model3": st.session_state.model3_instance,
+            "make_model4": st.session_state.model4_instance,
+            "make_model5": st.session_state.model5_instance,
+        },
+        refine=load_refine_loop() # shared, keeps its sidebar stats
+    )
+    stage_labels = {stage.name: stage.label for stage in pipeline.stages}
+    final_stage = pipeline.stages[-1].name
+    tier_note = f" ({tier['name']} tier)" if tier is not None else ""
+    stage_renderers = {} # one incremental renderer per live stage (render.py)
+    final_pipeline_output_string = ""
+
+    with tier_scope(tier):
+        for kind, stage_name, data in pipeline.stream(prompt_for_next, turn_id=turn_id, rerun_from=rerun_from):
+            if kind == "start":
+                thinking_placeholder.markdown(f"<p class='thinking-placeholder'>Pipeline Stage: {stage_labels[stage_name]}{tier_note}...</p>", unsafe_allow_html=True)
+                stage_renderers[stage_name] = stream_renderer(container.empty())
+            elif kind == "chunk":
+                stage_renderers[stage_name].write(data) # appends, redraws at most every ~80 ms
+            elif kind == "restart":
+                if stage_name in stage_renderers:
+                    stage_renderers.pop(stage_name).clear() # More code arrived upstream, the stage starts over
+            elif kind == "done":
+                stage_renderers[stage_name].clear() # Clear once the stage finished streaming
+                if stage_name == final_stage:
+                    final_pipeline_output_string = data # Output of the last stage
+            elif kind == "cached":
+                thinking_placeholder.markdown(f"<p class='thinking-placeholder'>{stage_labels[stage_name]}: reused (checkpoint or similar earlier request)</p>", unsafe_allow_html=True)
+                if stage_name == final_stage:
+                    final_pipeline_output_string = data # Stored output (checkpoint or near duplicate prompt)
+            elif kind == "verified" and stage_name == final_stage:
+                final_pipeline_output_string = data # Code already passed the local checks, the last stages were not called
+            elif kind == "skip" and stage_name == final_stage:
+                final_pipeline_output_string = f"Error: Could not extract code to feed {stage_labels[stage_name]}.\nShowing the previous stage's output instead:\n" + data
+
+    thinking_placeholder.empty()
+    return final_pipeline_output_string
+
+
 # --- Streamlit UI Title ---
 st.title("✨ GenAI Super Coder (User Backend Ver.) ✨")
 
+pipeline_profiles = load_profiles()
+st.sidebar.selectbox( # which pipelines.json profile code requests go through, e.g. "fast" = M2 -> M4
+    "Pipeline profile", list(pipeline_profiles["profiles"]), key="pipeline_profile",
+    index=list(pipeline_profiles["profiles"]).index(pipeline_profiles.get("default", "full")),
+    format_func=lambda name: f"{name}: {pipeline_profiles['profiles'][name].get('description', '')}"
+)
+
+with st.sidebar.expander("Response cache"): # hit/miss counters of the stage cache (cache.py)
+    st.json(default_cache.summary())
+with st.sidebar.expander("Rate limiter"): # retries / throttles / AIMD limit of the shared limiter (ratelimit.py)
+    st.json(default_limiter.summary())
+if getattr(default_backend, "context_cache", None) is not None:
+    with st.sidebar.expander("Context cache"): # server side caches of the system instructions (backends.py)
+        st.json(default_backend.context_cache.summary())
+if default_router()[0] is not None:
+    with st.sidebar.expander("Intent router"): # turns decided locally / agreement with model1 (router.py)
+        st.json(router_summary())
+with st.sidebar.expander("Token budgets"): # stage inputs trimmed to fit max_output_tokens (tokens.py)
+    st.json(default_counter.summary())
+with st.sidebar.expander("Stage metrics"): # per stage span counters / latency histograms (tracing.py)
+    st.code(default_metrics.render(), language="text")
+if default_semantic_cache is not None:
+    with st.sidebar.expander("Semantic cache"): # near duplicate prompts served / resumed from stored stages (semantic_cache.py)
+        st.json(default_semantic_cache.summary())
+if default_verifier is not None:
+    with st.sidebar.expander("Early exit"): # stages skipped because the code already passed local checks (sandbox.py)
+        st.json(default_verifier.summary())
+if default_tiers is not None:
+    with st.sidebar.expander("Model tiers"): # turns per complexity tier, smaller models / output caps for small tasks (tiers.py)
+        st.json(default_tiers.summary())
+if load_refine_loop() is not None:
+    with st.sidebar.expander("Refine loop"): # sandbox runs / model5 fix calls of the real refine loop (refine.py)
+        st.json(load_refine_loop().summary())
+
 if "messages" not in st.session_state:
     st.session_state.messages = [
         {"role": "assistant", "content_parts": [{"type": "text", "data": "Hello! I'm your AI Super Coder. How can I assist you today?"}]}
@@ -168,32 +291,30 @@ if user_input := st.chat_input("Describe your coding task or ask a question...")
         with st.chat_message("user"):
             st.markdown(user_input)
 
-        with st.chat_message("assistant"):
+        # a new message reruns the script while the previous turn's stage threads may still be
+        # streaming : cancel its token so they stop at their next chunk (cancel.py)
+        if st.session_state.get("turn_token") is not None:
+            st.session_state.turn_token.cancel("superseded by a new message")
+        st.session_state.turn_token = turn_token() # MAKE_BEST_TURN_DEADLINE seconds, if set
+
+        # one trace per turn : model1 and every stage span share its id (tracing.py)
+        with st.chat_message("assistant"), default_tracer.trace("turn", ui="streamlit"), cancel_scope(st.session_state.turn_token):
             current_assistant_turn_container = st.container()
             thinking_placeholder = current_assistant_turn_container.empty()
             thinking_placeholder.markdown("<p class='thinking-placeholder'>🧠 Orchestrating (Model 1)...</p>", unsafe_allow_html=True)
 
             accumulated_final_parts_for_history_this_turn = []
+            pipeline_turn_id = None
 
             try:
-                # Model1's __call__ expects just the current prompt; it uses its internal chat_session
-                # but we pass the UI history for its context construction if it's designed to use it.
-                # YOUR model1.py __call__ takes user_prompt and optionally ui_chat_history_for_context.
-                model1_raw_text_output = st.session_state.model1_instance(user_input, st.session_state.messages) # Pass UI history for context
-
-                # Parse Model1's output (YOUR model1.py __call__ returns raw text, not dict)
-                model1_output_json = None
-                json_str_match_m1 = re.search(r"```json\s*(\{.*?\})\s*```", model1_raw_text_output, re.DOTALL)
-                if json_str_match_m1:
-                    try:
-                        model1_output_json = json.loads(json_str_match_m1.group(1))
-                    except json.JSONDecodeError as e:
-                        current_assistant_turn_container.error(f"M1 JSON Error: {e}. Raw: {json_str_match_m1.group(1)}")
-                else: # Try parsing as raw JSON if no markdown wrapper
-                    try:
-                        model1_output_json = json.loads(model1_raw_text_output.strip())
-                    except json.JSONDecodeError as e:
-                         current_assistant_turn_container.error(f"M1 Output Error: Not valid JSON. Raw: {model1_raw_text_output}")
+                # Model1's __call__ expects just the current prompt; it keeps its own bounded
+                # history (model1.memory), so the UI history is not passed along.
+                model1_raw_text_output = st.session_state.model1_instance(user_input)
+
+                # Parse Model1's output (fenced or bare JSON, see stream_parser.parse_model1_output)
+                model1_output_json = parse_model1_output(model1_raw_text_output)
+                if model1_output_json is None:
+                    current_assistant_turn_container.error(f"M1 Output Error: Not valid JSON. Raw: {model1_raw_text_output}")
                 
                 if not model1_output_json: # If parsing failed completely
                     model1_output_json = { # Fallback
@@ -220,62 +341,15 @@ if user_input := st.chat_input("Describe your coding task or ask a question...")
                 if is_code_related and prompt_for_next and prompt_for_next.strip():
                     if initial_ack_displayed_in_turn: current_assistant_turn_container.markdown("---")
                     
-                    # --- EXECUTE YOUR FIXED M2->M3->M4->M5 PIPELINE ---
-                    pipeline_output_accumulator = []
-                    pipeline_stream_display_area = current_assistant_turn_container.empty()
-                    
-                    current_data_for_next_model = prompt_for_next
-
-                    # Stage 2: Model 2
-                    thinking_placeholder.markdown("<p class='thinking-placeholder'>Pipeline Stage: Generating Code (Model 2)...</p>", unsafe_allow_html=True)
-                    temp_accumulator_m2 = []
-                    for chunk in st.session_state.model2_instance(current_data_for_next_model):
-                        temp_accumulator_m2.append(chunk)
-                        pipeline_stream_display_area.markdown("".join(temp_accumulator_m2) + " ▌")
-                    current_data_for_next_model = "".join(temp_accumulator_m2) # Output of M2
-                    pipeline_stream_display_area.empty() # Clear for next stage's stream
-
-                    # Stage 3: Model 3 (Apex - refines M2 output)
-                    thinking_placeholder.markdown("<p class='thinking-placeholder'>Pipeline Stage: Refining Code (Model 3)...</p>", unsafe_allow_html=True)
-                    prompt_for_m3 = f"<CodeToRefine language='python'>\n{current_data_for_next_model}\n</CodeToRefine>\n<TaskGoal>Refine this code to Apex standards: raw output, setup instructions, peak quality.</TaskGoal>"
-                    temp_accumulator_m3 = []
-                    for chunk in st.session_state.model3_instance(prompt_for_m3):
-                        temp_accumulator_m3.append(chunk)
-                        pipeline_stream_display_area.markdown("".join(temp_accumulator_m3) + " ▌")
-                    current_data_for_next_model = "".join(temp_accumulator_m3) # Output of M3
-                    pipeline_stream_display_area.empty()
-
-                    # Stage 4: Model 4 (Physician - takes M3 output)
-                    thinking_placeholder.markdown("<p class='thinking-placeholder'>Pipeline Stage: Diagnosing & Correcting (Model 4)...</p>", unsafe_allow_html=True)
-                    prompt_for_m4 = f"<CodeToFix language='python'>\n{current_data_for_next_model}\n</CodeToFix>\n<RequestDetails>Diagnose, fix, and verify this code. Adhere to any implicit library constraints. Output JSON report then corrected code block.</RequestDetails>"
-                    temp_accumulator_m4 = []
-                    for chunk in st.session_state.model4_instance(prompt_for_m4):
-                        temp_accumulator_m4.append(chunk)
-                        pipeline_stream_display_area.markdown("".join(temp_accumulator_m4) + " ▌")
-                    current_data_for_next_model = "".join(temp_accumulator_m4) # Output of M4 (JSON + MD Code)
-                    pipeline_stream_display_area.empty()
-
-                    # Stage 5: Model 5 (Iterative Refiner - takes code part of M4 output)
-                    thinking_placeholder.markdown("<p class='thinking-placeholder'>Pipeline Stage: Iteratively Perfecting (Model 5)...</p>", unsafe_allow_html=True)
-                    code_to_perfect_match_m5 = re.search(r"```python\s*\n(.*?)\n```", current_data_for_next_model, re.DOTALL)
-                    if code_to_perfect_match_m5:
-                        code_for_m5 = code_to_perfect_match_m5.group(1).strip()
-                        prompt_for_m5 = f"<CodeToPerfect language='python'>\n```python\n{code_for_m5}\n```\n</CodeToPerfect>\n<TaskGoal>Iteratively perfect this code until it's 100% runnable and functionally complete. Output JSON log then final code block.</TaskGoal>\n<MaxIterations>5</MaxIterations>" # MaxIterations can be configurable
-                        temp_accumulator_m5 = []
-                        for chunk in st.session_state.model5_instance(prompt_for_m5):
-                            temp_accumulator_m5.append(chunk)
-                            pipeline_stream_display_area.markdown("".join(temp_accumulator_m5) + " ▌")
-                        final_pipeline_output_string = "".join(temp_accumulator_m5) # Output of M5
-                    else:
-                        final_pipeline_output_string = "Error: Could not extract code from Model 4 to feed Model 5.\nShowing Model 4 output instead:\n" + current_data_for_next_model
-                    
-                    pipeline_stream_display_area.empty()
-                    thinking_placeholder.empty()
+                    # --- EXECUTE THE M2->M3->M4->M5 PIPELINE, checkpointed under a new turn id ---
+                    pipeline_turn_id = st.session_state.last_turn_id = new_turn_id()
+                    final_pipeline_output_string = stream_pipeline(prompt_for_next, current_assistant_turn_container, thinking_placeholder, pipeline_turn_id, tier=choose_tier(user_input, model1_output_json))
                         
                     # Parse and display the FINAL output of the pipeline (from Model 5 or Model 4 if M5 had issues)
                     # Model 4 and 5 output style is JSON then MD code block
                     parsed_pipeline_parts = display_ai_parts_from_string(final_pipeline_output_string, current_assistant_turn_container, expected_model_output_style="model4_style") # or model5_style
                     accumulated_final_parts_for_history_this_turn.extend(parsed_pipeline_parts)
+                    st.session_state.model1_instance.remember(f"that is the code generated by the pipeline : {final_pipeline_output_string}")
 
                 elif not is_code_related and not user_ack_from_model1.strip():
                     fallback_msg = "I'm ready to assist. What can I do for you?"
@@ -286,10 +360,17 @@ if user_input := st.chat_input("Describe your coding task or ask a question...")
                     thinking_placeholder.empty()
 
 
+            except turn_cancelled as e:
+                thinking_placeholder.empty()
+                current_assistant_turn_container.warning(f"Stopped: {e}")
+                accumulated_final_parts_for_history_this_turn.append({"type": "text", "data": f"Stopped: {e}"})
+
             except Exception as e:
                 thinking_placeholder.empty()
                 error_msg = f"An unexpected error occurred processing your request: {e}"
                 current_assistant_turn_container.error(error_msg)
+                if pipeline_turn_id is not None:
+                    current_assistant_turn_container.info("Finished stages were checkpointed: use Re-run in the sidebar's Checkpoints panel to continue from the last one.")
                 accumulated_final_parts_for_history_this_turn.append({"type": "text", "data": f"Sorry, I encountered an error: {e}"})
                 import traceback; traceback.print_exc()
 
@@ -299,3 +380,45 @@ if user_input := st.chat_input("Describe your coding task or ask a question...")
         # If M1 only gave an ack for a non-code task, and nothing else was added.
         elif not accumulated_final_parts_for_history_this_turn and user_ack_from_model1 and not is_code_related:
              st.session_state.messages.append({"role": "assistant", "content_parts": [{"type": "text", "data": user_ack_from_model1}]})
+
+# --- Checkpoints of the last pipeline turn: resume it, or re-run only a later stage (checkpoints.py) ---
+# Drawn last so a turn that just failed already shows up here.
+last_turn = default_checkpoints.turn(st.session_state.last_turn_id) if st.session_state.get("last_turn_id") else None
+rerun_request = None
+if last_turn is not None:
+    with st.sidebar.expander("Checkpoints", expanded=last_turn["status"] != "done"):
+        st.json({"status": last_turn["status"], "error": last_turn["error"],
+                 "stages": {name: stage["kind"] for name, stage in last_turn["stages"].items()}})
+        # a re-run keeps the profile and tier the turn started with, not the current selection
+        last_turn_profile = last_turn["profile"] or st.session_state.pipeline_profile
+        st.caption(f"Profile: {last_turn_profile}" + (f", {last_turn['tier']} tier" if last_turn["tier"] else ""))
+        profile_stage_names = [stage["name"] for stage in pipeline_profiles["profiles"][last_turn_profile]["stages"]]
+        rerun_choice = st.selectbox("Re-run the last pipeline turn", ["from the last completed stage"] + profile_stage_names)
+        if st.button("Re-run"):
+            rerun_request = (last_turn["turn_id"], None if rerun_choice.startswith("from") else rerun_choice) # None = resume
+
+if rerun_request is not None and st.session_state.get("models_initialized_flag", False):
+    rerun_turn_id, rerun_from = rerun_request
+    if st.session_state.get("turn_token") is not None:
+        st.session_state.turn_token.cancel("superseded by a re-run")
+    st.session_state.turn_token = turn_token()
+
+    rerun_parts = []
+    with st.chat_message("assistant"), default_tracer.trace("turn", ui="streamlit", resumed=True), cancel_scope(st.session_state.turn_token):
+        rerun_container = st.container()
+        rerun_thinking = rerun_container.empty()
+        try:
+            rerun_tier = default_tiers.named(last_turn["tier"]) if default_tiers is not None and last_turn["tier"] else None
+            final_pipeline_output_string = stream_pipeline(last_turn["prompt"], rerun_container, rerun_thinking, rerun_turn_id, rerun_from, tier=rerun_tier, profile=last_turn_profile)
+            rerun_thinking.empty()
+            rerun_parts = display_ai_parts_from_string(final_pipeline_output_string, rerun_container, expected_model_output_style="model4_style")
+            st.session_state.model1_instance.remember(f"that is the code generated by the pipeline : {final_pipeline_output_string}")
+        except turn_cancelled as e:
+            rerun_thinking.empty()
+            rerun_container.warning(f"Stopped: {e}")
+        except Exception as e:
+            rerun_thinking.empty()
+            rerun_container.error(f"The re-run failed too: {e}")
+            import traceback; traceback.print_exc()
+    if rerun_parts:
+        st.session_state.messages.append({"role": "assistant", "content_parts": rerun_parts})
@@ -0,0 +1,26 @@
+import os
+import sys
+
+# offline models for every test, set before backends.py picks the process default
+os.environ['MAKE_BEST_BACKEND'] = 'fake'
+os.environ.pop('MAKE_BEST_PIPELINE', None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def models():
+    '''
+        fresh make_model2 .. make_model5 on the fake backend, no response cache or rate limiter
+    '''
+    import model1
+
+    made = {}
+    for name in ('make_model2', 'make_model3', 'make_model4', 'make_model5'):
+        model = getattr(model1, name)()
+        model.cache = None
+        model.limiter = None
+        made[name] = model
+    return made
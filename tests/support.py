@@ -0,0 +1,32 @@
+'''
+    helpers shared by the pipeline tests
+'''
+from cancel import cancel_token
+from pipeline import FINISHED, default_pipeline
+
+
+PROMPT = 'Write a python module. Based on this context: sum a list of numbers'
+
+
+def pipeline(models, profile, pipelined = True, **options):
+    # no env defaults : each test says which verifier / checkpoints it runs with
+    settings = dict(verifier = None, fanout = None, semantic_cache = None, checkpoints = None, refine = None)
+    settings.update(options)
+    return default_pipeline(pipelined, profile, models, **settings)
+
+
+def run(pipeline, prompt = PROMPT, **kwargs):
+    # a deadline turns a hang into a failure
+    return list(pipeline.stream(prompt, token = cancel_token(deadline = 30), **kwargs))
+
+
+async def arun(pipeline, prompt = PROMPT, **kwargs):
+    return [event async for event in pipeline.astream(prompt, token = cancel_token(deadline = 30), **kwargs)]
+
+
+def finished(events):
+    return [(name, kind) for kind, name, data in events if kind in FINISHED]
+
+
+def position(events, kind, name):
+    return next(index for index, event in enumerate(events) if event[:2] == (kind, name))
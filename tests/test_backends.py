@@ -0,0 +1,64 @@
+from backends import MIN_CACHED_TOKENS, backend_from_env, fake_backend, instruction_cache
+
+
+def settings(model_name = 'gemini-1.5-flash-001', instruction_tokens = MIN_CACHED_TOKENS):
+    return {'model_name': model_name, 'generation_config': {}, 'safety_settings': None,
+            'system_instruction': 'x' * (instruction_tokens * 4)}
+
+
+class clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_context_cache_is_opt_in(monkeypatch):
+    monkeypatch.delenv('MAKE_BEST_CONTEXT_CACHE', raising = False)
+    assert backend_from_env().context_cache is None
+    monkeypatch.setenv('MAKE_BEST_CONTEXT_CACHE', '1')
+    assert backend_from_env().context_cache is not None
+
+
+def test_a_refusal_is_remembered(capsys):
+    created = []
+
+    def create(settings, ttl):
+        created.append(settings)
+        raise RuntimeError('400 Cached content is too small. total_token_count=120, min_total_token_count=32768')
+
+    cache = instruction_cache(create, lambda handle, ttl: handle)
+    assert cache.get(settings()) is None
+    assert cache.get(settings()) is None
+    assert len(created) == 1
+    assert cache.summary()['uncacheable'] == 1 and cache.summary()['refused'] == 1
+    # reported on stderr, stdout stays clean for bench.py > report.json
+    output = capsys.readouterr()
+    assert output.out == '' and 'too small' in output.err
+
+
+def test_a_retryable_error_is_tried_again_later(capsys):
+    failures = [RuntimeError('429 Resource has been exhausted')]
+    now = clock()
+
+    def create(settings, ttl):
+        if failures:
+            raise failures.pop()
+        return 'handle'
+
+    cache = instruction_cache(create, lambda handle, ttl: handle, retry_after = 60, clock = now)
+    assert cache.get(settings()) is None
+    now.now += 30
+    assert cache.get(settings()) is None      # still backing off, no second request
+    now.now += 31
+    assert cache.get(settings()) == 'handle'
+    assert cache.summary()['uncacheable'] == 0 and cache.summary()['errors'] == 1
+
+
+def test_the_fake_backend_refuses_what_the_api_refuses():
+    backend = fake_backend(context_cache = True)
+    assert backend.context_cache.get(settings(instruction_tokens = 100)) is None
+    assert backend.context_cache.get(settings(model_name = 'gemini-1.5-flash-latest')) is None
+    assert backend.context_cache.get(settings()) is not None
@@ -0,0 +1,13 @@
+from bench import import_seconds, percentiles, regressions
+
+
+def test_regressions_compare_the_import_time():
+    baseline = {'metrics': {'import': percentiles([0.05, 0.05, 0.06]), 'total': percentiles([1.0])}}
+    report = {'metrics': {'import': percentiles([0.5, 0.5, 0.6]), 'total': percentiles([1.0])}}
+    assert [(metric, p) for metric, p, old, new in regressions(report, baseline, 0.2)] == [('metrics.import', 'p50'), ('metrics.import', 'p95')]
+
+
+def test_import_time_is_measured_from_any_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    samples = import_seconds(runs = 1)
+    assert len(samples) == 1 and samples[0] > 0
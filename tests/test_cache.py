@@ -0,0 +1,50 @@
+from cache import cache_key, response_cache
+
+
+def test_lru_bounds_entries_and_bytes():
+    cache = response_cache(max_entries = 2)
+    for name in ('a', 'b', 'c'):
+        cache.put(name, [name])
+    assert cache.get('a') is None and cache.get('c') == ['c']
+
+    cache = response_cache(max_bytes = 10)
+    cache.put('a', ['12345'])
+    cache.put('b', ['123456'])
+    assert cache.get('a') is None and cache.get('b') == ['123456']
+    assert cache.summary()['evictions'] == 1
+
+
+def test_expired_entries_are_not_served():
+    cache = response_cache(ttl = -1)
+    cache.put('a', ['x'])
+    assert cache.get('a') is None
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / 'responses.sqlite')
+    response_cache(disk_path = path).put('a', ['x', 'y'], elapsed = 2.0)
+
+    cache = response_cache(disk_path = path)
+    assert cache.get('a') == ['x', 'y']
+    assert cache.summary()['disk_hits'] == 1 and cache.summary()['saved_seconds'] == 2.0
+
+
+def test_the_key_depends_on_every_part_of_the_call():
+    key = cache_key('m', {'temperature': 0}, 'instruction', 'prompt')
+    assert key == cache_key('m', {'temperature': 0}, 'instruction', 'prompt')
+    assert key != cache_key('m', {'temperature': 1}, 'instruction', 'prompt')
+    assert key != cache_key('m', {'temperature': 0}, 'other instruction', 'prompt')
+    assert key != cache_key('other', {'temperature': 0}, 'instruction', 'prompt')
+
+
+def test_a_repeated_stage_call_replays_the_stream(models):
+    model = models['make_model2']
+    model.cache = response_cache()
+    first = list(model.stream('sum a list'))
+    calls = model.backend.calls
+
+    assert list(model.stream('sum a list')) == first
+    assert model.backend.calls == calls
+    list(model.stream('sum a list', use_cache = False))
+    assert model.backend.calls == calls + 1
+    assert model.cache.summary()['hits'] == 1
@@ -0,0 +1,63 @@
+import pytest
+
+from backends import fake_backend, synthetic_response
+from checkpoints import checkpoint_store
+from support import finished, pipeline, run
+from tiers import tier_scope
+
+
+def test_rerun_from_replays_earlier_stages_from_checkpoints(models):
+    store = checkpoint_store()
+    chain = pipeline(models, 'full', checkpoints = store)
+    first = run(chain, turn_id = 'turn-1')
+    outputs = {name: data for kind, name, data in first if kind in ('done', 'skip', 'verified', 'cached')}
+    assert store.turn('turn-1')['status'] == 'done'
+    assert store.turn('turn-1')['profile'] == 'full'
+
+    calls = models['make_model2'].backend.calls
+    again = run(chain, turn_id = 'turn-1', rerun_from = 'model4')
+
+    assert finished(again)[:2] == [('model2', 'cached'), ('model3', 'cached')]
+    assert sorted(finished(again)[2:]) == [('model4', 'done'), ('model5', 'done')]
+    assert [data for kind, name, data in again if kind == 'cached'] == [outputs['model2'], outputs['model3']]
+    assert models['make_model2'].backend.calls == calls + 2     # only model4 and model5 called again
+    assert store.turn('turn-1')['status'] == 'done'
+
+
+def test_a_failed_rerun_does_not_leave_the_old_later_stages(models):
+    store = checkpoint_store()
+    run(pipeline(models, 'full', pipelined = False, checkpoints = store), turn_id = 'turn-2')
+
+    def responder(settings, prompt_text):
+        if '<CodeToFix' in prompt_text:
+            raise ConnectionError('model4 is down')
+        return synthetic_response(settings, prompt_text)
+
+    models['make_model4'].backend = fake_backend(responder = responder)
+    failing = pipeline(models, 'full', pipelined = False, checkpoints = store)
+    with pytest.raises(RuntimeError, match = 'model4'):
+        run(failing, turn_id = 'turn-2', rerun_from = 'model4')
+    assert store.turn('turn-2')['status'] == 'failed'
+    assert set(store.turn('turn-2')['stages']) == {'model2', 'model3'}
+
+    # resuming runs model4 and model5 again instead of replaying the outputs the rerun replaced
+    models['make_model4'].backend = fake_backend()
+    resumed = run(pipeline(models, 'full', pipelined = False, checkpoints = store), turn_id = 'turn-2')
+    assert finished(resumed) == [('model2', 'cached'), ('model3', 'cached'), ('model4', 'done'), ('model5', 'done')]
+    assert models['make_model4'].backend.calls == 1
+
+
+def test_replay_refuses_another_profile_or_tier(models):
+    store = checkpoint_store()
+    run(pipeline(models, 'full', checkpoints = store), turn_id = 'turn-3')
+
+    with pytest.raises(ValueError, match = "profile 'full'"):
+        run(pipeline(models, 'fast', checkpoints = store), turn_id = 'turn-3')
+
+    small = {'name': 'small', 'default': {}, 'stages': {}, 'score': 0.0, 'features': {}}
+    with tier_scope(small), pytest.raises(ValueError, match = "tier None"):
+        run(pipeline(models, 'full', checkpoints = store), turn_id = 'turn-3', rerun_from = 'model4')
+
+    # the refused runs left the turn as it was
+    turn = store.turn('turn-3')
+    assert turn['status'] == 'done' and len(turn['stages']) == 4
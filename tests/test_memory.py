@@ -0,0 +1,51 @@
+from memory import conversation_memory, digest_code
+
+
+FUNCTION = 'def add(a, b):\n    return a + b'
+REPLY = f'Here it is.\n```python\n{FUNCTION}\n```\n'
+
+
+def sent(memory, prompt = 'next'):
+    return '\n'.join(part for message in memory.contents(prompt) for part in message['parts'])
+
+
+def test_the_latest_turn_keeps_its_code():
+    memory = conversation_memory()
+    memory.add('write an add function', REPLY)
+    assert FUNCTION in sent(memory, 'now add type hints to that function')
+
+    # older turns only keep a digest of theirs
+    memory.add('and a subtract function', 'Sure.\n```python\ndef sub(a, b):\n    return a - b\n```\n')
+    text = sent(memory)
+    assert FUNCTION not in text and 'python block omitted : 2 lines' in text
+    assert 'def sub(a, b)' in text
+
+
+def test_the_pipeline_output_attached_to_the_latest_turn_is_kept():
+    memory = conversation_memory()
+    memory.add('write an add function', '{"is_code_related": true}')
+    memory.extend_last_reply(f'that is the code generated by the pipeline : {REPLY}')
+    assert FUNCTION in sent(memory)
+
+
+def test_a_latest_turn_over_the_budget_is_digested():
+    memory = conversation_memory(max_latest_tokens = 50)
+    big = 'x = 1\n' * 200
+    memory.add('write a big module', f'```python\n{big}```\n')
+    text = sent(memory)
+    assert big not in text and 'python block omitted' in text
+
+
+def test_history_fits_in_max_tokens():
+    memory = conversation_memory(max_tokens = 100, max_turn_tokens = 40)
+    for turn in range(10):
+        memory.add(f'request {turn} ' + 'word ' * 30, 'reply ' * 30)
+    messages = memory.contents('next')
+    assert len(messages) < 2 * memory.max_turns + 1
+    assert messages[-1] == {'role': 'user', 'parts': ['next']}
+    assert 'request 9' in messages[-3]['parts'][0]
+
+
+def test_json_blocks_are_not_digested():
+    text = '```json\n{"is_code_related": true}\n```'
+    assert digest_code(text) == text
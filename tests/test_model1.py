@@ -0,0 +1,19 @@
+from model1 import _progress_printer
+
+
+def test_the_console_streams_the_last_stage(capsys):
+    progress = _progress_printer('model4')
+    for event in [('start', 'model2', 'p'), ('chunk', 'model2', 'hidden'), ('done', 'model2', 'hidden'),
+                  ('start', 'model4', 'p'), ('chunk', 'model4', 'fixed '), ('chunk', 'model4', 'code'), ('done', 'model4', 'fixed code')]:
+        progress(event)
+
+    printed = capsys.readouterr().out
+    assert 'hidden' not in printed
+    assert '[model2 : done]' in printed and 'fixed code\n[model4 : done]' in printed
+    assert progress.streamed
+
+
+def test_a_final_output_that_did_not_stream_is_not_marked_streamed():
+    progress = _progress_printer('model5')
+    progress(('verified', 'model5', '```python\npass\n```\n'))
+    assert not progress.streamed
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from backends import fake_backend, synthetic_response
+from checkpoints import checkpoint_store
+from support import arun, finished, pipeline, position, run
+
+
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_linear_profile_runs_stages_in_order(models, pipelined):
+    events = run(pipeline(models, 'fast', pipelined))
+
+    assert sorted(finished(events)) == [('model2', 'done'), ('model4', 'done')]
+    if pipelined:
+        # model4 starts on model2's first code fence, it may even finish before model2's tail
+        assert position(events, 'handoff', 'model2') < position(events, 'start', 'model4')
+    else:
+        assert position(events, 'done', 'model2') < position(events, 'start', 'model4')
+    model2_output = events[position(events, 'done', 'model2')][2]
+    model4_prompt = events[position(events, 'start', 'model4')][2]
+    assert '<CodeToFix' in model4_prompt
+    assert '```python' in model2_output and model2_output.split('```python')[1].split('```')[0] in model4_prompt
+
+
+def test_linear_profile_async(models):
+    events = asyncio.run(arun(pipeline(models, 'full')))
+    assert sorted(finished(events)) == [('model2', 'done'), ('model3', 'done'), ('model4', 'done'), ('model5', 'done')]
+    assert position(events, 'handoff', 'model3') < position(events, 'start', 'model4')
+
+
+def test_branches_join_waits_for_both_and_takes_the_best_code(models):
+    events = run(pipeline(models, 'branches'))
+
+    assert {name for name, kind in finished(events)} == {'model2', 'model3', 'model4', 'model5'}
+    model5_start = position(events, 'start', 'model5')
+    assert model5_start > position(events, 'done', 'model3')
+    assert model5_start > position(events, 'done', 'model4')
+
+    # best_code passes one branch's code on, not both concatenated
+    model5_prompt = events[model5_start][2]
+    assert model5_prompt.count('<CodeToPerfect') == 1
+    assert '<model3>' not in model5_prompt and '<model4>' not in model5_prompt
+
+
+def test_error_in_a_stage_fails_the_turn(models):
+    def responder(settings, prompt_text):
+        if '<CodeToFix' in prompt_text:
+            raise ConnectionError('model4 is down')
+        return synthetic_response(settings, prompt_text)
+
+    models['make_model4'].backend = fake_backend(responder = responder)
+    store = checkpoint_store()
+    with pytest.raises(RuntimeError, match = 'model4'):
+        run(pipeline(models, 'full', pipelined = False, checkpoints = store), turn_id = 'turn-2')
+
+    # the stages that finished before the failure are kept for a retry
+    turn = store.turn('turn-2')
+    assert turn['status'] == 'failed'
+    assert set(turn['stages']) == {'model2', 'model3'}
+
+
+def test_make_pipeline_makes_the_models_not_given(models):
+    from pipeline import make_pipeline
+
+    chain = make_pipeline(model3 = models['make_model3'])
+    assert [stage.name for stage in chain.stages] == ['model2', 'model3', 'model4', 'model5']
+    assert chain.stages[1].model is models['make_model3']
+    assert all(stage.model is not None for stage in chain.stages)
+    assert sorted(finished(run(chain))) == [('model2', 'done'), ('model3', 'done'), ('model4', 'done'), ('model5', 'done')]
+
+
+class failing_verifier:
+    # the check before a skip_when_verified stage raises (e.g. the sandbox could not start)
+
+    def verified_code(self, text):
+        raise OSError('no interpreter')
+
+    def count_skip(self, stage_name):
+        pass
+
+
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_error_in_a_stage_check_fails_the_turn(models, pipelined):
+    with pytest.raises(RuntimeError, match = 'model4 : no interpreter'):
+        run(pipeline(models, 'full', pipelined, verifier = failing_verifier()))
+
+    with pytest.raises(RuntimeError, match = 'model4 : no interpreter'):
+        asyncio.run(arun(pipeline(models, 'full', pipelined, verifier = failing_verifier())))
+
+
+TWO_FILES = (
+    'main.py :\n```python\nfrom helper import double\n\nprint(double(2))\n```\n'
+    'helper.py :\n```python\ndef double(value):\n    return value * 2\n```\n'
+)
+
+
+def two_files(models):
+    def responder(settings, prompt_text):
+        return TWO_FILES if '<CodeToFix' not in prompt_text else synthetic_response(settings, prompt_text)
+
+    # slow enough that model4 starts on the first fence while model2 still writes the second
+    models['make_model2'].backend = fake_backend(responder = responder, token_latency = 0.002)
+    return pipeline(models, 'fast')
+
+
+def last_start(events, name):
+    return [data for kind, stage_name, data in events if (kind, stage_name) == ('start', name)][-1]
+
+
+def test_more_code_after_the_handoff_restarts_the_downstream_stage(models):
+    events = run(two_files(models))
+
+    assert sorted(finished(events)) == [('model2', 'done'), ('model4', 'done')]
+    assert position(events, 'start', 'model4') < position(events, 'done', 'model2') < position(events, 'restart', 'model4')
+    assert 'def double(value)' in last_start(events, 'model4')
+    # nothing of the first run of model4 is handed on
+    assert [kind for kind, name, data in events if name == 'model4'].count('done') == 1
+
+
+def test_more_code_after_the_handoff_restarts_the_downstream_stage_async(models):
+    events = asyncio.run(arun(two_files(models)))
+
+    assert sorted(finished(events)) == [('model2', 'done'), ('model4', 'done')]
+    assert any(event[:2] == ('restart', 'model4') for event in events)
+    assert 'def double(value)' in last_start(events, 'model4')
+
+
+def test_a_speculative_stage_hands_off_only_once_its_upstream_finished(models):
+    models['make_model2'].backend = fake_backend(token_latency = 0.002)
+    events = run(pipeline(models, 'full'))
+
+    assert not any(kind == 'restart' for kind, name, data in events)
+    # model3 started on model2's fence, its own handoff waits for model2's done
+    assert position(events, 'start', 'model3') < position(events, 'done', 'model2') < position(events, 'handoff', 'model3')
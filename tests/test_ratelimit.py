@@ -0,0 +1,70 @@
+import pytest
+
+import ratelimit
+from cancel import cancel_scope, cancel_token, turn_cancelled
+from ratelimit import adaptive_concurrency, rate_limiter, token_bucket
+
+
+@pytest.fixture(autouse = True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'backoff_delay', lambda attempt: 0.0)
+
+
+def test_bucket_makes_later_callers_wait():
+    bucket = token_bucket(per_minute = 60, capacity = 2)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert 0.9 < bucket.reserve() <= 1.0       # one unit per second
+
+
+def test_a_cancelled_wait_gives_the_units_back():
+    bucket = token_bucket(per_minute = 60, capacity = 1)
+    bucket.reserve()
+    token = cancel_token()
+    token.cancel('user stopped')
+    with cancel_scope(token), pytest.raises(turn_cancelled):
+        bucket.acquire()
+    assert 0.9 < bucket.reserve() <= 1.0       # not two units behind
+
+
+def test_retryable_errors_before_the_first_chunk_are_retried():
+    attempts = []
+
+    def open_stream():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError('429 Resource has been exhausted')
+        yield 'ok'
+
+    limiter = rate_limiter(6000, 10 ** 9)
+    assert list(limiter.stream(open_stream)) == ['ok']
+    assert limiter.summary()['retries'] == 2 and limiter.summary()['throttled'] == 2
+
+
+def test_other_errors_and_errors_mid_stream_are_not_retried():
+    limiter = rate_limiter(6000, 10 ** 9)
+
+    def broken():
+        raise ValueError('bad request')
+        yield
+
+    with pytest.raises(ValueError):
+        list(limiter.stream(broken))
+
+    def cut_off():
+        yield 'part'
+        raise RuntimeError('503 unavailable')
+
+    with pytest.raises(RuntimeError):
+        list(limiter.stream(cut_off))
+    assert limiter.summary()['retries'] == 0 and limiter.summary()['failed'] == 2
+
+
+def test_concurrency_grows_on_success_and_halves_when_throttled():
+    limit = adaptive_concurrency(initial = 4)
+    limit.acquire()
+    limit.release('ok')
+    assert limit.limit == 4.25
+    limit.acquire()
+    limit.release('throttled')
+    assert limit.limit == 2.125 and limit.in_flight == 0
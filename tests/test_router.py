@@ -0,0 +1,58 @@
+import json
+
+from router import intent_router, route, routed_model1, router_summary
+from stream_parser import TASK_MARKER, parse_model1_output
+
+
+def test_rules_decide_the_obvious_turns():
+    router = intent_router()
+    assert router.decide('hi there!')['is_code_related'] is False
+    assert router.decide('thanks a lot')['source'] == 'rule:thanks'
+    assert router.decide('write a function that merges two sorted lists')['is_code_related'] is True
+    assert router.decide('Traceback (most recent call last):\n  ValueError: bad')['source'] == 'rule:traceback'
+    # unsure without a trained classifier : model1 decides
+    assert router.decide('what do you think about rust?')['is_code_related'] is None
+    assert router.decide('hi, write me a parser')['is_code_related'] is None     # not small talk as a whole
+
+
+def test_confident_turns_skip_model1(models):
+    import model1
+
+    inner = model1.make_model1()
+    routed = routed_model1(inner, intent_router(), mode = 'on')
+    calls = inner.backend.calls
+
+    reply = parse_model1_output(routed('hello'))
+    assert reply['is_code_related'] is False and reply['response_for_user']
+    reply = parse_model1_output(routed('write a function that merges two sorted lists'))
+    assert reply['is_code_related'] is True
+    assert TASK_MARKER.search(reply['prompt_for_model2'])
+    assert inner.backend.calls == calls
+    # routed turns are in model1's memory like any other
+    assert [user_text for user_text, model_text in inner.memory.turns] == ['hello', 'write a function that merges two sorted lists']
+
+    routed('what do you think about rust?')
+    assert inner.backend.calls == calls + 1
+
+
+def test_shadow_mode_always_calls_model1_and_counts_agreement(tmp_path):
+    import model1
+
+    log_path = tmp_path / 'router.jsonl'
+    inner = model1.make_model1()
+    routed = routed_model1(inner, intent_router(), mode = 'shadow', log_path = str(log_path))
+    before = router_summary()
+    calls = inner.backend.calls
+
+    routed('write a function that merges two sorted lists')
+    after = router_summary()
+    assert inner.backend.calls == calls + 1
+    assert after['model1_calls'] == before['model1_calls'] + 1
+    assert after['agreed'] + after['disagreed'] == before['agreed'] + before['disagreed'] + 1
+    logged = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert logged[-1]['prompt'] == 'write a function that merges two sorted lists'
+
+
+def test_route_is_a_no_op_when_the_router_is_off():
+    model = object()
+    assert route(model) is model
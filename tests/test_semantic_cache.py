@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+from semantic_cache import semantic_cache
+
+
+DIRECTIVE = 'You are an expert programmer, write complete code. Based on this context: '
+OUTPUTS = {'model2': 'm2', 'model3': 'm3', 'model4': 'm4', 'model5': 'm5'}
+STAGES = list(OUTPUTS)
+
+
+def test_a_paraphrase_hits():
+    cache = semantic_cache()
+    cache.store(DIRECTIVE + 'write a fast LRU cache in python', OUTPUTS, 'full')
+
+    hit = cache.lookup(DIRECTIVE + 'python LRU cache, fast please', STAGES, 'full')
+    assert hit is not None and hit['outputs'] == OUTPUTS
+    assert cache.summary()['hits'] == 1
+
+
+@pytest.mark.parametrize('stored, asked', [
+    ('convert celsius to fahrenheit in python', 'convert fahrenheit to celsius in python'),
+    ('write a fast LRU cache in python', 'write a fast LRU cache in javascript'),
+    ('write a fast LRU cache in python', 'parse a csv file in python'),
+])
+def test_other_tasks_miss(stored, asked):
+    cache = semantic_cache()
+    cache.store(DIRECTIVE + stored, OUTPUTS, 'full')
+    assert cache.lookup(DIRECTIVE + asked, STAGES, 'full') is None
+
+
+def test_a_function_to_do_something_is_not_a_direction():
+    cache = semantic_cache()
+    cache.store(DIRECTIVE + 'a python function to sort a list of numbers', OUTPUTS, 'full')
+    assert cache.lookup(DIRECTIVE + 'sort a list of numbers, python function', STAGES, 'full') is not None
+
+
+def test_entries_are_kept_per_profile_and_tier():
+    cache = semantic_cache()
+    prompt = DIRECTIVE + 'write a fast LRU cache in python'
+    cache.store(prompt, OUTPUTS, 'full', 'large')
+
+    assert cache.lookup(prompt, STAGES, 'fast', 'large') is None
+    assert cache.lookup(prompt, STAGES, 'full', 'small') is None
+    assert cache.lookup(prompt, STAGES, 'full', 'large') is not None
+
+
+def test_prompts_without_the_task_marker_are_not_cached():
+    cache = semantic_cache()
+    cache.store('write a fast LRU cache in python', OUTPUTS, 'full')
+    assert cache.summary()['entries'] == 0
+    assert cache.lookup('write a fast LRU cache in python', STAGES, 'full') is None
+    assert cache.summary()['unmarked'] == 1
+
+
+def test_a_repeated_prompt_replays_the_stored_outputs(models):
+    from support import finished, pipeline, run
+
+    cache = semantic_cache()
+    chain = pipeline(models, 'full', semantic_cache = cache)
+    first = run(chain)
+    assert cache.summary()['stores'] == 1
+
+    calls = models['make_model2'].backend.calls
+    again = run(chain)
+    assert finished(again) == [('model2', 'cached'), ('model3', 'cached'), ('model4', 'cached'), ('model5', 'cached')]
+    assert models['make_model2'].backend.calls == calls
+    assert {name: data for kind, name, data in again if kind == 'cached'} == {name: data for kind, name, data in first if kind == 'done'}
+
+    # another profile does not replay the full chain's outputs
+    run(pipeline(models, 'fast', semantic_cache = cache))
+    assert models['make_model2'].backend.calls == calls + 2
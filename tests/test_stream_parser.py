@@ -0,0 +1,58 @@
+from stream_parser import code_fence_handoff, fence_parser, first_code_block, parse_all, parse_model1_output, task_text
+
+
+ANSWER = 'Here it is.\n```python\ndef add(a, b):\n    return a + b\n```\nRun it.\n'
+
+
+def feed_in_chunks(text, size):
+    parser = fence_parser()
+    events = []
+    for start in range(0, len(text), size):
+        events += parser.feed(text[start:start + size])
+    return events + parser.close()
+
+
+def test_events_do_not_depend_on_chunking():
+    whole = parse_all(ANSWER)
+    for size in (1, 2, 3, 7, 64):
+        assert feed_in_chunks(ANSWER, size) == whole
+
+    kinds = [kind for kind, data in whole]
+    assert kinds == ['text', 'code_open', 'code', 'code', 'code_close', 'text']
+    close = whole[4][1]
+    assert close['language'] == 'python'
+    assert close['code'] == 'def add(a, b):\n    return a + b'
+    assert close['closed'] and ANSWER[:close['end']].endswith('```\n')
+
+
+def test_json_fences_are_parsed():
+    events = parse_all('```json\n{"status": "SUCCESS"}\n```\n```json\n{broken\n```\n')
+    assert ('json', {'status': 'SUCCESS'}) in events
+    assert any(kind == 'json_error' and data['raw'] == '{broken' for kind, data in events)
+
+
+def test_unterminated_fence_is_closed_at_the_end():
+    events = parse_all('```python\nprint(1)')
+    close = events[-1]
+    assert close[0] == 'code_close'
+    assert close[1]['code'] == 'print(1)' and not close[1]['closed']
+
+
+def test_handoff_returns_the_text_up_to_the_first_code_fence():
+    tracker = code_fence_handoff()
+    sections = [tracker.feed(ANSWER[start:start + 5]) for start in range(0, len(ANSWER), 5)]
+    handed_off = [section for section in sections if section is not None]
+    assert handed_off[0] == ANSWER[:ANSWER.index('Run it.')]
+
+    json_first = code_fence_handoff()
+    assert json_first.feed('```json\n{"a": 1}\n```\n') is None
+
+
+def test_model1_output_and_task_text():
+    assert parse_model1_output('```json\n{"is_code_related": true}\n```') == {'is_code_related': True}
+    assert parse_model1_output('{"is_code_related": false}') == {'is_code_related': False}
+    assert parse_model1_output('not json') is None
+    assert first_code_block(ANSWER) == 'def add(a, b):\n    return a + b'
+
+    assert task_text('You are an expert. Based on this context: sort a list') == ' sort a list'
+    assert task_text('sort a list') == 'sort a list'
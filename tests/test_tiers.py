@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from backends import fake_backend
+from tiers import apply_tier, complexity, tier_policy, tier_scope, tiers_from_env
+
+
+@pytest.fixture
+def policy(tmp_path, monkeypatch):
+    monkeypatch.setenv('MAKE_BEST_TIERS', '1')
+    monkeypatch.setenv('MAKE_BEST_TIER_LOG', str(tmp_path / 'tiers.jsonl'))
+    return tiers_from_env()
+
+
+def test_complexity_ranks_requests():
+    small = complexity('just fix the typo in this one-liner')
+    large = complexity('build a distributed microservices application with a database schema and a gui\n'
+                       '- auth\n- billing\n- reports\n- admin panel')
+    assert small['score'] == 0.0
+    assert large['score'] > 4.0 and large['features']['requirements'] == 4
+
+
+def test_choose_picks_the_first_tier_that_fits_and_logs_it(policy):
+    assert policy.choose('rename a variable, a small change')['name'] == 'small'
+    assert policy.choose('build a distributed microservices application with a database schema and a gui')['name'] == 'large'
+    assert policy.summary()['tiers'] == {'small': 1, 'medium': 0, 'large': 1}
+    with open(policy.log_path, encoding = 'utf-8') as f:
+        assert [json.loads(line)['tier'] for line in f] == ['small', 'large']
+
+
+def test_apply_tier_overrides_and_caps_the_stage_settings(policy):
+    settings = {'model_name': 'gemini-1.5-pro', 'generation_config': {'max_output_tokens': 2500, 'temperature': 1.0}}
+    assert apply_tier('model4', settings) is settings      # no tier, the class settings
+
+    with tier_scope(policy.named('small')):
+        model4 = apply_tier('model4', settings)
+        model2 = apply_tier('model2', settings)
+    assert model2['model_name'] == 'gemini-1.5-flash-8b'
+    assert model2['generation_config'] == {'max_output_tokens': 2048, 'temperature': 0.2}
+    assert model4['generation_config']['max_output_tokens'] == 2500   # never above the class's own
+    assert settings['generation_config']['temperature'] == 1.0
+
+
+def test_the_tier_reaches_the_stage_calls(models, policy):
+    seen = []
+    model = models['make_model2']
+    model.backend = fake_backend(responder = lambda settings, prompt: seen.append(settings['model_name']) or 'ok')
+
+    with tier_scope(policy.named('small')):
+        list(model.stream('sum a list'))
+    list(model.stream('sum a list'))
+    assert seen == ['gemini-1.5-flash-8b', model.model_name]
+
+
+def test_named_is_none_for_an_unknown_tier():
+    assert tier_policy([{'name': 'only'}]).named('gone') is None
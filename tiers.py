@@ -0,0 +1,164 @@
+'''
+    per turn model tiers : a complexity estimate of the code request (model1's decision and
+    features of the prompt) picks a tier, and the tier's settings override the stage classes'
+    own for that turn only. small edits get the fastest model and small output caps, only
+    large tasks get the full budget of make_model2 .. make_model5
+
+        with tier_scope(default_tiers.choose(prompt, decision)) :
+            ... pipeline.stream(...)        every stage call in here (threads and tasks copy
+                                            the context) sees the tier's settings
+
+    a tier (tiers.json) : name, max_score (the last tier takes the rest), default = settings
+    for every stage, stages = {stage: settings} on top. settings are model_name and any
+    generation_config key (max_output_tokens, temperature ...), max_output_tokens never goes
+    above the class's own
+
+        MAKE_BEST_TIERS       1 uses tiers.json next to this file, a path uses that file,
+                              unset / 0 keeps the class settings (default)
+        MAKE_BEST_TIER_LOG    JSONL of every tier decision (score, features, trace id), to tune
+                              the thresholds against the turns' latency and tokens
+'''
+import contextlib
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+
+from stream_parser import task_text
+from tokens import estimate_tokens
+
+
+_current_tier = contextvars.ContextVar('make_best_tier', default = None)
+
+LARGE_HINTS = re.compile(
+    r'\b(?:application|app|system|framework|service|microservices?|server|database|schema|architecture|'
+    r'end[- ]to[- ]end|full[- ]stack|production|multiple files|package|library|gui|game|engine|compiler|'
+    r'interpreter|distributed|concurrent|concurrency|asynchronous|scalable)\b', re.I)
+SMALL_HINTS = re.compile(
+    r'\b(?:typo|rename|one[- ]liner|snippet|small|simple|quick|tiny|minor|short|just|only|single)\b', re.I)
+REQUIREMENT_LINE = re.compile(r'^\s*(?:[-*]|\d+[.)])\s+', re.M)
+CODE_FENCE = re.compile(r'```[^\n]*\n(.*?)(?:```|$)', re.S)
+
+
+def complexity(user_prompt, decision = None):
+    '''
+        {'score', 'features'} of a code request, higher means a bigger task. the task part of
+        prompt_for_model2 (model1's fixed directive left out) and the user's own words count
+    '''
+    task = task_text((decision or {}).get('prompt_for_model2') or user_prompt)
+    text = f'{user_prompt}\n{task}'
+    features = {
+        'task_tokens': estimate_tokens(task),
+        'code_lines': sum(block.count('\n') for block in CODE_FENCE.findall(user_prompt)),
+        'requirements': len(REQUIREMENT_LINE.findall(task)),
+        'large_hints': len({hint.lower() for hint in LARGE_HINTS.findall(text)}),
+        'small_hints': len({hint.lower() for hint in SMALL_HINTS.findall(text)})
+    }
+    score = (
+        features['task_tokens'] / 150
+        + features['code_lines'] / 40
+        + features['requirements'] * 0.5
+        + features['large_hints'] * 1.5
+        - features['small_hints']
+    )
+    return {'score': max(0.0, score), 'features': features}
+
+
+class tier_policy:
+    '''
+        choose() -> {'name', 'score', 'features', 'default', 'stages'} of the first tier whose
+        max_score the request's score does not pass, every choice is counted and logged
+    '''
+
+    def __init__(self, tiers, log_path = None):
+        self.tiers = tiers
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self.stats = {'decisions': 0, 'tiers': {tier['name']: 0 for tier in tiers}, 'score_sum': 0.0}
+
+    def choose(self, user_prompt, decision = None, trace_id = None):
+        estimate = complexity(user_prompt, decision)
+        tier = next((tier for tier in self.tiers if tier.get('max_score') is None or estimate['score'] <= tier['max_score']), self.tiers[-1])
+        chosen = {'name': tier['name'], 'default': tier.get('default', {}), 'stages': tier.get('stages', {}), **estimate}
+
+        with self._lock:
+            self.stats['decisions'] += 1
+            self.stats['tiers'][tier['name']] += 1
+            self.stats['score_sum'] += estimate['score']
+            if self.log_path:
+                record = {'at': time.time(), 'trace_id': trace_id, 'tier': tier['name'], 'score': estimate['score'],
+                          'features': estimate['features'], 'prompt': user_prompt[:200]}
+                with open(self.log_path, 'a', encoding = 'utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii = False) + '\n')
+        return chosen
+
+    def named(self, name):
+        '''
+            the tier called name in choose()'s form (no score), None when there is none, to run a
+            checkpointed turn again with the tier it started with
+        '''
+        tier = next((tier for tier in self.tiers if tier['name'] == name), None)
+        if tier is None:
+            return None
+        return {'name': name, 'default': tier.get('default', {}), 'stages': tier.get('stages', {}), 'score': None, 'features': {}}
+
+    def summary(self):
+        with self._lock:
+            decisions = self.stats['decisions']
+            return dict(self.stats, tiers = dict(self.stats['tiers']),
+                        mean_score = self.stats['score_sum'] / decisions if decisions else None)
+
+
+def current_tier():
+    return _current_tier.get()
+
+
+@contextlib.contextmanager
+def tier_scope(tier):
+    '''
+        tier (from choose(), None for the class settings) applies to the stage calls inside
+    '''
+    reset = _current_tier.set(tier)
+    try:
+        yield tier
+    finally:
+        _current_tier.reset(reset)
+
+
+def apply_tier(stage_name, settings):
+    '''
+        settings (make_base_model.settings) with the current tier's overrides for stage_name
+    '''
+    tier = _current_tier.get()
+    if tier is None:
+        return settings
+    overrides = dict(tier['default'], **tier['stages'].get(stage_name, {}))
+    if not overrides:
+        return settings
+
+    settings = dict(settings)
+    generation_config = dict(settings['generation_config'])
+    for key, value in overrides.items():
+        if key == 'model_name':
+            settings['model_name'] = value
+        elif key == 'max_output_tokens' and generation_config.get('max_output_tokens'):
+            generation_config[key] = min(value, generation_config[key])
+        else:
+            generation_config[key] = value
+    settings['generation_config'] = generation_config
+    return settings
+
+
+def tiers_from_env():
+    setting = os.getenv('MAKE_BEST_TIERS', '0').strip()
+    if setting in ('', '0'):
+        return None
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tiers.json') if setting == '1' else setting
+    with open(path, encoding = 'utf-8') as f:
+        tiers = json.load(f)['tiers']
+    return tier_policy(tiers, os.getenv('MAKE_BEST_TIER_LOG') or None)
+
+
+default_tiers = tiers_from_env()
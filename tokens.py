@@ -0,0 +1,133 @@
+'''
+    token accounting : a free local estimate everywhere, the backend's exact count (gemini's
+    count_tokens) only when the estimate says a prompt is close to its budget, cached per prompt
+
+    a stage's input budget is a share of its max_output_tokens : M3 / M4 / M5 write the
+    whole code back, so an input bigger than that gets a truncated answer (and a retry).
+    over budget, the chatter outside the code fences is dropped before the stage is called
+'''
+import threading
+from collections import OrderedDict
+
+from cache import cache_key
+from stream_parser import parse_all
+
+
+# part of max_output_tokens the code sent to a rewriting stage may use, the rest is
+# left for the json report and the changes
+OUTPUT_SHARE = 0.75
+
+# the local estimate is trusted below this share of a budget, above it the exact count is asked
+EXACT_ABOVE = 0.8
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for english and code, good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def input_budget(model):
+    '''
+        input tokens a rewriting stage can take without truncating its answer, None when unknown
+    '''
+    settings = getattr(model, 'settings', None)     # tiers.py may cap max_output_tokens for the turn
+    config = (settings['generation_config'] if isinstance(settings, dict) else getattr(model, 'generation_config', None)) or {}
+    max_output_tokens = config.get('max_output_tokens')
+    if not max_output_tokens:
+        return None
+    return int(max_output_tokens * OUTPUT_SHARE)
+
+
+def code_only(text):
+    '''
+        the fenced blocks of text (fences kept), None when it has none
+    '''
+    blocks = []
+    for kind, data in parse_all(text):
+        if kind == 'code_close':
+            blocks.append(f"```{data['language']}\n{data['code']}\n```")
+    return '\n\n'.join(blocks) if blocks else None
+
+
+class token_counter:
+    '''
+        count() = local estimate, or the backend's exact count near a budget (cached per prompt)
+        fit() trims a stage input to its budget, stats say how often and how much
+    '''
+
+    def __init__(self, max_entries = 1024):
+        self.max_entries = max_entries
+        self.stats = {'estimates': 0, 'exact_calls': 0, 'exact_hits': 0, 'exact_errors': 0,
+                      'trimmed': 0, 'trimmed_tokens': 0, 'over_budget': 0}
+        self._exact = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bump(self, name, amount = 1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def exact(self, model, text):
+        '''
+            the backend's own count for model's settings, None when the model can not tell
+        '''
+        backend = getattr(model, 'backend', None)
+        if backend is None or not hasattr(model, 'settings'):
+            return None
+
+        settings = model.settings
+        key = cache_key(settings['model_name'], settings['generation_config'], settings['system_instruction'], text)
+        with self._lock:
+            if key in self._exact:
+                self._exact.move_to_end(key)
+                self.stats['exact_hits'] += 1
+                return self._exact[key]
+
+        self._bump('exact_calls')
+        try:
+            tokens = backend.count_tokens(settings, text)
+        except Exception:
+            self._bump('exact_errors')
+            return None
+
+        with self._lock:
+            self._exact[key] = tokens
+            while len(self._exact) > self.max_entries:
+                self._exact.popitem(last = False)
+        return tokens
+
+    def count(self, text, model = None, budget = None):
+        self._bump('estimates')
+        tokens = estimate_tokens(text)
+        if model is not None and budget is not None and tokens > budget * EXACT_ABOVE:
+            exact = self.exact(model, text)
+            if exact is not None:
+                return exact
+        return tokens
+
+    def fit(self, text, budget, model = None):
+        '''
+            text unchanged when it fits in budget tokens, else only its code blocks
+            (still over budget is counted, the code itself is never cut)
+        '''
+        if budget is None:
+            return text
+        tokens = self.count(text, model, budget)
+        if tokens <= budget:
+            return text
+
+        trimmed = code_only(text)
+        if trimmed is not None and len(trimmed) < len(text):
+            trimmed_tokens = self.count(trimmed, model, budget)
+            self._bump('trimmed')
+            self._bump('trimmed_tokens', max(0, tokens - trimmed_tokens))
+            text, tokens = trimmed, trimmed_tokens
+        if tokens > budget:
+            self._bump('over_budget')
+        return text
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats, cached_counts = len(self._exact))
+
+
+default_counter = token_counter()
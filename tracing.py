@@ -0,0 +1,246 @@
+'''
+    per turn traces and per stage spans, exported as JSONL and as prometheus text
+
+        with default_tracer.trace('turn') as turn :        root span, new trace id
+            span = default_tracer.start_span('model2', model = ...)
+            with span :                                   ends it, records the error if any
+                span.chunk(text)                          ttft / chunk and token counts
+
+    a span started while a trace is open (same thread, a copied context or an asyncio task)
+    gets its trace id and the open span as parent. finished spans go to every exporter :
+        MAKE_BEST_TRACE_PATH      append one JSON line per span to this file
+        MAKE_BEST_METRICS_PORT    serve the prometheus text of default_metrics on this port
+'''
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cancel import turn_cancelled
+
+
+_current_span = contextvars.ContextVar('make_best_span', default = None)
+
+
+class span:
+    '''
+        one timed operation, attributes : model, prompt_tokens, response_tokens, ttft, chunks,
+        cache_hit, retries, error ; status is ok, error, cancelled (turn cancelled / past its
+        deadline) or abandoned (stream closed early)
+    '''
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.status = 'ok'
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._response_chars = 0
+        self._ended = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, amount = 1):
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def retry(self):
+        self.add('retries')
+
+    def chunk(self, text):
+        if 'ttft' not in self.attributes:
+            self.attributes['ttft'] = time.perf_counter() - self._started
+        self.add('chunks')
+        self._response_chars += len(text)
+
+    def end(self, status = None):
+        if self._ended:
+            return
+        self._ended = True
+        if status is not None:
+            self.status = status
+        if self._response_chars:
+            self.attributes['response_tokens'] = self._response_chars // 4 + 1   # same estimate as tokens.estimate_tokens
+        self.tracer.export(self.record(time.perf_counter() - self._started))
+
+    def record(self, duration):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.started_at,
+            'duration': duration,
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is GeneratorExit:
+            self.end('abandoned')
+        elif exc_type is not None and issubclass(exc_type, turn_cancelled):
+            self.attributes['error'] = str(exc)
+            self.end('cancelled')
+        elif exc_type is not None:
+            self.attributes['error'] = f'{exc_type.__name__}: {exc}'
+            self.end('error')
+        else:
+            self.end()
+        return False
+
+
+class tracer:
+
+    def __init__(self, exporters = ()):
+        self.exporters = list(exporters)
+
+    def start_span(self, name, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            return span(self, name, uuid.uuid4().hex, None, attributes)
+        return span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    @contextlib.contextmanager
+    def trace(self, name = 'turn', **attributes):
+        '''
+            root span of a turn, every span started inside (threads need a copied context) joins it
+        '''
+        root = span(self, name, uuid.uuid4().hex, None, attributes)
+        token = _current_span.set(root)
+        try:
+            with root:
+                yield root
+        finally:
+            _current_span.reset(token)
+
+    def export(self, record):
+        for exporter in self.exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                # tracing must never break a turn
+                print(f'trace export failed : {e}')
+
+
+class jsonl_exporter:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        line = json.dumps(record, ensure_ascii = False, default = str) + '\n'
+        with self._lock, open(self.path, 'a', encoding = 'utf-8') as f:
+            f.write(line)
+
+
+class metrics_exporter:
+    '''
+        aggregates finished spans into prometheus counters and histograms, render() -> text format
+    '''
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix = 'make_best'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}     # (metric, labels) -> value
+        self._histograms = {}   # (metric, labels) -> [bucket counts..., sum, count]
+
+    def _count(self, metric, labels, amount = 1):
+        key = (metric, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def _observe(self, metric, labels, value):
+        histogram = self._histograms.setdefault((metric, labels), [0] * len(self.BUCKETS) + [0.0, 0])
+        for index, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def export(self, record):
+        name = (('name', record['name']),)
+        attributes = record['attributes']
+        with self._lock:
+            self._count('spans_total', name + (('status', record['status']),))
+            self._observe('span_duration_seconds', name, record['duration'])
+            if 'ttft' in attributes:
+                self._observe('span_ttft_seconds', name, attributes['ttft'])
+            for kind in ('prompt', 'response'):
+                if attributes.get(f'{kind}_tokens'):
+                    self._count('tokens_total', name + (('kind', kind),), attributes[f'{kind}_tokens'])
+            if 'cache_hit' in attributes:     # model calls only, not the turn span
+                self._count('chunks_total', name, attributes.get('chunks', 0))
+                self._count('cache_hits_total', name, int(attributes['cache_hit']))
+                self._count('retries_total', name, attributes.get('retries', 0))
+
+    def render(self):
+        def _labels(labels, extra = ()):
+            pairs = [f'{key}="{value}"' for key, value in labels + extra]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines = []
+        with self._lock:
+            for (metric, labels), value in sorted(self._counters.items()):
+                lines.append(f'{self.prefix}_{metric}{_labels(labels)} {value}')
+            for (metric, labels), histogram in sorted(self._histograms.items()):
+                for bound, count in zip(self.BUCKETS, histogram):
+                    lines.append(f'{self.prefix}_{metric}_bucket{_labels(labels, (("le", bound),))} {count}')
+                lines.append(f'{self.prefix}_{metric}_bucket{_labels(labels, (("le", "+Inf"),))} {histogram[-1]}')
+                lines.append(f'{self.prefix}_{metric}_sum{_labels(labels)} {histogram[-2]}')
+                lines.append(f'{self.prefix}_{metric}_count{_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics, port, host = '127.0.0.1'):
+    '''
+        GET /metrics returns metrics.render(), served from a daemon thread
+    '''
+    class _handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def _tracer_from_env():
+    exporters = [default_metrics]
+    if os.getenv('MAKE_BEST_TRACE_PATH'):
+        exporters.append(jsonl_exporter(os.environ['MAKE_BEST_TRACE_PATH']))
+    if os.getenv('MAKE_BEST_METRICS_PORT'):
+        try:
+            serve_metrics(default_metrics, int(os.environ['MAKE_BEST_METRICS_PORT']))
+        except OSError as e:
+            # e.g. a second process on the same host, keep running without the endpoint
+            print(f'metrics endpoint not started : {e}')
+    return tracer(exporters)
+
+
+default_metrics = metrics_exporter()
+default_tracer = _tracer_from_env()